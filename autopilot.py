@@ -0,0 +1,573 @@
+import json
+import numpy as np
+import os
+from os.path import exists
+import time
+
+from review_session import *
+
+# Screens the classifier answers, in output order
+AUTOPILOT_SCREENS = ['Period', 'Eclipsing', 'Doppler beaming', 'Flares']
+
+# Fixed feature lengths
+FOLD_BINS = 64 # Phase bins of the curve folded once, and of the curve folded twice
+PERIODOGRAM_BINS = 128 # Log spaced period bins of the periodogram
+PERIODOGRAM_RANGE = (4e-4, 14) # Periods covered by the periodogram bins (days), from twice a 20 s cadence
+
+# Scalar features, after the binned curves and the periodogram
+SCALAR_FEATURES = ['log period', 'log power over cutoff', 'literature period', 'literature period doubled',
+                   'residuals flare max', 'residuals flare fraction', 'flux flare max', 'flux flare fraction']
+
+SCALAR_FEATURES_START = 2 * FOLD_BINS + PERIODOGRAM_BINS
+NUM_FEATURES = SCALAR_FEATURES_START + len(SCALAR_FEATURES)
+
+
+def bin_phase(phase, flux, num_bins):
+    """
+        Bins a folded curve into a fixed number of phase bins, filling empty bins from their neighbours, and
+        standardizes it
+        Parameters:
+                    phase: phase of each point, from -0.5 to 0.5
+                    flux: flux of each point
+                    num_bins: number of bins
+        Returns:
+                    binned_flux: standardized mean flux of each bin
+    """
+    finite = np.isfinite(phase) & np.isfinite(flux)
+    phase, flux = phase[finite], flux[finite]
+
+    if not len(flux):
+        return np.zeros(num_bins)
+
+    bins = np.clip(((phase + 0.5) * num_bins).astype(int), 0, num_bins - 1)
+    counts = np.bincount(bins, minlength=num_bins)
+    sums = np.bincount(bins, weights=flux, minlength=num_bins)
+
+    # Fill empty bins by interpolating between the filled ones
+    filled = counts > 0
+    centers = np.arange(num_bins)
+    binned_flux = np.interp(centers, centers[filled], sums[filled] / counts[filled])
+
+    # Shape only, so stars of any brightness and amplitude look alike
+    scale = np.std(binned_flux)
+    binned_flux = binned_flux - np.median(binned_flux)
+
+    return binned_flux / scale if scale > 0 else binned_flux
+
+
+def resample_periodogram(period, power):
+    """
+        Resamples a periodogram onto fixed log spaced period bins, keeping the maximum power of each bin
+        Parameters:
+                    period: periodogram periods (days)
+                    power: periodogram power
+        Returns:
+                    binned_power: maximum power of each bin over the maximum power (0 for empty bins)
+    """
+    finite = np.isfinite(period) & np.isfinite(power) & (period > 0)
+    period, power = period[finite], power[finite]
+
+    binned_power = np.zeros(PERIODOGRAM_BINS)
+    if not len(power) or power.max() <= 0:
+        return binned_power
+
+    edges = np.geomspace(*PERIODOGRAM_RANGE, PERIODOGRAM_BINS + 1)
+    bins = np.searchsorted(edges, period, side='right') - 1
+    inside = (bins >= 0) & (bins < PERIODOGRAM_BINS)
+
+    np.maximum.at(binned_power, bins[inside], power[inside])
+
+    return binned_power / power.max()
+
+
+def create_features(products):
+    """
+        Creates the fixed length features of a star from its numerical products
+        Parameters:
+                    products: dictionary of numpy arrays from StarProducts.create_products()
+        Returns:
+                    features: NUM_FEATURES float array
+    """
+    period = float(products['period_at_max_power'])
+    lit_period = float(products['lit_period'])
+
+    # Phases are in days, from -period / 2 to period / 2
+    fold = bin_phase(products['binned_phase'] / period, products['binned_flux'], FOLD_BINS)
+    double_fold = bin_phase(products['double_phase'] / (2 * period), products['double_flux'], FOLD_BINS)
+
+    periodogram = resample_periodogram(products['periodogram_period'], products['periodogram_power'])
+
+    max_power = np.nanmax(products['periodogram_power']) if len(products['periodogram_power']) else 0.0
+    cutoff = float(products['cutoff'])
+    significance = np.log10(max_power / cutoff) if max_power > 0 and cutoff > 0 else 0.0
+
+    # Same checks as irradiation and ellipsoidal
+    lit_at_period = lit_period > 0 and np.isclose(lit_period, period, rtol=1e-2)
+    lit_at_double = lit_period > 0 and np.isclose(lit_period, 2 * period, rtol=1e-2)
+
+    # Flare probabilities, when stella ran
+    flares = []
+    for key in ['residuals', 'flux']:
+        probability = products.get(f'flare_{key}_probability', np.array([]))
+        probability = probability[np.isfinite(probability)]
+        flares += [probability.max(), np.mean(probability > 0.5)] if len(probability) else [0.0, 0.0]
+
+    scalars = [np.log10(period), significance, lit_at_period, lit_at_double] + flares
+
+    return np.concatenate([fold, double_fold, periodogram, np.array(scalars, dtype=float)])
+
+
+class AutopilotModel(object):
+    def __init__(self, model_dir=None, hidden_units=64):
+        self.model_dir = model_dir
+
+        # Size of the hidden layer of a new model
+        self.hidden_units = hidden_units
+
+        # Feature standardization and layers, set by load() or fit()
+        self.feature_mean = None
+        self.feature_scale = None
+        self.layers = {}
+
+        if model_dir and exists(model_dir):
+            self.load(model_dir)
+
+
+    def load(self, model_dir):
+        """
+            Loads a trained model
+            Parameters:
+                        model_dir: path of the npz model
+            Returns:
+                        None
+        """
+        with np.load(model_dir) as data:
+            if list(data['screens']) != AUTOPILOT_SCREENS or int(data['num_features']) != NUM_FEATURES:
+                raise ValueError(f'Model {model_dir} was trained on different screens or features')
+
+            self.feature_mean = data['feature_mean']
+            self.feature_scale = data['feature_scale']
+            self.layers = {key: data[key] for key in ['hidden_weights', 'hidden_biases', 'output_weights', 'output_biases']}
+
+
+    def save(self, model_dir):
+        """
+            Atomically saves the model
+            Parameters:
+                        model_dir: path of the npz model
+            Returns:
+                        None
+        """
+        os.makedirs(os.path.dirname(model_dir) or '.', exist_ok=True)
+        tmp_dir = model_dir + '.tmp.npz'
+
+        np.savez(tmp_dir, screens=np.array(AUTOPILOT_SCREENS), num_features=np.array(NUM_FEATURES),
+                 feature_mean=self.feature_mean, feature_scale=self.feature_scale, **self.layers)
+
+        os.replace(tmp_dir, model_dir)
+
+
+    def forward(self, features):
+        """
+            Runs a batch of standardized features through the network
+            Parameters:
+                        features: (batch, NUM_FEATURES) standardized features
+            Returns:
+                        hidden: (batch, hidden units) hidden layer activations
+                        probabilities: (batch, len(AUTOPILOT_SCREENS)) probability each screen is a 'y'
+        """
+        hidden = np.maximum(features @ self.layers['hidden_weights'] + self.layers['hidden_biases'], 0)
+        logits = hidden @ self.layers['output_weights'] + self.layers['output_biases']
+
+        return hidden, 1 / (1 + np.exp(-np.clip(logits, -30, 30)))
+
+
+    def predict(self, features, batch_size=1024):
+        """
+            Scores many stars, a batch at a time
+            Parameters:
+                        features: (stars, NUM_FEATURES) features
+                        batch_size: stars scored at a time
+            Returns:
+                        probabilities: (stars, len(AUTOPILOT_SCREENS)) probability each screen is a 'y'
+        """
+        if not self.layers:
+            raise ValueError('Autopilot model has not been trained or loaded')
+
+        features = (np.asarray(features, dtype=float) - self.feature_mean) / self.feature_scale
+        probabilities = np.empty((len(features), len(AUTOPILOT_SCREENS)))
+
+        for start in range(0, len(features), batch_size):
+            _, probabilities[start:start + batch_size] = self.forward(features[start:start + batch_size])
+
+        return probabilities
+
+
+    def initialize(self, feature_mean, feature_scale, seed=0):
+        """
+            Starts a new model from random weights
+            Parameters:
+                        feature_mean: mean of each feature
+                        feature_scale: standard deviation of each feature
+                        seed: random seed of the initial weights
+            Returns:
+                        None
+        """
+        rng = np.random.default_rng(seed)
+
+        self.feature_mean = np.asarray(feature_mean, dtype=float)
+        self.feature_scale = np.where(np.asarray(feature_scale) > 0, feature_scale, 1.0)
+
+        self.layers = {
+            'hidden_weights': rng.normal(0, np.sqrt(2 / NUM_FEATURES), (NUM_FEATURES, self.hidden_units)),
+            'hidden_biases': np.zeros(self.hidden_units),
+            'output_weights': rng.normal(0, np.sqrt(1 / self.hidden_units), (self.hidden_units, len(AUTOPILOT_SCREENS))),
+            'output_biases': np.zeros(len(AUTOPILOT_SCREENS))
+        }
+
+        # Adam moments and step count
+        self.moments = {key: (np.zeros_like(value), np.zeros_like(value)) for key, value in self.layers.items()}
+        self.num_steps = 0
+
+
+    def step(self, features, labels, learning_rate=1e-3, weight_decay=1e-4):
+        """
+            Takes one Adam step on the binary cross entropy of every answered screen of a batch
+            Parameters:
+                        features: (batch, NUM_FEATURES) features
+                        labels: (batch, len(AUTOPILOT_SCREENS)) 1 for 'y', 0 for 'n', NaN if not answered
+                        learning_rate: Adam step size
+                        weight_decay: L2 penalty on the weights
+            Returns:
+                        loss: summed loss of the batch
+                        num_answered: number of answered screens in the batch
+        """
+        x = (np.asarray(features, dtype=float) - self.feature_mean) / self.feature_scale
+        labels = np.asarray(labels, dtype=float)
+
+        # Unanswered screens don't count towards the loss
+        mask = np.isfinite(labels)
+        y = np.where(mask, labels, 0.0)
+        num_answered = int(mask.sum())
+
+        hidden, probabilities = self.forward(x)
+        loss = -np.sum(mask * (y * np.log(probabilities + 1e-12) + (1 - y) * np.log(1 - probabilities + 1e-12)))
+
+        # Backpropagate the masked cross entropy
+        output_gradient = mask * (probabilities - y) / max(num_answered, 1)
+        hidden_gradient = (output_gradient @ self.layers['output_weights'].T) * (hidden > 0)
+
+        gradients = {
+            'hidden_weights': x.T @ hidden_gradient + weight_decay * self.layers['hidden_weights'],
+            'hidden_biases': hidden_gradient.sum(axis=0),
+            'output_weights': hidden.T @ output_gradient + weight_decay * self.layers['output_weights'],
+            'output_biases': output_gradient.sum(axis=0)
+        }
+
+        self.num_steps += 1
+        for key, gradient in gradients.items():
+            mean, variance = self.moments[key]
+            mean[:] = 0.9 * mean + 0.1 * gradient
+            variance[:] = 0.999 * variance + 0.001 * gradient * gradient
+            self.layers[key] -= (learning_rate * (mean / (1 - 0.9 ** self.num_steps)) / 
+                                 (np.sqrt(variance / (1 - 0.999 ** self.num_steps)) + 1e-8))
+
+        return loss, num_answered
+
+
+    def fit(self, features, labels, epochs=200, batch_size=64, learning_rate=1e-3, weight_decay=1e-4, seed=0):
+        """
+            Trains a new model on stars held in memory
+            Parameters:
+                        features: (stars, NUM_FEATURES) features
+                        labels: (stars, len(AUTOPILOT_SCREENS)) 1 for 'y', 0 for 'n', NaN if not answered
+                        epochs: passes over the stars
+                        batch_size: stars per step
+                        learning_rate: Adam step size
+                        weight_decay: L2 penalty on the weights
+                        seed: random seed of the initial weights and batch order
+            Returns:
+                        losses: mean loss of each epoch
+        """
+        rng = np.random.default_rng(seed)
+        features = np.asarray(features, dtype=float)
+        labels = np.asarray(labels, dtype=float)
+
+        self.initialize(features.mean(axis=0), features.std(axis=0), seed)
+
+        losses = []
+
+        for _ in range(epochs):
+            order = rng.permutation(len(features))
+            epoch_loss, epoch_answered = 0.0, 0
+
+            for start in range(0, len(features), batch_size):
+                batch = order[start:start + batch_size]
+                loss, num_answered = self.step(features[batch], labels[batch], learning_rate, weight_decay)
+                epoch_loss += loss
+                epoch_answered += num_answered
+
+            losses.append(epoch_loss / max(epoch_answered, 1))
+
+        return losses
+
+
+    def fit_loader(self, loader, epochs=200, learning_rate=1e-3, weight_decay=1e-4, seed=0):
+        """
+            Trains a new model on batches streamed from a training set, which never has to fit in memory
+            Parameters:
+                        loader: TrainingLoader of the training set
+                        epochs: passes over the training set
+                        learning_rate: Adam step size
+                        weight_decay: L2 penalty on the weights
+                        seed: random seed of the initial weights
+            Returns:
+                        losses: mean loss of each epoch
+        """
+        self.initialize(*loader.feature_statistics(), seed)
+
+        losses = []
+
+        for _ in range(epochs):
+            epoch_loss, epoch_answered = 0.0, 0
+
+            for features, labels in loader:
+                loss, num_answered = self.step(features, labels, learning_rate, weight_decay)
+                epoch_loss += loss
+                epoch_answered += num_answered
+
+            losses.append(epoch_loss / max(epoch_answered, 1))
+
+        return losses
+
+
+class Autopilot(object):
+    def __init__(self, preload_plots, model_dir, ledger=None, threshold=0.9, batch_size=256):
+        self.preload_plots = preload_plots
+        self.model_dir = model_dir
+
+        # Answers with a confidence (the probability of the chosen answer) under threshold are left to the reviewer
+        self.threshold = threshold
+
+        # Stars scored at a time
+        self.batch_size = batch_size
+
+        # Review session the confident answers are recorded in, so the reviewer only sees the remaining screens
+        self.session = ReviewSession(preload_plots, ledger)
+
+        # Every star's probabilities, one JSON line per star
+        self.scores_dir = self.preload_plots.preload_dir + 'autopilot.jsonl'
+
+
+    def load_scores(self):
+        """
+            Loads the TIC names of stars scored by previous runs
+            Parameters:
+                        None
+            Returns:
+                        tics: set of TIC names
+        """
+        tics = set()
+
+        if not exists(self.scores_dir):
+            return tics
+
+        with open(self.scores_dir, 'r') as f:
+            for line in f:
+                # Skip a line that was cut off mid write
+                if not line.endswith('\n'):
+                    break
+
+                tics.add(json.loads(line)['TIC'])
+
+        return tics
+
+
+    def load_features(self, tics):
+        """
+            Creates the features of a batch of stars from their stored products
+            Parameters:
+                        tics: TIC names of the stars
+            Returns:
+                        tics: TIC names of the stars whose products could be read
+                        features: (stars, NUM_FEATURES) features
+        """
+        loaded, features = [], []
+
+        for tic in tics:
+            try:
+                features.append(create_features(self.preload_plots.star_products.load(tic)))
+                loaded.append(tic)
+            except Exception as e:
+                print(f'Error for {tic}: {e} \n')
+
+        return loaded, np.array(features).reshape(-1, NUM_FEATURES)
+
+
+    def decide(self, probabilities):
+        """
+            Chooses the answer of every screen the classifier is confident about
+            Parameters:
+                        probabilities: probability each screen is a 'y', in AUTOPILOT_SCREENS order
+            Returns:
+                        answers: {screen: True/False} of the confident screens
+                        confidences: {screen: probability of the chosen answer} of every screen
+        """
+        answers, confidences = {}, {}
+
+        for screen, probability in zip(AUTOPILOT_SCREENS, probabilities):
+            confidences[screen] = float(max(probability, 1 - probability))
+
+            if confidences[screen] >= self.threshold:
+                answers[screen] = bool(probability >= 0.5)
+
+        # Effects don't matter for a period that isn't real
+        if answers.get('Period') is False:
+            answers = {'Period': False}
+
+        return answers, confidences
+
+
+    def write_scores(self, entries):
+        """
+            Appends the scores of a batch of stars
+            Parameters:
+                        entries: list of score dictionaries
+            Returns:
+                        None
+        """
+        with open(self.scores_dir, 'a') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+
+    def run(self):
+        """
+            Scores every preloaded star not scored yet in batches, recording its confident answers and saving the
+            stars with every needed screen answered, so only the rest are queued for review
+            Parameters:
+                        None
+            Returns:
+                        None
+        """
+        model = AutopilotModel(self.model_dir)
+        index = self.session.create_index()
+        decisions = self.session.load_decisions()
+        scored = self.load_scores()
+
+        self.session.saved = self.preload_plots.results_store.get_tics('results')
+
+        tics = [tic for tic in self.preload_plots.get_tics()
+                if tic in index and tic not in scored and not self.session.is_complete(decisions.get(tic, {}))]
+
+        num_decided = 0
+
+        for start in range(0, len(tics), self.batch_size):
+            batch_tics, features = self.load_features(tics[start:start + self.batch_size])
+            if not batch_tics:
+                continue
+
+            entries = []
+
+            for tic, probabilities in zip(batch_tics, model.predict(features)):
+                answers, confidences = self.decide(probabilities)
+                star_answers = decisions.setdefault(tic, {})
+
+                # Keep answers the reviewer already gave
+                for screen, answer in answers.items():
+                    if screen not in star_answers:
+                        self.session.record(tic, screen, answer, confidences[screen])
+                        star_answers[screen] = answer
+
+                entries.append({'TIC': tic, 'probabilities': dict(zip(AUTOPILOT_SCREENS, probabilities.tolist())),
+                                'confidences': confidences, 'answers': answers, 'time': time.time()})
+
+                if self.session.is_complete(star_answers):
+                    self.session.save_results({tic: star_answers}, index)
+                    num_decided += 1
+
+                    if self.session.ledger:
+                        self.session.preload_plots.results_store.flush()
+                        self.session.ledger.update_tic(tic, SAVED if star_answers['Period'] else REVIEWED)
+
+            self.write_scores(entries)
+
+        print(f'Autopilot decided {num_decided} of {len(tics)} stars, {len(tics) - num_decided} queued for review')
+
+
+    def load_answers(self):
+        """
+            Loads every reviewer answer (autopilot answers are left out)
+            Parameters:
+                        None
+            Returns:
+                        answers: {tic: {screen: True/False}}
+        """
+        answers = {}
+
+        if not exists(self.session.decisions_dir):
+            return answers
+
+        with open(self.session.decisions_dir, 'r') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+
+                entry = json.loads(line)
+                if entry.get('confidence') is None and entry['screen'] in AUTOPILOT_SCREENS:
+                    answers.setdefault(entry['TIC'], {})[entry['screen']] = entry['answer']
+
+        return answers
+
+
+    def create_training_set(self):
+        """
+            Creates features and labels from the products of every reviewed star
+            Parameters:
+                        None
+            Returns:
+                        features: (stars, NUM_FEATURES) features
+                        labels: (stars, len(AUTOPILOT_SCREENS)) 1 for 'y', 0 for 'n', NaN if not answered
+        """
+        answers = self.load_answers()
+
+        tics = [tic for tic in answers if self.preload_plots.star_products.exists(tic)]
+        tics, features = self.load_features(tics)
+
+        labels = np.array([[float(answers[tic][screen]) if screen in answers[tic] else np.nan
+                            for screen in AUTOPILOT_SCREENS] for tic in tics]).reshape(-1, len(AUTOPILOT_SCREENS))
+
+        return features, labels
+
+
+    def train(self, training_set=None, **fit_settings):
+        """
+            Trains the model on every reviewed star and saves it to model_dir
+            Parameters:
+                        training_set: TrainingSet to add the reviewer's answers to and stream from (None to train on
+                                      the stored products of the reviewed stars in memory)
+                        fit_settings: AutopilotModel.fit() (or fit_loader()) keyword arguments
+            Returns:
+                        losses: mean loss of each epoch
+        """
+        model = AutopilotModel()
+
+        if training_set is not None:
+            num_stars = training_set.add_labels(self.load_answers())
+            losses = model.fit_loader(training_set.create_loader(), **fit_settings)
+
+        else:
+            features, labels = self.create_training_set()
+            if not len(features):
+                raise ValueError(f'No reviewed stars with products in {self.preload_plots.products_dir} to train on')
+
+            num_stars = len(features)
+            losses = model.fit(features, labels, **fit_settings)
+
+        model.save(self.model_dir)
+
+        print(f'Trained the autopilot ({num_stars} reviewed stars), final loss {losses[-1]:.3f}')
+
+        return losses
@@ -0,0 +1,121 @@
+import argparse
+from astropy.timeseries import LombScargle
+import numpy as np
+import os
+import sys
+import time
+import warnings
+
+# Run from anywhere in the repo
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lightkurve as lk
+
+from detrending import *
+from synthetic_lightcurves import *
+
+
+def add_systematics(rng, time, flux):
+    """
+        Multiplies synthetic lightcurves by TESS like systematics: a decaying ramp after each downlink and a slow drift
+        Parameters:
+                    rng: numpy random generator
+                    time: time data (days)
+                    flux: (stars, time) flux, multiplied in place
+        Returns:
+                    None
+    """
+    num_stars = len(flux)
+    orbit_time = (time - time[0]) % (SECTOR_LENGTH / 2)
+
+    ramp = rng.uniform(0.002, 0.02, num_stars)[:, None] * np.exp(-orbit_time[None, :] / rng.uniform(0.3, 2, num_stars)[:, None])
+    drift = rng.uniform(-0.01, 0.01, num_stars)[:, None] * ((time - time.mean()) / (time.max() - time.min()))[None, :] ** 2
+
+    flux *= 1 + ramp + drift
+
+
+def peak_period(time, flux, cadence):
+    """
+        Finds the period at max power over the pipeline's period range
+        Parameters:
+                    time: time data (days)
+                    flux: flux data
+                    cadence: cadence (seconds)
+        Returns:
+                    period: period at max power (days)
+    """
+    frequency = np.arange(1 / 14, 86400 / (2 * cadence), 1 / (10 * (time.max() - time.min())))
+    power = LombScargle(time, flux).power(frequency, method='fast')
+
+    return 1 / frequency[np.argmax(power)]
+
+
+def lightkurve_process(time, flux, flux_err):
+    """
+        Cleans a sector as LightcurveData did before the detrender, with lightkurve
+        Parameters:
+                    time: time data (days)
+                    flux: flux data
+                    flux_err: flux error data
+        Returns:
+                    time: kept time data
+                    flux: normalized flux, about 0
+                    flux_err: normalized flux error
+    """
+    lightcurve = lk.LightCurve(time=time, flux=flux, flux_err=flux_err).remove_nans().remove_outliers().normalize() - 1
+
+    return lightcurve.time.value, lightcurve.flux.value, lightcurve.flux_err.value
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measures the speed and false peak suppression of the detrender')
+    parser.add_argument('--stars', type=int, default=200, help='number of synthetic stars')
+    parser.add_argument('--cadence', type=float, default=120, help='cadence in seconds')
+    parser.add_argument('--window', type=float, default=3.0, help='detrending window in days')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+
+    warnings.filterwarnings('ignore')
+
+    generator = SyntheticLightcurves(args.cadence, 1, args.seed)
+    flux, labels, parameters = generator.create_batch(0, args.stars)
+    add_systematics(np.random.default_rng(args.seed), generator.time, flux)
+
+    methods = {
+        'lightkurve': lightkurve_process,
+        'normalize only': Detrender().process,
+        f'median {args.window:g} d': Detrender(args.window).process,
+        f'biweight {args.window:g} d': Detrender(args.window, 'biweight').process
+    }
+
+    # Stars with a real period well inside the window, and stars with nothing periodic
+    real = (labels[:, AUTOPILOT_SCREENS.index('Period')] == 1) & (parameters['period'] < args.window / 3)
+    flat = labels[:, AUTOPILOT_SCREENS.index('Period')] == 0
+
+    print(f'{args.stars} stars, {len(generator.time)} points each, {real.sum()} with a real period under '
+          f'{args.window / 3:g} days, {flat.sum()} without a real period')
+    print(f"{'method':<18}{'ms per sector':>15}{'recovered':>12}{'false long peaks':>19}")
+
+    for name, process in methods.items():
+        seconds, recovered, long_peaks = 0.0, 0, 0
+
+        for star in range(args.stars):
+            flux_err = np.full(len(generator.time), np.hypot(parameters['white_noise'][star], parameters['red_noise'][star]))
+
+            start = time.perf_counter()
+            star_time, star_flux, _ = process(generator.time, flux[star].astype(float), flux_err)
+            seconds += time.perf_counter() - start
+
+            period = peak_period(star_time, star_flux, args.cadence)
+            injected = parameters['period'][star]
+
+            # The period, or half of it for eclipsing and ellipsoidal stars
+            if real[star] and min(abs(period / injected - ratio) for ratio in [1, 0.5, 2]) < 0.01:
+                recovered += 1
+
+            # Peaks past half the window in stars with nothing periodic come from systematics
+            if flat[star] and period > args.window / 2:
+                long_peaks += 1
+
+        print(f'{name:<18}{1000 * seconds / args.stars:>15.2f}{recovered / max(real.sum(), 1):>12.0%}'
+              f'{long_peaks / max(flat.sum(), 1):>19.0%}')
@@ -0,0 +1,183 @@
+import argparse
+from astropy.io import fits
+import hashlib
+import numpy as np
+import os
+import shutil
+import sys
+import tempfile
+import warnings
+
+import pandas as pd
+
+# Run from anywhere in the repo
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bulk_download import BulkDownloader, PRODUCT_COLUMNS
+from download_server import StandInServer
+
+# Each scenario: (description, faults of every file's first requests, ignore ranges, retries, files expected to fail)
+SCENARIOS = [
+    ('clean', [], False, 3, False),
+    ('dropped connections, resumed with ranges', ['drop', 'drop'], False, 3, False),
+    ('dropped connections, ranges ignored', ['drop', 'drop'], True, 3, False),
+    ('503 with Retry-After', ['status', 'status'], False, 3, False),
+    ('corrupt file, downloaded again', ['corrupt'], False, 3, False),
+    ('dropped more times than retried', ['drop'] * 5, False, 2, True)
+]
+
+
+def create_files(files_dir, num_files, size, seed=0):
+    """
+        Creates the files to serve: random bytes with md5 checksums in the product table, and one FITS file verified by
+        its own CHECKSUM and DATASUM keywords
+        Parameters:
+                    files_dir: directory to write them to
+                    num_files: number of random files
+                    size: bytes per random file
+                    seed: random seed
+        Returns:
+                    products: pandas dataframe of PRODUCT_COLUMNS, with bare file names as URLs
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+
+    for i in range(num_files):
+        filename = f'tess-s{i + 1:04d}-{i:016d}-lc.fits'
+        data = rng.bytes(size)
+
+        with open(os.path.join(files_dir, filename), 'wb') as f:
+            f.write(data)
+
+        rows.append({'iau_name': f'FAULT{i:04d}', 'sector': i + 1, 'exptime': 120.0, 'filename': filename, 'url': filename,
+                     'size': len(data), 'checksum': f'md5:{hashlib.md5(data).hexdigest()}'})
+
+    # A FITS file with no size or checksum in the table
+    filename = 'tess-s0099-0000000000000099-lc.fits'
+    hdul = fits.HDUList([fits.PrimaryHDU(), fits.BinTableHDU.from_columns([fits.Column('FLUX', 'E', array=rng.random(size // 8))])])
+    hdul.writeto(os.path.join(files_dir, filename), checksum=True)
+
+    rows.append({'iau_name': 'FAULT0099', 'sector': 99, 'exptime': 120.0, 'filename': filename, 'url': filename,
+                 'size': None, 'checksum': None})
+
+    return pd.DataFrame(rows, columns=PRODUCT_COLUMNS)
+
+
+def check_mirror(downloader, products, files_dir):
+    """
+        Compares every downloaded file with the file served
+        Parameters:
+                    downloader: BulkDownloader that downloaded the products
+                    products: pandas dataframe of PRODUCT_COLUMNS
+                    files_dir: directory of the served files
+        Returns:
+                    wrong: filenames missing from the mirror or differing from the served file
+    """
+    wrong = []
+
+    for _, product in products.iterrows():
+        path = downloader.create_dir(product)
+
+        with open(os.path.join(files_dir, product['filename']), 'rb') as f:
+            served = f.read()
+
+        if not os.path.exists(path) or open(path, 'rb').read() != served:
+            wrong.append(product['filename'])
+
+    return wrong
+
+
+def run_scenario(files_dir, products, faults, ignore_range, retries, expect_failed, workers):
+    """
+        Downloads every product from a stand-in server with the given faults into a fresh mirror, then again
+        Parameters:
+                    files_dir: directory of the served files
+                    products: pandas dataframe of PRODUCT_COLUMNS
+                    faults: faults given to each file's first requests
+                    ignore_range: True if the server ignores range requests
+                    retries: retries of a failed file
+                    expect_failed: True if every file should give up
+                    workers: concurrent downloads
+        Returns:
+                    problems: what went wrong (empty if the scenario passed)
+    """
+    mirror_dir = tempfile.mkdtemp(prefix='download_faults_')
+    server = StandInServer(files_dir, faults, ignore_range).start()
+    problems = []
+
+    try:
+        downloader = BulkDownloader(mirror_dir, workers, retries, backoff=0.01, max_backoff=0.05, timeout=10,
+                                    chunk_size=1 << 14, base_url=server.get_url())
+        failed = downloader.download(products)
+
+        if expect_failed:
+            if len(failed) != len(products):
+                problems.append(f'{len(products) - len(failed)} files downloaded, expected every file to give up')
+            if any(os.path.exists(downloader.create_dir(product)) for _, product in products.iterrows()):
+                problems.append('a file that gave up was renamed into the mirror')
+            return problems
+
+        if failed:
+            problems.append(f'failed: {failed}')
+
+        wrong = check_mirror(downloader, products, files_dir)
+        if wrong:
+            problems.append(f'missing or different from the served file: {wrong}')
+
+        # Each file's faults cost a request each, then it is served whole
+        expected = len(faults) + 1
+        counts = server.counts
+        if any(counts.get(filename, 0) != expected for filename in products['filename']):
+            problems.append(f'requests per file {sorted(set(counts.values()))}, expected {expected}')
+
+        # Dropped connections resume from the bytes already written, unless the server ignores the range
+        resumed = [status for _, range_header, status in server.requests if range_header and range_header != 'bytes=0-']
+        if 'drop' in faults and len(resumed) < len(products):
+            problems.append(f'only {len(resumed)} range requests after dropped connections')
+        if 'drop' in faults and set(resumed) != {200 if ignore_range else 206}:
+            problems.append(f'range requests answered with {sorted(set(resumed))}')
+
+        # A rerun finds every file in place
+        num_requests = len(server.requests)
+        downloader.download(products)
+        if len(server.requests) != num_requests:
+            problems.append(f'the rerun made {len(server.requests) - num_requests} requests')
+
+    finally:
+        server.stop()
+        shutil.rmtree(mirror_dir)
+
+    return problems
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Runs the bulk downloader against a local stand-in server that drops "
+                                                 "connections, ignores ranges, asks for retries and corrupts files, checking "
+                                                 "its retry, range resume and checksum paths")
+    parser.add_argument('--files', type=int, default=4, help='random files served, besides one FITS file')
+    parser.add_argument('--size', type=int, default=200000, help='bytes per random file')
+    parser.add_argument('--workers', type=int, default=4, help='concurrent downloads')
+    args = parser.parse_args()
+
+    warnings.filterwarnings('ignore')
+    files_dir = tempfile.mkdtemp(prefix='download_server_')
+
+    try:
+        products = create_files(files_dir, args.files, args.size)
+
+        results = {}
+        for description, faults, ignore_range, retries, expect_failed in SCENARIOS:
+            results[description] = run_scenario(files_dir, products, faults, ignore_range, retries, expect_failed, args.workers)
+
+    finally:
+        shutil.rmtree(files_dir)
+
+    print()
+    for description, problems in results.items():
+        print(f"{description}: {'ok' if not problems else 'FAILED, ' + '; '.join(problems)}")
+
+    passed = not any(results.values())
+    print('PASSED' if passed else 'FAILED')
+
+    sys.exit(0 if passed else 1)
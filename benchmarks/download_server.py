@@ -0,0 +1,205 @@
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import re
+import socket
+import threading
+from urllib.parse import unquote, urlparse
+
+# Faults a file's requests can be given, in order, before it is served normally
+FAULTS = ['drop', 'status', 'corrupt']
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # Keep-alive, as MAST serves it
+    protocol_version = 'HTTP/1.1'
+
+
+    def log_message(self, format, *args):
+        # Requests are recorded by the server instead
+        pass
+
+
+    def send_body(self, status, data, headers):
+        """
+            Sends a response with a body
+            Parameters:
+                        status: HTTP status
+                        data: body bytes
+                        headers: {header: value} besides the length
+            Returns:
+                        None
+        """
+        self.send_response(status)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+    def do_GET(self):
+        name = unquote(urlparse(self.path).path).lstrip('/')
+        path = os.path.join(self.server.files_dir, name)
+
+        if not os.path.isfile(path):
+            self.server.record(name, self.headers.get('Range'), 404)
+            self.send_body(404, b'Not found', {})
+            return
+
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        fault = self.server.next_fault(name)
+
+        # Unavailable, asking the client to wait
+        if fault == 'status':
+            self.server.record(name, self.headers.get('Range'), 503)
+            self.send_body(503, b'Unavailable', {'Retry-After': '1'})
+            return
+
+        # A flipped byte in the middle of the file
+        if fault == 'corrupt':
+            data = bytearray(data)
+            data[len(data) // 2] ^= 0xFF
+            data = bytes(data)
+
+        # Resume from the requested byte, unless ranges are ignored
+        match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if match and not self.server.ignore_range:
+            start = int(match.group(1))
+
+            if start >= len(data):
+                self.server.record(name, self.headers['Range'], 416)
+                self.send_body(416, b'', {'Content-Range': f'bytes */{len(data)}'})
+                return
+
+            status, body = 206, data[start:]
+            headers = {'Content-Range': f'bytes {start}-{len(data) - 1}/{len(data)}'}
+        else:
+            status, body, headers = 200, data, {}
+
+        self.server.record(name, self.headers.get('Range'), status)
+
+        if fault != 'drop':
+            self.send_body(status, body, headers)
+            return
+
+        # Promise the whole body, send half of it, then cut the connection
+        self.send_response(status)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body[:len(body) // 2])
+        self.wfile.flush()
+
+        self.connection.shutdown(socket.SHUT_RDWR)
+        self.close_connection = True
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, files_dir, faults=None, ignore_range=False, port=0):
+        super().__init__(('127.0.0.1', port), StandInHandler)
+
+        # Files are served from files_dir by their path in it
+        self.files_dir = files_dir
+
+        # Faults given to each file's first requests, in order, e.g. ['status', 'drop', 'drop']
+        self.faults = list(faults or [])
+
+        # True to answer range requests with the whole file, as some servers do
+        self.ignore_range = ignore_range
+
+        # Every request (name, Range header, status), and the number of requests per file
+        self.requests = []
+        self.counts = {}
+        self.lock = threading.Lock()
+
+        self.thread = None
+
+
+    def next_fault(self, name):
+        """
+            Counts a request for a file, giving it the next of the file's faults
+            Parameters:
+                        name: path of the file in files_dir
+            Returns:
+                        fault: one of FAULTS (None once the file's faults are used up)
+        """
+        with self.lock:
+            count = self.counts.get(name, 0)
+            self.counts[name] = count + 1
+
+        return self.faults[count] if count < len(self.faults) else None
+
+
+    def record(self, name, range_header, status):
+        """
+            Records a request
+            Parameters:
+                        name: path of the file in files_dir
+                        range_header: Range header of the request (None if not a range request)
+                        status: HTTP status of the response
+            Returns:
+                        None
+        """
+        with self.lock:
+            self.requests.append((name, range_header, status))
+
+
+    def get_url(self):
+        """
+            Gets the URL files are served under
+            Parameters:
+                        None
+            Returns:
+                        url: base URL, ending in '/'
+        """
+        return f'http://127.0.0.1:{self.server_address[1]}/'
+
+
+    def start(self):
+        """
+            Serves requests on a background thread
+            Parameters:
+                        None
+            Returns:
+                        server: this server
+        """
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+        return self
+
+
+    def stop(self):
+        """
+            Stops serving and closes the socket
+            Parameters:
+                        None
+            Returns:
+                        None
+        """
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serves a directory of lightcurve files as a stand-in for MAST, with faults')
+    parser.add_argument('--dir', required=True, help='directory of files to serve')
+    parser.add_argument('--port', type=int, default=8000, help='port to serve on')
+    parser.add_argument('--faults', nargs='*', default=[], choices=FAULTS,
+                        help="faults given to each file's first requests, in order")
+    parser.add_argument('--ignore-range', action='store_true', help='answer range requests with the whole file')
+    args = parser.parse_args()
+
+    server = StandInServer(args.dir, args.faults, args.ignore_range, args.port)
+    print(f'Serving {args.dir} at {server.get_url()}')
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
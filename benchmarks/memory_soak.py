@@ -0,0 +1,194 @@
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+
+import numpy as np
+import pandas as pd
+
+# Run from anywhere in the repo
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from data_sources import FixtureSource
+from memory_guard import release_memory
+from preload_engine import PreloadEngine
+from preload_plots import PreloadPlots
+from results_store import ResultsStore
+from run_ledger import *
+from stage_metrics import StageMetrics
+
+# Without stella every star stops at its flares, after every other stage has run, so the run is only partial
+STELLA = importlib.util.find_spec('stella') is not None
+
+
+def create_catalog(num_stars):
+    """
+        Creates a catalog of synthetic stars
+        Parameters:
+                    num_stars: number of stars
+        Returns:
+                    catalog_df: pandas dataframe with the columns the analysis reads
+    """
+    return pd.DataFrame({'iau_name': [f'SOAK{i:06d}' for i in range(num_stars)], 'tic': np.arange(num_stars),
+                         'i': 16.0, 'porb': 0.0, 'porbe': 0.0, 'ra': 0.0, 'decl': 0.0})
+
+
+def summarize(records, max_memory):
+    """
+        Summarizes the memory each worker was left at after each star
+        Parameters:
+                    records: stage metrics records of the run
+                    max_memory: memory ceiling of the workers (MB)
+        Returns:
+                    summary: {stars, statuses, workers, peak, over, growth per 1000 stars}
+    """
+    by_worker = {}
+    for record in sorted(records, key=lambda record: record['time']):
+        by_worker.setdefault(record['pid'], []).append(record['rss'])
+
+    # Growth within each worker's life, weighted by its stars (workers that only did a few stars say little)
+    slopes, weights = [], []
+    for rss in by_worker.values():
+        if len(rss) >= 10:
+            slopes.append(np.polyfit(np.arange(len(rss)), rss, 1)[0])
+            weights.append(len(rss))
+
+    rss = np.array([record['rss'] for record in records if record['rss'] is not None])
+    statuses = {}
+    for record in records:
+        statuses[record['status']] = statuses.get(record['status'], 0) + 1
+
+    summary = {
+        'stars': len(records),
+        'statuses': statuses,
+        'workers': len(by_worker),
+        'rss_p50': float(np.percentile(rss, 50)) if len(rss) else None,
+        'rss_peak': float(rss.max()) if len(rss) else None,
+        'over': int((rss > max_memory).sum()) if max_memory else 0,
+        'growth_per_1000': float(np.average(slopes, weights=weights) * 1000) if slopes else None
+    }
+
+    return summary
+
+
+def get_commit():
+    """
+        Gets the current commit of the repo
+        Parameters:
+                    None
+        Returns:
+                    commit: commit hash (None outside a git checkout), with '+' if the tree has changes
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        changed = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_DIR, capture_output=True,
+                                 text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return commit + ('+' if changed else '')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Preloads many synthetic stars with a memory ceiling, checking that worker '
+                                                 'memory stays bounded')
+    parser.add_argument('--stars', type=int, default=1000, help='synthetic stars to preload')
+    parser.add_argument('--sectors', type=int, default=1, help='sectors per lightcurve')
+    parser.add_argument('--cadence', type=float, default=120, help='cadence in seconds')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the synthetic lightcurves')
+    parser.add_argument('--workers', type=int, default=1, help='preload worker processes')
+    parser.add_argument('--max-memory', type=float, default=1000, help='MB a worker may be left at before the pool is recycled')
+    parser.add_argument('--margin', type=float, default=100, help='MB over max-memory a worker may reach before the soak fails')
+    parser.add_argument('--max-tasks', type=int, default=None,
+                        help='stars per worker before it is replaced anyway (default: never, so only the ceiling recycles)')
+    parser.add_argument('--dir', default=None, help='directory the run writes to (default a temporary one, removed after)')
+    parser.add_argument('--out', default=None, help='JSON to write (default benchmarks/results/memory-soak-<commit>.json)')
+    args = parser.parse_args()
+
+    warnings.filterwarnings('ignore')
+    if not STELLA:
+        print('stella is not installed, so every star fails at its flares (after every other stage has run)')
+
+    run_dir = args.dir or tempfile.mkdtemp(prefix='memory_soak_')
+    os.makedirs(run_dir, exist_ok=True)
+
+    class CatalogData(object):
+        catalog_df = create_catalog(args.stars)
+
+    ledger = RunLedger(os.path.join(run_dir, 'run_ledger.db'))
+    ledger.register(CatalogData.catalog_df['iau_name'])
+    metrics = StageMetrics(os.path.join(run_dir, 'metrics.jsonl'))
+    preload_plots = PreloadPlots(True, os.path.join(run_dir, 'periods.csv'), True,
+                                 results_store=ResultsStore(os.path.join(run_dir, 'results.db')),
+                                 preload_dir=os.path.join(run_dir, 'preload', ''))
+
+    lightcurve_settings = {'data_source': FixtureSource(cadence=args.cadence, num_sectors=args.sectors, seed=args.seed), 'bootstrap_samples': 0}
+    engine = PreloadEngine(CatalogData, preload_plots, args.cadence, args.workers, ledger,
+                           max_tasks_per_worker=args.max_tasks, lightcurve_settings=lightcurve_settings,
+                           metrics_settings=metrics.get_settings(), max_memory=args.max_memory)
+
+    start = time.perf_counter()
+    engine.run()
+    seconds = time.perf_counter() - start
+    preload_plots.results_store.flush()
+
+    summary = summarize(metrics.load(), args.max_memory)
+    summary['seconds'] = seconds
+    summary['main_rss'] = release_memory()
+
+    # Memory only says something about full stars, so a run without stella, or where every star failed, can't pass
+    bounded = summary['rss_peak'] is not None and summary['rss_peak'] <= args.max_memory + args.margin
+    partial = not STELLA or summary['statuses'].get(FAILED, 0) == summary['stars']
+    passed = bounded and not partial
+
+    growth = summary['growth_per_1000']
+    print(f"\n{summary['stars']} stars in {seconds / 60:.1f} min on {summary['workers']} worker processes, {summary['statuses']}")
+    if summary['rss_peak'] is not None:
+        print(f"Worker memory after each star: {summary['rss_p50']:.0f} MB p50, {summary['rss_peak']:.0f} MB peak, "
+              f"{summary['over']} stars over {args.max_memory:.0f} MB"
+              + (f', growing {growth:.1f} MB per 1000 stars within a worker' if growth is not None else ''))
+    print(f"Main process at {summary['main_rss']:.0f} MB")
+
+    if partial:
+        print('PARTIAL: ' + ('stella is not installed' if not STELLA else 'every star failed')
+              + ', so the stars stopped before their flares and the run says little about full stars')
+    elif not bounded:
+        print('FAILED: ' + (f"a worker reached {summary['rss_peak']:.0f} MB" if summary['rss_peak'] is not None
+                            else 'worker memory could not be read'))
+    else:
+        print('PASSED')
+
+    commit = get_commit()
+    run = {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.platform(),
+        'stella': STELLA,
+        'settings': vars(args),
+        'summary': summary,
+        'bounded': bounded,
+        'partial': partial,
+        'passed': passed
+    }
+
+    out_dir = args.out or os.path.join(REPO_DIR, 'benchmarks', 'results', f"memory-soak-{commit or 'unknown'}.json")
+    os.makedirs(os.path.dirname(out_dir), exist_ok=True)
+    with open(out_dir, 'w') as f:
+        json.dump(run, f, indent=4)
+
+    print(f'Wrote {out_dir}')
+
+    if not args.dir:
+        shutil.rmtree(run_dir)
+
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,310 @@
+import argparse
+import importlib.util
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+import warnings
+
+# Draw figures without a display
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+# Run from anywhere in the repo
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import lightkurve as lk
+
+from lightcurve_data import *
+from orb_calculator import *
+from synthetic_lightcurves import *
+
+from exoplanet_effects import ExoplanetEffects
+
+# Stella inference is skipped without stella (imported by ExoplanetEffects at first use)
+STELLA = importlib.util.find_spec('stella') is not None
+
+# Trace peak memory while measuring (tracing slows allocation heavy stages, e.g. figure rendering)
+TRACE_MEMORY = True
+
+# Stages, in pipeline order
+STAGES = ['periodogram', 'plausible_period', 'remove_eclipses', 'fit_sine_wave', 'fold_lightcurve', 'fold_sine_wave',
+          'render_figure', 'stella']
+
+
+class SyntheticLightcurveData(LightcurveData):
+    def __init__(self, lightcurve, catalog_row, cadence, **lightcurve_settings):
+        # Lightcurve used instead of searching MAST
+        self.synthetic_lightcurve = lightcurve
+
+        super().__init__(catalog_row, cadence, **lightcurve_settings)
+
+
+    def get_lightcurve(self):
+        """
+            Uses the synthetic lightcurve instead of searching for one
+            Parameters:
+                        None
+            Returns:
+                        lightcurve: synthetic lightcurve
+                        name: TIC name of the lightcurve
+                        imag: catalog i magnitude
+                        literature_period: literature period (0 if none)
+        """
+        self.sectors = self.synthetic_lightcurve.meta['SECTORS']
+
+        return self.synthetic_lightcurve, f"TIC {self.synthetic_lightcurve.meta['TICID']}", self.catalog_row['i'], 0.0
+
+
+def create_lightcurve(num_sectors, cadence, seed):
+    """
+        Creates a synthetic lightcurve with a real period, gaps removed
+        Parameters:
+                    num_sectors: number of sectors
+                    cadence: cadence (seconds)
+                    seed: random seed
+        Returns:
+                    lightcurve: lightkurve LightCurve
+                    period: injected period (days)
+    """
+    generator = SyntheticLightcurves(cadence, num_sectors, seed)
+    flux, labels, parameters = generator.create_batch(0, 32)
+
+    # First star with a real period
+    star = int(np.argmax(labels[:, AUTOPILOT_SCREENS.index('Period')]))
+    finite = np.isfinite(flux[star])
+    flux_err = np.full(finite.sum(), np.hypot(parameters['white_noise'][star], parameters['red_noise'][star]))
+
+    lightcurve = lk.LightCurve(time=generator.time[finite], flux=flux[star][finite], flux_err=flux_err,
+                               meta={'TICID': star, 'SECTORS': num_sectors})
+
+    return lightcurve, parameters['period'][star]
+
+
+def measure(function):
+    """
+        Runs a function, measuring its duration and its peak traced memory
+        Parameters:
+                    function: function to run
+        Returns:
+                    result: result of the function
+                    seconds: duration
+                    peak: peak traced memory (MB, None if not tracing)
+    """
+    if TRACE_MEMORY:
+        tracemalloc.start()
+    start = time.perf_counter()
+
+    try:
+        result = function()
+    finally:
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] / 1024 ** 2 if TRACE_MEMORY else None
+        tracemalloc.stop()
+
+    return result, seconds, peak
+
+
+def run_stage(stages, stage, function, fallback=None):
+    """
+        Runs and measures one stage, recording its error instead of stopping the run (as process_star would)
+        Parameters:
+                    stages: {stage: measurement} to record the stage in
+                    stage: name of the stage
+                    function: function running the stage
+                    fallback: result used by the later stages if the stage fails
+        Returns:
+                    result: result of the stage (fallback if it failed)
+    """
+    try:
+        result, seconds, peak = measure(function)
+    except Exception as e:
+        stages[stage] = {'seconds': None, 'peak_mb': None, 'error': repr(e)}
+        plt.close('all')
+        return fallback
+
+    stages[stage] = {'seconds': seconds, 'peak_mb': peak, 'error': None}
+
+    return result
+
+
+def run_stages(lightcurve, cadence, stella_model=None):
+    """
+        Runs every stage of one star's analysis in pipeline order, measuring each
+        Parameters:
+                    lightcurve: synthetic lightcurve
+                    cadence: cadence (seconds)
+                    stella_model: path of the stella model (None to skip stella)
+        Returns:
+                    stages: {stage: {seconds, peak_mb, error}} of the stages that ran
+    """
+    stages = {}
+    catalog_row = pd.Series({'iau_name': 'synthetic', 'i': 16.0, 'porb': 0.0, 'porbe': 0.0})
+
+    # Searching is replaced by the synthetic lightcurve, so this is the periodogram
+    lightcurve_data = run_stage(stages, 'periodogram', lambda: SyntheticLightcurveData(lightcurve, catalog_row, cadence))
+    if lightcurve_data is None:
+        return stages
+
+    # The same steps as OrbCalculator.__init__, one at a time
+    orb_calculator = OrbCalculator.__new__(OrbCalculator)
+    orb_calculator.lightcurve_data = lightcurve_data
+    orb_calculator.is_real_period = False
+
+    orb_calculator.is_plausible, orb_calculator.cutoff = run_stage(stages, 'plausible_period', orb_calculator.plausible_period,
+                                                                   (False, 0.0))
+    orb_calculator.no_eclipse_flux = run_stage(stages, 'remove_eclipses', orb_calculator.remove_eclipses, lightcurve_data.flux)
+    orb_calculator.sine_fit = run_stage(stages, 'fit_sine_wave',
+                                        lambda: orb_calculator.fit_sine_wave(lightcurve_data.time, orb_calculator.no_eclipse_flux))
+    if orb_calculator.sine_fit is None:
+        return stages
+
+    orb_calculator.binned_lightcurve = run_stage(stages, 'fold_lightcurve', orb_calculator.fold_lightcurve)
+    orb_calculator.binned_sine, orb_calculator.sine_period = run_stage(
+        stages, 'fold_sine_wave', lambda: orb_calculator.fold_sine_wave(lightcurve_data.time, orb_calculator.sine_fit.params['frequency'].value,
+                                                                        orb_calculator.sine_fit.best_fit), (None, None))
+    if orb_calculator.binned_lightcurve is None or orb_calculator.binned_sine is None:
+        return stages
+
+    orb_calculator.time_points = np.arange(min(lightcurve_data.time), max(lightcurve_data.time), orb_calculator.sine_period)
+    orb_calculator.xmin = min(lightcurve_data.time) + 1 + lightcurve_data.period_at_max_power
+    orb_calculator.xmax = min(lightcurve_data.time) + 1 + 4 * lightcurve_data.period_at_max_power
+
+    # Draw and encode the period screen, as preload would
+    def render_figure():
+        orb_calculator.is_real_period_plot()
+        plt.gcf().savefig(io.BytesIO(), format='png')
+        plt.close('all')
+
+    run_stage(stages, 'render_figure', render_figure)
+
+    # Stella needs its package and a trained model
+    if STELLA and stella_model and os.path.exists(stella_model):
+        exoplanet_effects = ExoplanetEffects.__new__(ExoplanetEffects)
+        exoplanet_effects.lightcurve_data = lightcurve_data
+        exoplanet_effects.orb_calculator = orb_calculator
+        exoplanet_effects.flare_predictions = {}
+
+        run_stage(stages, 'stella', exoplanet_effects.predict_flares)
+
+    return stages
+
+
+def get_commit():
+    """
+        Gets the current commit of the repo
+        Parameters:
+                    None
+        Returns:
+                    commit: commit hash (None outside a git checkout), with '+' if the tree has changes
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        changed = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_DIR, capture_output=True,
+                                 text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return commit + ('+' if changed else '')
+
+
+def compare(results, baseline_dir):
+    """
+        Prints each stage's time and peak memory against a baseline run
+        Parameters:
+                    results: results of this run
+                    baseline_dir: path of the baseline run's JSON
+        Returns:
+                    None
+    """
+    with open(baseline_dir, 'r') as f:
+        baseline = json.load(f)
+
+    previous = {(entry['sectors'], entry['stage']): entry for entry in baseline['results']}
+    print(f"\nAgainst {baseline_dir} (commit {baseline.get('commit')}):")
+
+    # Tracing memory slows allocation heavy stages, so times are only comparable between runs that both traced or not
+    if baseline['settings'].get('no_memory') != (not TRACE_MEMORY):
+        print('Warning: only one of the runs traced memory, so their times are not comparable')
+
+    for entry in results:
+        old = previous.get((entry['sectors'], entry['stage']))
+        if not old or not old['seconds'] or not entry['seconds']:
+            continue
+
+        ratio = entry['seconds'] / old['seconds']
+        flag = '  SLOWER' if ratio > 1.2 else ''
+        memory = (f", {old['peak_mb']:7.1f} -> {entry['peak_mb']:7.1f} MB" 
+                  if old['peak_mb'] is not None and entry['peak_mb'] is not None else '')
+        print(f"{entry['sectors']:>3} sectors {entry['stage']:<17} {old['seconds']:8.3f} s -> {entry['seconds']:8.3f} s "
+              f"({ratio:5.2f}x){memory}{flag}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measures each stage of a star's analysis on synthetic lightcurves")
+    parser.add_argument('--sectors', type=int, nargs='+', default=[1, 2, 4, 8, 13], help='lightcurve lengths to sweep (sectors)')
+    parser.add_argument('--cadence', type=float, default=120, help='cadence in seconds')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per length, the fastest is kept')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the synthetic lightcurves')
+    parser.add_argument('--stella-model', default='stella_results/ensemble_s0002_i0325_b0.73.h5', help='stella model for the stella stage')
+    parser.add_argument('--no-memory', action='store_true', help='skip tracing peak memory, for more accurate times')
+    parser.add_argument('--out', default=None, help='JSON to write (default benchmarks/results/<commit>.json)')
+    parser.add_argument('--compare', default=None, help='JSON of an earlier run to compare against')
+    args = parser.parse_args()
+
+    warnings.filterwarnings('ignore')
+    TRACE_MEMORY = not args.no_memory
+
+    results = []
+
+    for num_sectors in args.sectors:
+        lightcurve, period = create_lightcurve(num_sectors, args.cadence, args.seed)
+        print(f'{num_sectors} sectors, {len(lightcurve)} points, injected period {period:.4f} days')
+
+        # Keep each stage's fastest run
+        best = {}
+        for _ in range(args.repeat):
+            for stage, measured in run_stages(lightcurve, args.cadence, args.stella_model).items():
+                if stage not in best or (measured['seconds'] or np.inf) < (best[stage]['seconds'] or np.inf):
+                    best[stage] = measured
+
+        for stage in STAGES:
+            measured = best.get(stage, {'seconds': None, 'peak_mb': None, 'error': 'skipped'})
+            results.append(dict(sectors=num_sectors, points=len(lightcurve), stage=stage, **measured))
+
+            if measured['seconds'] is None:
+                print(f"    {stage:<17} {measured['error']}")
+            else:
+                peak = f", peak {measured['peak_mb']:7.1f} MB" if measured['peak_mb'] is not None else ''
+                print(f"    {stage:<17} {measured['seconds']:8.3f} s{peak}")
+
+    commit = get_commit()
+    run = {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'lightkurve': lk.__version__,
+        'machine': platform.platform(),
+        'settings': vars(args),
+        'results': results
+    }
+
+    out_dir = args.out or os.path.join(REPO_DIR, 'benchmarks', 'results', f"{commit or 'unknown'}.json")
+    os.makedirs(os.path.dirname(out_dir), exist_ok=True)
+    with open(out_dir, 'w') as f:
+        json.dump(run, f, indent=4)
+
+    print(f'Wrote {out_dir}')
+
+    if args.compare:
+        compare(results, args.compare)
@@ -0,0 +1,119 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+# Run from anywhere in the repo
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# What each mode imports before any work starts
+TARGETS = {
+    'review': 'import main',
+    'analysis': 'import main, lightcurve_data, orb_calculator, exoplanet_effects, save_data'
+}
+
+
+def measure(statement):
+    """
+        Imports a statement in a fresh interpreter with -X importtime
+        Parameters:
+                    statement: import statement
+        Returns:
+                    wall: seconds the interpreter took to start, import and exit
+                    imports: {package: seconds} spent importing each top level package and its submodules
+    """
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement], cwd=REPO_DIR, capture_output=True,
+                               text=True)
+    wall = time.perf_counter() - start
+
+    if completed.returncode:
+        raise RuntimeError(completed.stderr.strip().splitlines()[-1])
+
+    # Lines are 'import time: self [us] | cumulative | name', with each module's own time added to its package
+    imports = {}
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        own, _, name = line[len('import time:'):].split('|')
+        package = name.strip().split('.')[0]
+        imports[package] = imports.get(package, 0.0) + int(own) / 1e6
+
+    return wall, imports
+
+
+def get_commit():
+    """
+        Gets the current commit of the repo
+        Parameters:
+                    None
+        Returns:
+                    commit: commit hash (None outside a git checkout), with '+' if the tree has changes
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        changed = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_DIR, capture_output=True,
+                                 text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return commit + ('+' if changed else '')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measures the import time of each way of running the tool')
+    parser.add_argument('--repeat', type=int, default=5, help='interpreters started per mode, the fastest is kept')
+    parser.add_argument('--top', type=int, default=8, help='slowest packages listed per mode')
+    parser.add_argument('--out', default=None, help='JSON to write (default benchmarks/results/startup-<commit>.json)')
+    parser.add_argument('--compare', default=None, help='JSON of an earlier run to compare against')
+    args = parser.parse_args()
+
+    results = {}
+
+    for mode, statement in TARGETS.items():
+        try:
+            runs = [measure(statement) for _ in range(args.repeat)]
+        except RuntimeError as e:
+            print(f'{mode:<10} failed: {e}')
+            continue
+
+        wall, imports = min(runs, key=lambda run: run[0])
+        results[mode] = {'wall': wall, 'imports': sum(imports.values()), 'slowest': dict(sorted(imports.items(),
+                         key=lambda item: -item[1])[:args.top])}
+
+        print(f"{mode:<10} {wall:6.3f} s wall, {results[mode]['imports']:6.3f} s importing")
+        for name, seconds in results[mode]['slowest'].items():
+            print(f'    {name:<28} {seconds:6.3f} s')
+
+    commit = get_commit()
+    run = {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.platform(),
+        'settings': vars(args),
+        'results': results
+    }
+
+    out_dir = args.out or os.path.join(REPO_DIR, 'benchmarks', 'results', f"startup-{commit or 'unknown'}.json")
+    os.makedirs(os.path.dirname(out_dir), exist_ok=True)
+    with open(out_dir, 'w') as f:
+        json.dump(run, f, indent=4)
+
+    print(f'Wrote {out_dir}')
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+
+        print(f"\nAgainst {args.compare} (commit {baseline.get('commit')}):")
+        for mode, entry in results.items():
+            old = baseline['results'].get(mode)
+            if old:
+                flag = '  SLOWER' if entry['wall'] > 1.2 * old['wall'] else ''
+                print(f"{mode:<10} {old['wall']:6.3f} s -> {entry['wall']:6.3f} s ({entry['wall'] / old['wall']:5.2f}x){flag}")
@@ -0,0 +1,89 @@
+import argparse
+import numpy as np
+import os
+import resource
+import sys
+import time
+import tracemalloc
+
+# Run from anywhere in the repo
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from streaming_periodogram import *
+
+
+def create_series(num_points, cadence, seed=0):
+    """
+        Creates a synthetic multi sector lightcurve, with a sinusoid, white noise and a gap every 27 days
+        Parameters:
+                    num_points: number of points
+                    cadence: cadence of the points (seconds)
+                    seed: random seed
+        Returns:
+                    time: time data (days)
+                    flux: flux data
+    """
+    rng = np.random.default_rng(seed)
+    step = cadence / 86400
+
+    # Leave a one day gap between 26 day sectors
+    time = np.arange(num_points) * step
+    time = 2000 + time + np.floor(time / 26)
+
+    flux = 0.002 * np.sin(2 * np.pi * time / 0.21) + rng.normal(0, 0.01, num_points)
+
+    return time, flux
+
+
+def measure(function):
+    """
+        Runs a function, measuring its duration and its peak traced memory
+        Parameters:
+                    function: function to run
+        Returns:
+                    result: result of the function
+                    seconds: duration
+                    peak: peak traced memory (MB)
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+
+    result = function()
+
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, seconds, peak / 1024 ** 2
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measures the peak memory of the streaming periodogram on a synthetic lightcurve')
+    parser.add_argument('--points', type=int, default=2000000, help='number of points')
+    parser.add_argument('--cadence', type=float, default=20, help='cadence of the points in seconds')
+    parser.add_argument('--minimum-period', type=float, default=None, help='minimum period in days (default twice the cadence)')
+    parser.add_argument('--memory-limit', type=float, default=256, help='memory limit of the streaming periodogram in MB')
+    parser.add_argument('--compare', action='store_true', help="also measure lightkurve's periodogram")
+    args = parser.parse_args()
+
+    time_data, flux = create_series(args.points, args.cadence)
+    minimum_period = args.minimum_period or 2 * args.cadence / 86400
+
+    streaming_periodogram = StreamingPeriodogram(args.memory_limit)
+    _, _, num_frequencies = streaming_periodogram.create_grid(time_data, minimum_period, 14)
+    time_block, frequency_block = streaming_periodogram.get_block_sizes(len(time_data), num_frequencies)
+    print(f'{args.points} points, {num_frequencies} frequencies, blocks of {time_block} points x {frequency_block} frequencies')
+
+    (frequency, power), seconds, peak = measure(lambda: streaming_periodogram.compute(time_data, flux, minimum_period=minimum_period))
+    print(f'Streaming: {seconds:.1f} s, peak {peak:.0f} MB ({power.nbytes / 1024 ** 2:.0f} MB of it the power array), '
+          f'period at max power {1 / frequency[np.argmax(power)]:.5f} days')
+
+    if args.compare:
+        import lightkurve as lk
+
+        lightcurve = lk.LightCurve(time=time_data, flux=flux)
+        periodogram, seconds, peak = measure(lambda: lightcurve.to_periodogram(oversample_factor=10, minimum_period=minimum_period,
+                                                                               maximum_period=14))
+        print(f'Lightkurve: {seconds:.1f} s, peak {peak:.0f} MB, period at max power {periodogram.period_at_max_power.value:.5f} days')
+
+    print(f'Max resident memory: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB')
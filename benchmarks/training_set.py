@@ -0,0 +1,109 @@
+import argparse
+import importlib.util
+import numpy as np
+import os
+import shutil
+import sys
+import tempfile
+import warnings
+
+import pandas as pd
+
+# Run from anywhere in the repo
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from autopilot import AUTOPILOT_SCREENS, NUM_FEATURES
+from data_sources import FixtureSource
+from training_set import TrainingSet
+
+# Without stella every star fails at its flares, so no row is written
+STELLA = importlib.util.find_spec('stella') is not None
+
+
+def create_catalog(num_stars):
+    """
+        Creates a catalog of synthetic stars
+        Parameters:
+                    num_stars: number of stars
+        Returns:
+                    catalog_df: pandas dataframe with the columns the analysis reads
+    """
+    return pd.DataFrame({'iau_name': [f'TRAIN{i:06d}' for i in range(num_stars)], 'tic': 1000 + np.arange(num_stars),
+                         'i': 16.0, 'porb': 0.0, 'porbe': 0.0, 'ra': 0.0, 'decl': 0.0})
+
+
+def check_set(training_set, catalog_df, failed, max_failed):
+    """
+        Checks that every star of the catalog has one row, with its TIC and finite features, other than the few whose
+        analysis raised
+        Parameters:
+                    training_set: TrainingSet that was built
+                    catalog_df: pandas dataframe of the catalog data
+                    failed: {iau_name: error} of the stars whose analysis raised
+                    max_failed: stars whose analysis may raise
+        Returns:
+                    problems: what went wrong (empty if the set is complete)
+    """
+    import h5py
+
+    with h5py.File(training_set.training_dir, 'r') as f:
+        iau_names = list(f['iau_name'].asstr()[:])
+        tics = list(f['tic'].asstr()[:])
+        features = f['features'][:]
+        labels = f['labels'][:]
+
+    problems = []
+
+    # Some synthetic stars defeat the eclipse fit, but a star is only ever missing because its analysis raised
+    missing = sorted(set(catalog_df['iau_name']) - set(iau_names))
+    if len(iau_names) != len(set(iau_names)) or len(iau_names) + len(missing) != len(catalog_df):
+        problems.append(f'{len(iau_names)} rows for {len(catalog_df)} stars')
+    if set(missing) - set(failed):
+        problems.append(f'no row and no error for {sorted(set(missing) - set(failed))}')
+    if len(failed) > max_failed:
+        problems.append(f'{len(failed)} stars failed (at most {max_failed} may): {failed}')
+
+    expected = {row['iau_name']: f"TIC {row['tic']}" for _, row in catalog_df.iterrows()}
+    wrong = [iau_name for iau_name, tic in zip(iau_names, tics) if expected.get(iau_name) != tic]
+    if wrong:
+        problems.append(f'wrong TIC for {wrong}')
+
+    if features.shape[1:] != (NUM_FEATURES,) or labels.shape[1:] != (len(AUTOPILOT_SCREENS),):
+        problems.append(f'features {features.shape} and labels {labels.shape} have the wrong widths')
+    elif not np.isfinite(features).all():
+        problems.append(f'{int((~np.isfinite(features).any(axis=1)).sum())} rows have non finite features')
+
+    return problems
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Builds a training set from a few synthetic stars, checking every star gets '
+                                                 'a row')
+    parser.add_argument('--stars', type=int, default=6, help='synthetic stars')
+    parser.add_argument('--cadence', type=float, default=120, help='cadence in seconds')
+    parser.add_argument('--workers', type=int, default=2, help='worker processes')
+    parser.add_argument('--max-failed', type=int, default=1, help='stars whose analysis may raise (e.g. a diverging eclipse fit)')
+    args = parser.parse_args()
+
+    warnings.filterwarnings('ignore')
+    if not STELLA:
+        print('stella is not installed, so every star fails at its flares and the check cannot pass')
+
+    run_dir = tempfile.mkdtemp(prefix='training_set_')
+
+    try:
+        catalog_df = create_catalog(args.stars)
+        training_set = TrainingSet(os.path.join(run_dir, 'training.h5'), chunk_rows=max(1, args.stars // 2))
+
+        lightcurve_settings = {'data_source': FixtureSource(cadence=args.cadence), 'bootstrap_samples': 0}
+        failed = training_set.build(catalog_df, args.cadence, args.workers, lightcurve_settings)
+
+        problems = check_set(training_set, catalog_df, failed, args.max_failed)
+
+    finally:
+        shutil.rmtree(run_dir)
+
+    print(f'{args.stars - len(failed)} of {args.stars} stars written' + (f', {len(failed)} failed' if failed else ''))
+    print('PASSED' if not problems else 'FAILED: ' + '; '.join(problems))
+
+    sys.exit(0 if not problems else 1)
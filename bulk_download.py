@@ -0,0 +1,367 @@
+import argparse
+from astropy.io import fits
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
+import numpy as np
+import os
+from os.path import exists
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+import threading
+import time
+from tqdm import tqdm
+
+# MAST file download endpoint, followed by a product's data URI
+MAST_DOWNLOAD_URL = 'https://mast.stsci.edu/api/v0.1/Download/file?uri='
+
+# Columns of a product table, one row per file ('size' and 'checksum', e.g. 'md5:<hex>', may be empty)
+PRODUCT_COLUMNS = ['iau_name', 'sector', 'exptime', 'filename', 'url', 'size', 'checksum']
+
+# Responses worth retrying
+RETRY_STATUSES = [408, 429, 500, 502, 503, 504]
+
+
+class RetryableError(Exception):
+    pass
+
+
+class BulkDownloader(object):
+    def __init__(self, mirror_dir, workers=8, max_retries=5, backoff=1.0, max_backoff=60.0, rate_limit=None, timeout=60,
+                 chunk_size=1 << 20, base_url=MAST_DOWNLOAD_URL):
+        # Files are written to mirror_dir/s<sector>/<filename>, the layout MirrorSource indexes
+        self.mirror_dir = mirror_dir
+
+        # Concurrent downloads, each on a pooled keep-alive connection
+        self.workers = workers
+
+        # Retries of a failed file, waiting backoff * 2^attempt seconds (jittered, at most max_backoff) in between
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        # Most requests started per second across every worker (None for no limit)
+        self.rate_limit = rate_limit
+        self.next_request = 0.0
+        self.rate_lock = threading.Lock()
+
+        self.timeout = timeout # Seconds without a response before a request fails
+        self.chunk_size = chunk_size # Bytes written at a time
+        self.base_url = base_url # Prefix of data URIs that aren't URLs
+
+        self.session = self.create_session()
+
+
+    def create_session(self):
+        """
+            Creates an HTTP session with a connection pool as large as the number of workers
+            Parameters:
+                        None
+            Returns:
+                        session: requests session
+        """
+        session = requests.Session()
+
+        # Retries are handled per file, so a resumed retry keeps what was already downloaded
+        adapter = HTTPAdapter(pool_connections=self.workers, pool_maxsize=self.workers, max_retries=0)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+        return session
+
+
+    def search_products(self, catalog_df, cadence, multi_cadence=False):
+        """
+            Searches MAST for the lightcurve files of every catalog star, across the worker threads
+            Parameters:
+                        catalog_df: pandas dataframe of the catalog data
+                        cadence: desired cadence for lightcurves
+                        multi_cadence: True to keep every cadence, as multi cadence mode can use them
+            Returns:
+                        products: pandas dataframe of PRODUCT_COLUMNS
+        """
+        import lightkurve as lk
+
+        def search(iau_name):
+            for attempt in range(self.max_retries + 1):
+                try:
+                    self.wait_for_rate()
+                    return lk.search_lightcurve(iau_name, mission='TESS').table
+                except Exception:
+                    if attempt == self.max_retries:
+                        raise
+                    time.sleep(self.get_delay(attempt))
+
+        rows = []
+        with ThreadPoolExecutor(max_workers = self.workers) as executor:
+            futures = {executor.submit(search, iau_name): iau_name for iau_name in catalog_df['iau_name']}
+
+            for future in tqdm(as_completed(futures), 'Searching MAST', total = len(futures)):
+                iau_name = futures[future]
+
+                try:
+                    table = future.result()
+                except Exception as e:
+                    print(f'Error for {iau_name}: {e} \n')
+                    continue
+
+                for product in table:
+                    exptime = float(product['exptime'])
+                    if not str(product['productFilename']).endswith('lc.fits') or (exptime != cadence and not multi_cadence):
+                        continue
+
+                    rows.append({'iau_name': iau_name, 'sector': int(product['sequence_number']), 'exptime': exptime,
+                                 'filename': str(product['productFilename']), 'url': str(product['dataURI']),
+                                 'size': int(product['size']) if 'size' in product.colnames else None, 'checksum': None})
+
+        return pd.DataFrame(rows, columns=PRODUCT_COLUMNS)
+
+
+    def get_delay(self, attempt, retry_after=None):
+        """
+            Gets the wait before a retry, doubling with every attempt with +-50% jitter
+            Parameters:
+                        attempt: number of the failed attempt (from 0)
+                        retry_after: wait asked for by the server (seconds, None if not asked)
+            Returns:
+                        delay: seconds to wait
+        """
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt) * np.random.uniform(0.5, 1.5)
+
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_backoff))
+
+        return delay
+
+
+    def wait_for_rate(self):
+        """
+            Waits for the next request slot under the rate limit, shared by every worker
+            Parameters:
+                        None
+            Returns:
+                        None
+        """
+        if not self.rate_limit:
+            return
+
+        with self.rate_lock:
+            now = time.monotonic()
+            start = max(now, self.next_request)
+            self.next_request = start + 1 / self.rate_limit
+
+        time.sleep(max(0.0, start - now))
+
+
+    def create_dir(self, product):
+        """
+            Creates the mirror path of a product
+            Parameters:
+                        product: row of the product table
+            Returns:
+                        path: path of the file
+        """
+        return os.path.join(self.mirror_dir, f"s{int(product['sector']):04d}", product['filename'])
+
+
+    def get_url(self, product):
+        """
+            Gets the URL of a product
+            Parameters:
+                        product: row of the product table
+            Returns:
+                        url: URL of the file
+        """
+        url = product['url']
+
+        return url if url.startswith(('http://', 'https://')) else self.base_url + url
+
+
+    def verify(self, path, size=None, checksum=None):
+        """
+            Checks a downloaded file against its expected size and checksum, or else the FITS checksums in its headers
+            Parameters:
+                        path: path of the file
+                        size: expected size in bytes (None if unknown)
+                        checksum: expected '<algorithm>:<hex digest>' (None if unknown)
+            Returns:
+                        None, raising RetryableError if the file is incomplete or corrupt
+        """
+        if size is not None and os.path.getsize(path) != size:
+            raise RetryableError(f'Size {os.path.getsize(path)} is not the expected {size}')
+
+        if checksum:
+            algorithm, expected = checksum.split(':', 1)
+            digest = hashlib.new(algorithm)
+
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(self.chunk_size), b''):
+                    digest.update(block)
+
+            if digest.hexdigest() != expected.lower():
+                raise RetryableError(f'{algorithm} checksum {digest.hexdigest()} is not the expected {expected}')
+
+            return
+
+        # SPOC files carry CHECKSUM and DATASUM keywords in every HDU (0 means the keyword is there and wrong)
+        try:
+            with fits.open(path, memmap=False) as hdul:
+                for hdu in hdul:
+                    if hdu.verify_datasum() == 0 or hdu.verify_checksum() == 0:
+                        raise RetryableError(f'FITS checksum of HDU {hdu.name} does not match')
+        except OSError as e:
+            raise RetryableError(f'Not a readable FITS file: {e}')
+
+
+    def fetch(self, url, part_dir):
+        """
+            Downloads a URL into a partial file, resuming from what is already in it
+            Parameters:
+                        url: URL of the file
+                        part_dir: path of the partial file
+            Returns:
+                        size: total size in bytes given by the server (None if not given)
+        """
+        start = os.path.getsize(part_dir) if exists(part_dir) else 0
+        headers = {'Range': f'bytes={start}-'} if start else {}
+
+        self.wait_for_rate()
+
+        with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+            # The partial file is already whole
+            if response.status_code == 416 and start:
+                return start
+
+            if response.status_code in RETRY_STATUSES:
+                retry_after = response.headers.get('Retry-After')
+                raise RetryableError(f'HTTP {response.status_code}', float(retry_after) if retry_after and retry_after.isdigit() else None)
+
+            response.raise_for_status()
+
+            # Servers that ignore the range send the whole file again
+            resumed = bool(start) and response.status_code == 206
+            if resumed:
+                size = int(response.headers['Content-Range'].rsplit('/', 1)[1]) if '/' in response.headers.get('Content-Range', '') else None
+            else:
+                size = int(response.headers['Content-Length']) if 'Content-Length' in response.headers else None
+
+            with open(part_dir, 'ab' if resumed else 'wb') as f:
+                for block in response.iter_content(self.chunk_size):
+                    f.write(block)
+
+        return size
+
+
+    def download_product(self, product):
+        """
+            Downloads one product into the mirror, retrying with backoff and verifying it before it is renamed into place
+            Parameters:
+                        product: row of the product table
+            Returns:
+                        downloaded: True if downloaded, False if it was already in the mirror
+        """
+        path = self.create_dir(product)
+        part_dir = path + '.part'
+        size = int(product['size']) if pd.notna(product['size']) else None
+        checksum = product['checksum'] if isinstance(product['checksum'], str) and product['checksum'] else None
+
+        if exists(path):
+            return False
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+
+            try:
+                served_size = self.fetch(self.get_url(product), part_dir)
+            except RetryableError as e:
+                error = e
+                retry_after = e.args[1] if len(e.args) > 1 else None
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                # Whatever arrived is kept, and the next attempt resumes from it
+                error = e
+            else:
+                try:
+                    self.verify(part_dir, size if size is not None else served_size, checksum)
+
+                    os.replace(part_dir, path)
+                    return True
+
+                except RetryableError as e:
+                    # A short file resumes, a corrupt one is downloaded again from the start
+                    error = e
+                    if size is None or os.path.getsize(part_dir) >= size:
+                        os.remove(part_dir)
+
+            if attempt < self.max_retries:
+                time.sleep(self.get_delay(attempt, retry_after))
+
+        raise RetryableError(f'Gave up after {self.max_retries + 1} attempts: {error}')
+
+
+    def download(self, products):
+        """
+            Downloads every product not in the mirror yet across the worker threads
+            Parameters:
+                        products: pandas dataframe of PRODUCT_COLUMNS
+            Returns:
+                        failed: {filename: error} of the products that could not be downloaded
+        """
+        failed = {}
+        downloaded = 0
+
+        with ThreadPoolExecutor(max_workers = self.workers) as executor:
+            futures = {executor.submit(self.download_product, product): product['filename']
+                       for _, product in products.drop_duplicates('filename').iterrows()}
+
+            with tqdm(total = len(futures), desc = 'Downloading lightcurves') as progress:
+                for future in as_completed(futures):
+                    filename = futures[future]
+
+                    try:
+                        downloaded += future.result()
+                    except Exception as e:
+                        failed[filename] = repr(e)
+
+                    progress.update(1)
+                    progress.set_postfix(failed = len(failed))
+
+        print(f'Downloaded {downloaded} files into {self.mirror_dir}, {len(futures) - downloaded - len(failed)} were already there'
+              + (f', {len(failed)} failed' if failed else ''))
+
+        return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Downloads the TESS lightcurves of the catalog into a local mirror')
+    parser.add_argument('--mirror', required=True, help='directory of the mirror (data_source = mirror reads it)')
+    parser.add_argument('--catalog', default='raw_wdss_data.csv', help='raw catalog query to search MAST for')
+    parser.add_argument('--catalog-cache', default='wdss_data.feather', help='cached copy of the catalog columns (as catalog_dir)')
+    parser.add_argument('--products', default=None, help=f"product table CSV ({', '.join(PRODUCT_COLUMNS)}), "
+                                                         'written by the search and reused so reruns skip it')
+    parser.add_argument('--cadence', type=float, default=120, help='cadence to download in seconds')
+    parser.add_argument('--multi-cadence', action='store_true', help='download every cadence')
+    parser.add_argument('--workers', type=int, default=8, help='concurrent downloads')
+    parser.add_argument('--retries', type=int, default=5, help='retries of a failed file')
+    parser.add_argument('--rate-limit', type=float, default=None, help='most requests per second')
+    parser.add_argument('--base-url', default=MAST_DOWNLOAD_URL, help='prefix of data URIs that are not URLs')
+    args = parser.parse_args()
+
+    downloader = BulkDownloader(args.mirror, args.workers, args.retries, rate_limit=args.rate_limit, base_url=args.base_url)
+    products_dir = args.products or os.path.join(args.mirror, 'products.csv')
+
+    if exists(products_dir):
+        products = pd.read_csv(products_dir)
+    else:
+        from catalog_data import CatalogData
+
+        catalog_data = CatalogData(args.catalog, args.catalog_cache, '', resume=True)
+        products = downloader.search_products(catalog_data.catalog_df, args.cadence, args.multi_cadence)
+
+        os.makedirs(os.path.dirname(products_dir) or '.', exist_ok=True)
+        products.to_csv(products_dir, index=False)
+
+    failed = downloader.download(products)
+    for filename, error in failed.items():
+        print(f'Error for {filename}: {error}')
@@ -1,14 +1,36 @@
-import csv 
+import hashlib
+import json
 import os
 from os.path import exists
-import pandas as pd
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None # Cache falls back to pickle without pyarrow
+
+# Catalog columns used downstream {column: dtype}
+CATALOG_COLUMNS = {
+    'iau_name': 'str',
+    'i': 'float64',
+    'porb': 'float64',
+    'porbe': 'float64',
+    'ra': 'float64',
+    'decl': 'float64'
+}
 
 
 class CatalogData(object):
-    def __init__(self, raw_catalog_dir, catalog_dir, porb_dir):
+    def __init__(self, raw_catalog_dir, catalog_dir, porb_dir, resume=False, chunk_size=100000):
         self.raw_catalog_dir = raw_catalog_dir
-        self.catalog_dir = catalog_dir
+        self.catalog_dir = catalog_dir # Cached binary copy of the catalog columns
         self.porb_dir = porb_dir
+        self.resume = resume # True to keep porb_dir from a previous run
+
+        # Rows parsed at a time from the raw query
+        self.chunk_size = chunk_size
+
+        # Cache description, kept next to the cache
+        self.meta_dir = self.catalog_dir + '.meta.json'
 
         # Preprocess files
         self.preprocess()
@@ -17,56 +39,205 @@ class CatalogData(object):
         self.catalog_df = self.create_dataframe()
 
 
-    def commaize(self):
+    def get_positions(self):
+        """
+            Finds the position of every needed column in the raw query's header, taking the first of any
+            duplicated header (e.g. iau_name, re and id appear twice)
+            Parameters:
+                        None
+            Returns:
+                        positions: {position: column}
+        """
+        with open(self.raw_catalog_dir, 'r') as f:
+            header = [column.strip() for column in f.readline().rstrip('\r\n').split('\t')]
+
+        positions = {}
+        for column in CATALOG_COLUMNS:
+            if column not in header:
+                raise KeyError(f'Column {column} is not in {self.raw_catalog_dir}')
+
+            positions[header.index(column)] = column
+
+        return positions
+
+
+    def read_raw(self):
+        """
+            Streams the raw tab separated query in chunks, parsing only the needed columns
+            Parameters:
+                        None
+            Returns:
+                        catalog_df: pandas dataframe of the catalog data
+        """
+        import pandas as pd
+
+        positions = self.get_positions()
+
+        reader = pd.read_csv(self.raw_catalog_dir, sep='\t', header=None, skiprows=1,
+                             usecols=list(positions), dtype={position: CATALOG_COLUMNS[column] for position, column in positions.items()},
+                             chunksize=self.chunk_size)
+
+        chunks = [chunk.rename(columns=positions) for chunk in reader]
+        catalog_df = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=list(CATALOG_COLUMNS))
+
+        # Keep the columns in the usual order
+        return catalog_df[list(CATALOG_COLUMNS)]
+
+
+    def hash_source(self):
+        """
+            Hashes the raw query, to tell if it changed when only its modification time did
+            Parameters:
+                        None
+            Returns:
+                        digest: sha256 hex digest
+        """
+        sha = hashlib.sha256()
+
+        with open(self.raw_catalog_dir, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+
+        return sha.hexdigest()
+
+
+    def describe_source(self):
+        """
+            Describes the raw query and the columns taken from it, as kept next to the cache
+            Parameters:
+                        None
+            Returns:
+                        meta: {source, mtime, size, columns}
+        """
+        stat = os.stat(self.raw_catalog_dir)
+
+        meta = {
+            'source': os.path.abspath(self.raw_catalog_dir),
+            'mtime': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'columns': CATALOG_COLUMNS
+        }
+
+        return meta
+
+
+    def is_cached(self, meta):
+        """
+            Checks if the cache was made from the current raw query, hashing it only if its modification time changed
+            Parameters:
+                        meta: description of the current raw query
+            Returns:
+                        boolean: True if the cache can be used
+        """
+        if not exists(self.catalog_dir) or not exists(self.meta_dir):
+            return False
+
+        try:
+            with open(self.meta_dir, 'r') as f:
+                cached_meta = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if cached_meta.get('columns') != meta['columns'] or cached_meta.get('size') != meta['size']:
+            return False
+
+        if cached_meta.get('mtime') == meta['mtime']:
+            return True
+
+        # Touched but maybe not changed
+        if cached_meta.get('hash') == self.hash_source():
+            self.write_meta(dict(cached_meta, mtime=meta['mtime']))
+            return True
+
+        return False
+
+
+    def write_meta(self, meta):
         """
-            Replaces the spaces in the raw data with commas
-            Parameters: 
+            Atomically writes the cache description
+            Parameters:
+                        meta: cache description
+            Returns:
                         None
+        """
+        tmp_dir = self.meta_dir + '.tmp'
+        with open(tmp_dir, 'w') as f:
+            json.dump(meta, f)
+
+        os.replace(tmp_dir, self.meta_dir)
+
+
+    def save_cache(self, catalog_df, meta):
+        """
+            Atomically writes the catalog as a feather file (or a pickle without pyarrow) and then its description
+            Parameters:
+                        catalog_df: pandas dataframe of the catalog data
+                        meta: description of the raw query
             Returns:
                         None
         """
-        # Open raw file
-        with open(self.raw_catalog_dir, 'r') as csvfile:
-            reader = csv.reader(csvfile, delimiter='\t')
+        cache_format = 'feather' if pyarrow else 'pickle'
+        os.makedirs(os.path.dirname(self.catalog_dir) or '.', exist_ok=True)
+
+        tmp_dir = self.catalog_dir + '.tmp'
+        if cache_format == 'feather':
+            catalog_df.to_feather(tmp_dir)
+        else:
+            catalog_df.to_pickle(tmp_dir, compression=None)
 
-            # Open new file
-            with open(self.catalog_dir, 'w', newline='') as outfile:
-                writer = csv.writer(outfile)
-                
-                # Iterate through each row
-                for row in reader:
-                    # Replace spaces with commas for each element
-                    modified_row = [column.replace(' ', ',') for column in row]
-                    
-                    writer.writerow(modified_row)
+        os.replace(tmp_dir, self.catalog_dir)
+        self.write_meta(dict(meta, format=cache_format, hash=self.hash_source()))
+
+
+    def load_cache(self):
+        """
+            Loads the cached catalog, in the format it was written in
+            Parameters:
+                        None
+            Returns:
+                        catalog_df: pandas dataframe of the catalog data
+        """
+        import pandas as pd
+
+        with open(self.meta_dir, 'r') as f:
+            cache_format = json.load(f).get('format', 'pickle')
+
+        if cache_format == 'feather':
+            return pd.read_feather(self.catalog_dir)
+
+        return pd.read_pickle(self.catalog_dir, compression=None)
 
 
     def preprocess(self):
         """
-            Replaces the spaces in the raw data with commas and removes porb_dir if it already exists
-            Parameters: 
+            Removes porb_dir if it already exists (unless resuming)
+            Parameters:
                         None
             Returns:
                         None
         """
-        # Check if query has already been commaized
-        if not exists(self.catalog_dir):
-            self.commaize()
-        
         # Check if orbital period directory already exists
-        if exists(self.porb_dir):
+        if exists(self.porb_dir) and not self.resume:
             os.remove(self.porb_dir)
 
 
     def create_dataframe(self):
         """
-            Creates a pandas dataframe to store the catalog data
-            Parameters: 
+            Creates a pandas dataframe to store the catalog data, from the cache if the raw query hasn't changed
+            Parameters:
                         None
             Returns:
                         catalog_df: pandas dataframe of the catalog data
         """
-        df = pd.read_csv(self.catalog_dir)
-        catalog_df = df[['iau_name', 'i', 'porb', 'porbe']] 
+        meta = self.describe_source()
+
+        if self.is_cached(meta):
+            try:
+                return self.load_cache()
+            except Exception as e:
+                print(f'Error loading cached catalog {self.catalog_dir}, rebuilding it: {e}')
+
+        catalog_df = self.read_raw()
+        self.save_cache(catalog_df, meta)
 
-        return catalog_df
\ No newline at end of file
+        return catalog_df
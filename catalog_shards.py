@@ -0,0 +1,201 @@
+import argparse
+import glob
+import hashlib
+import os
+from os.path import exists
+import re
+
+from plot_archive import *
+from preload_plots import PreloadPlots
+from results_store import *
+from run_ledger import *
+from star_products import *
+
+# Directory a shard's outputs are written under, next to where the unsharded outputs go
+SHARD_DIR = 'shard-{index}-of-{num_shards}'
+
+
+def parse_shard(text):
+    """
+        Parses a shard given on the command line
+        Parameters:
+                    text: shard as 'i/N', numbered from 1 to N
+        Returns:
+                    shard: (index, number of shards)
+    """
+    match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', text)
+    if not match:
+        raise ValueError(f"Shard {text} must be of the form 'i/N'")
+
+    index, num_shards = int(match.group(1)), int(match.group(2))
+    if not 1 <= index <= num_shards:
+        raise ValueError(f'Shard {text} must be between 1/{num_shards} and {num_shards}/{num_shards}')
+
+    return index, num_shards
+
+
+def get_shard(iau_name, num_shards):
+    """
+        Assigns a star to a shard by hashing its name, so every node agrees without sharing any state (unlike hash(),
+        which is salted per process)
+        Parameters:
+                    iau_name: name of the star
+                    num_shards: number of shards
+        Returns:
+                    index: shard of the star, from 1 to num_shards
+    """
+    return int(hashlib.sha1(iau_name.encode()).hexdigest()[:16], 16) % num_shards + 1
+
+
+def select_shard(catalog_df, shard):
+    """
+        Keeps the catalog rows of one shard
+        Parameters:
+                    catalog_df: pandas dataframe of the catalog data
+                    shard: (index, number of shards)
+        Returns:
+                    catalog_df: the shard's rows (keeping the original index)
+    """
+    index, num_shards = shard
+    in_shard = [get_shard(iau_name, num_shards) == index for iau_name in catalog_df['iau_name']]
+
+    return catalog_df[in_shard]
+
+
+def create_shard_dir(path, shard):
+    """
+        Creates a shard's copy of an output path, e.g. 'orbital_periods/results.db' becomes
+        'orbital_periods/shard-2-of-4/results.db', and 'preload/' becomes 'preload/shard-2-of-4/'
+        Parameters:
+                    path: unsharded output path
+                    shard: (index, number of shards)
+        Returns:
+                    shard_dir: path of the shard's output
+    """
+    directory, file = os.path.split(path)
+
+    return os.path.join(directory, SHARD_DIR.format(index=shard[0], num_shards=shard[1]), file)
+
+
+def find_shards(path):
+    """
+        Finds every shard's copy of an output path
+        Parameters:
+                    path: unsharded output path
+        Returns:
+                    shard_dirs: existing shard paths, ordered by number of shards and then index
+    """
+    directory, file = os.path.split(path)
+    shard_dirs = glob.glob(os.path.join(glob.escape(directory), SHARD_DIR.format(index='*', num_shards='*'), file))
+
+    def get_key(shard_dir):
+        index, num_shards = re.search(r'shard-(\d+)-of-(\d+)', shard_dir).groups()
+        return int(num_shards), int(index)
+
+    return sorted((shard_dir for shard_dir in shard_dirs if exists(shard_dir)), key=get_key)
+
+
+class ShardMerger(object):
+    def __init__(self, results_dir, porb_dir, ledger_dir, preload_dir='preload/', metrics_dir=None):
+        # Unsharded outputs the shards are merged into
+        self.results_dir = results_dir
+        self.porb_dir = porb_dir
+        self.ledger_dir = ledger_dir
+        self.preload_dir = preload_dir
+        self.metrics_dir = metrics_dir
+
+        # Preload file names, the same for every shard
+        self.preload_plots = PreloadPlots(False, porb_dir, preload_dir=preload_dir)
+
+
+    def merge_lines(self, merged_dir):
+        """
+            Appends the lines of every shard's copy of a JSON lines file that the merged file doesn't have yet
+            Parameters:
+                        merged_dir: path of the merged file
+            Returns:
+                        num_lines: number of lines appended
+        """
+        shard_dirs = find_shards(merged_dir)
+        if not shard_dirs:
+            return 0
+
+        seen = set()
+        if exists(merged_dir):
+            with open(merged_dir, 'r') as f:
+                seen = set(f)
+
+        num_lines = 0
+        os.makedirs(os.path.dirname(merged_dir) or '.', exist_ok=True)
+        with open(merged_dir, 'a') as merged_file:
+            for shard_dir in shard_dirs:
+                with open(shard_dir, 'r') as f:
+                    for line in f:
+                        # Skip partially written lines and lines already merged
+                        if not line.endswith('\n') or line in seen:
+                            continue
+
+                        merged_file.write(line)
+                        seen.add(line)
+                        num_lines += 1
+
+        return num_lines
+
+
+    def run(self):
+        """
+            Merges every shard's results, ledger, plots, products and logs into the unsharded outputs, keeping one row
+            per star, and writes the merged csvs
+            Parameters:
+                        None
+            Returns:
+                        None
+        """
+        # Results and preload rows, later shards replacing rows of the same TIC
+        results_store = ResultsStore(self.results_dir)
+        for store_dir in find_shards(self.results_dir):
+            num_rows = results_store.merge(store_dir)
+            print(f"Merged {num_rows['results']} results and {num_rows['preload']} preload rows from {store_dir}")
+
+        # Star statuses, keeping the furthest along row of each star
+        ledger = RunLedger(self.ledger_dir)
+        for ledger_dir in find_shards(self.ledger_dir):
+            print(f'Merged {ledger.merge(ledger_dir)} stars from {ledger_dir}')
+
+        # Packed plots and products, keeping the first copy of each
+        for shard_preload_dir in find_shards(self.preload_dir):
+            shard_plots = PreloadPlots(False, None, preload_dir=shard_preload_dir)
+
+            if exists(os.path.join(shard_preload_dir, 'plots.idx')):
+                num_plots = PlotArchive(self.preload_dir).merge(shard_preload_dir)
+                print(f'Merged {num_plots} plots from {shard_preload_dir}')
+
+            if exists(shard_plots.products_dir):
+                num_products = StarProducts(self.preload_plots.products_dir).merge(shard_plots.products_dir)
+                print(f'Merged {num_products} stars of products from {shard_plots.products_dir}')
+
+        # Review decisions, autopilot scores and stage metrics
+        for merged_dir in [self.preload_dir + 'review_session.jsonl', self.preload_dir + 'autopilot.jsonl', self.metrics_dir]:
+            if merged_dir and find_shards(merged_dir):
+                print(f'Merged {self.merge_lines(merged_dir)} lines into {merged_dir}')
+
+        # Write the merged rows out as csvs
+        results_store.export_csv('results', self.porb_dir)
+        if results_store.get_tics('preload'):
+            results_store.export_csv('preload', self.preload_plots.preload_data_dir)
+
+        counts = ', '.join(f'{num_stars} {status}' for status, num_stars in ledger.summary().items())
+        print(f'Merged ledger: {counts}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Merges the outputs of every shard of a run (main.py --shard i/N) into "
+                                                 "one results store, ledger and plot store")
+    parser.add_argument('--results', default='orbital_periods/results.db', help='results store to merge into')
+    parser.add_argument('--porb', default='orbital_periods/periods.csv', help='csv the merged results are written to')
+    parser.add_argument('--ledger', default='orbital_periods/run_ledger.db', help='run ledger to merge into')
+    parser.add_argument('--preload', default='preload/', help='preload directory to merge plots and products into')
+    parser.add_argument('--metrics', default='orbital_periods/metrics.jsonl', help='stage metrics to merge into')
+    args = parser.parse_args()
+
+    ShardMerger(args.results, args.porb, args.ledger, os.path.join(args.preload, ''), args.metrics).run()
@@ -0,0 +1,339 @@
+from astropy.io import fits
+import astropy.units as u
+import hashlib
+import lightkurve as lk
+import numpy as np
+import os
+from os.path import exists
+import pandas as pd
+
+# Columns of a mirror's index, one row per lightcurve file
+INDEX_COLUMNS = ['path', 'tic', 'sector', 'exptime', 'ra', 'dec', 'size', 'mtime']
+
+# Loaded mirror indexes {index_dir: (mtime, index)}, so each process reads an index once
+loaded_indexes = {}
+
+
+class Products(object):
+    def __init__(self, sectors, exptime, loader, tic=None):
+        # Sector and exposure time (seconds) of each product
+        self.sectors = [int(sector) for sector in sectors]
+        self.exptime = u.Quantity(np.asarray(exptime, dtype=float), u.second)
+
+        # Function returning the raw lightcurve of a product, given its index
+        self.loader = loader
+
+        self.tic = tic # TIC number (None if unknown before downloading)
+
+
+    def __len__(self):
+        return len(self.sectors)
+
+
+    def download(self, i):
+        """
+            Gets the raw lightcurve of a product
+            Parameters:
+                        i: index of the product
+            Returns:
+                        lightcurve: lightkurve LightCurve
+        """
+        return self.loader(i)
+
+
+class MastSource(object):
+    def __init__(self, download_dir=None):
+        self.download_dir = download_dir # Where downloads are cached (None for lightkurve's cache)
+
+
+    def search(self, catalog_row):
+        """
+            Searches MAST for the TESS lightcurves of a star
+            Parameters:
+                        catalog_row: row of the catalog dataframe
+            Returns:
+                        products: Products of the search
+        """
+        result = lk.search_lightcurve(catalog_row['iau_name'], mission='TESS')
+
+        return Products(result.table['sequence_number'], result.exptime.value,
+                        lambda i: result[i].download(download_dir=self.download_dir))
+
+
+class MirrorSource(object):
+    def __init__(self, mirror_dir, match_radius=5.0, index_dir=None, update=True):
+        self.mirror_dir = mirror_dir
+
+        # Stars are matched to TIC targets within match_radius (arcseconds) of their catalog position
+        self.match_radius = match_radius
+
+        # Index of every lightcurve file in the mirror, by TIC and sector
+        self.index_dir = index_dir or os.path.join(self.mirror_dir, 'mirror_index.csv')
+        self.index = None
+
+        # Index files added since the last run
+        if update:
+            self.update_index()
+
+
+    def __getstate__(self):
+        # Worker processes load the index from disk rather than receiving a copy with every star
+        state = self.__dict__.copy()
+        state['index'] = None
+
+        return state
+
+
+    def read_header(self, path):
+        """
+            Reads the target, sector, cadence and position of a lightcurve file from its headers
+            Parameters:
+                        path: path of the FITS file
+            Returns:
+                        row: index row of the file (without path, size and mtime)
+        """
+        with fits.open(path, memmap=False, lazy_load_hdus=True) as hdul:
+            primary, lightcurve = hdul[0].header, hdul[1].header
+
+            row = {
+                'tic': int(primary['TICID']),
+                'sector': int(primary['SECTOR']),
+                'exptime': round(float(lightcurve['TIMEDEL']) * 86400, 1),
+                'ra': float(primary['RA_OBJ']),
+                'dec': float(primary['DEC_OBJ'])
+            }
+
+        return row
+
+
+    def update_index(self):
+        """
+            Indexes the lightcurve files added to the mirror since the index was written, and drops removed ones
+            Parameters:
+                        None
+            Returns:
+                        None
+        """
+        index = pd.read_csv(self.index_dir) if exists(self.index_dir) else pd.DataFrame(columns=INDEX_COLUMNS)
+        known = {row.path: (row.size, row.mtime) for row in index.itertuples()}
+
+        added, found = [], set()
+
+        for root, _, files in os.walk(self.mirror_dir):
+            for file in files:
+                if not file.endswith(('lc.fits', 'lc.fits.gz')):
+                    continue
+
+                path = os.path.relpath(os.path.join(root, file), self.mirror_dir)
+                stat = os.stat(os.path.join(root, file))
+                found.add(path)
+
+                # Files already indexed, and not rewritten since
+                if known.get(path) == (stat.st_size, stat.st_mtime_ns):
+                    continue
+
+                try:
+                    row = self.read_header(os.path.join(root, file))
+                except (OSError, KeyError, ValueError, IndexError) as e:
+                    print(f'Error for {path}: {e} \n')
+                    continue
+
+                added.append(dict(row, path=path, size=stat.st_size, mtime=stat.st_mtime_ns))
+
+        unchanged = index['path'].isin(found) & ~index['path'].isin([row['path'] for row in added])
+        changed = bool(added) or not unchanged.all()
+
+        self.index = pd.concat([index[unchanged], pd.DataFrame(added, columns=INDEX_COLUMNS)], ignore_index=True)
+        self.index = self.index.astype({'tic': 'int64', 'sector': 'int64', 'exptime': 'float64', 'ra': 'float64',
+                                        'dec': 'float64', 'size': 'int64', 'mtime': 'int64'})
+
+        if changed or not exists(self.index_dir):
+            tmp_dir = self.index_dir + '.tmp'
+            self.index.to_csv(tmp_dir, index=False)
+            os.replace(tmp_dir, self.index_dir)
+
+        if added:
+            print(f'Indexed {len(added)} new lightcurve files in {self.mirror_dir} ({len(self.index)} in total)')
+
+
+    def get_index(self):
+        """
+            Gets the mirror's index, loading it once per process
+            Parameters:
+                        None
+            Returns:
+                        index: pandas dataframe of INDEX_COLUMNS
+        """
+        if self.index is not None:
+            return self.index
+
+        mtime = os.stat(self.index_dir).st_mtime_ns
+        if self.index_dir not in loaded_indexes or loaded_indexes[self.index_dir][0] != mtime:
+            loaded_indexes[self.index_dir] = (mtime, pd.read_csv(self.index_dir))
+
+        self.index = loaded_indexes[self.index_dir][1]
+
+        return self.index
+
+
+    def match_tic(self, catalog_row):
+        """
+            Finds the TIC target of a star, the nearest to its catalog position within the match radius
+            Parameters:
+                        catalog_row: row of the catalog dataframe (with a 'tic' to skip the match)
+            Returns:
+                        tic: TIC number (None if no target is close enough)
+        """
+        if 'tic' in catalog_row and pd.notna(catalog_row['tic']):
+            return int(catalog_row['tic'])
+
+        targets = self.get_index().drop_duplicates('tic')
+        if targets.empty:
+            return None
+
+        # Haversine separation to every target
+        ra, dec = np.radians(float(catalog_row['ra'])), np.radians(float(catalog_row['decl']))
+        target_ra, target_dec = np.radians(targets['ra'].to_numpy()), np.radians(targets['dec'].to_numpy())
+
+        a = np.sin((target_dec - dec) / 2) ** 2 + np.cos(dec) * np.cos(target_dec) * np.sin((target_ra - ra) / 2) ** 2
+        separation = np.degrees(2 * np.arcsin(np.sqrt(np.clip(a, 0, 1)))) * 3600
+
+        nearest = int(np.argmin(separation))
+        if separation[nearest] > self.match_radius:
+            return None
+
+        return int(targets['tic'].iloc[nearest])
+
+
+    def search(self, catalog_row):
+        """
+            Finds the lightcurve files of a star in the mirror
+            Parameters:
+                        catalog_row: row of the catalog dataframe
+            Returns:
+                        products: Products in the mirror (empty if the star has none)
+        """
+        tic = self.match_tic(catalog_row)
+
+        index = self.get_index()
+        files = index[index['tic'] == tic].sort_values(['sector', 'exptime']) if tic is not None else index.iloc[:0]
+        paths = [os.path.join(self.mirror_dir, path) for path in files['path']]
+
+        return Products(files['sector'], files['exptime'], lambda i: lk.read(paths[i]), tic)
+
+
+class FixtureSource(object):
+    def __init__(self, lightcurves=None, cadence=120, num_sectors=1, seed=0):
+        # Lightcurves of each star {iau_name: [LightCurve, ...]}, each with TICID and SECTOR in its meta (None to
+        # create a synthetic lightcurve for every star instead)
+        self.lightcurves = lightcurves
+
+        # Synthetic lightcurves, one product covering num_sectors sectors at the cadence (seconds)
+        self.cadence = cadence
+        self.num_sectors = num_sectors
+        self.seed = seed
+
+        # Made at the first synthetic star, in whichever process searches
+        self.generator = None
+
+
+    def __getstate__(self):
+        # Worker processes make their own generator
+        state = self.__dict__.copy()
+        state['generator'] = None
+
+        return state
+
+
+    def get_exptime(self, lightcurve):
+        """
+            Gets the exposure time of a lightcurve, from its meta or else its median time step
+            Parameters:
+                        lightcurve: lightkurve LightCurve
+            Returns:
+                        exptime: exposure time (seconds)
+        """
+        if 'EXPTIME' in lightcurve.meta:
+            return float(lightcurve.meta['EXPTIME'])
+
+        return round(float(np.median(np.diff(lightcurve.time.value))) * 86400, 1)
+
+
+    def get_tic(self, catalog_row):
+        """
+            Gets the number of a synthetic star, seeding its lightcurve
+            Parameters:
+                        catalog_row: row of the catalog dataframe (with a 'tic' to use it)
+            Returns:
+                        tic: the row's tic, or else a number hashed from the star's name (the same in every process)
+        """
+        if 'tic' in catalog_row and pd.notna(catalog_row['tic']):
+            return int(catalog_row['tic'])
+
+        return int(hashlib.sha1(catalog_row['iau_name'].encode()).hexdigest()[:8], 16)
+
+
+    def create_lightcurve(self, tic):
+        """
+            Creates the reproducible synthetic lightcurve of a star, gaps removed
+            Parameters:
+                        tic: number of the star, seeding its lightcurve
+            Returns:
+                        lightcurve: lightkurve LightCurve
+        """
+        from synthetic_lightcurves import SyntheticLightcurves
+
+        if self.generator is None:
+            self.generator = SyntheticLightcurves(self.cadence, self.num_sectors, self.seed)
+
+        flux, _, parameters = self.generator.create_batch(tic, 1)
+        finite = np.isfinite(flux[0])
+        flux_err = np.full(finite.sum(), np.hypot(parameters['white_noise'][0], parameters['red_noise'][0]))
+
+        return lk.LightCurve(time=self.generator.time[finite], flux=flux[0][finite], flux_err=flux_err,
+                             meta={'TICID': tic, 'SECTOR': 1, 'EXPTIME': self.cadence})
+
+
+    def search(self, catalog_row):
+        """
+            Finds the fixture lightcurves of a star
+            Parameters:
+                        catalog_row: row of the catalog dataframe
+            Returns:
+                        products: Products of the fixture (empty if the star has none), or one synthetic product
+                                  covering every sector, created when it's downloaded
+        """
+        if self.lightcurves is None:
+            tic = self.get_tic(catalog_row)
+
+            return Products([1], [self.cadence], lambda i: self.create_lightcurve(tic), tic)
+
+        lightcurves = self.lightcurves.get(catalog_row['iau_name'], [])
+
+        return Products([lightcurve.meta.get('SECTOR', i) for i, lightcurve in enumerate(lightcurves)],
+                        [self.get_exptime(lightcurve) for lightcurve in lightcurves],
+                        lambda i: lightcurves[i].copy())
+
+
+def create_source(data_source='mast', mirror_dir=None, cadence=120, **source_settings):
+    """
+        Creates the lightcurve source named in the configuration
+        Parameters:
+                    data_source: 'mast' to search and download live, 'mirror' to read a local directory of FITS files,
+                                 or 'fixture' for reproducible synthetic lightcurves with no network
+                    mirror_dir: directory of the mirror, for 'mirror'
+                    cadence: cadence of the synthetic lightcurves in seconds, for 'fixture'
+                    source_settings: keyword arguments of the source
+        Returns:
+                    source: MastSource, MirrorSource or FixtureSource
+    """
+    if data_source == 'mast':
+        return MastSource(**source_settings)
+
+    if data_source == 'mirror':
+        return MirrorSource(mirror_dir, **source_settings)
+
+    if data_source == 'fixture':
+        return FixtureSource(cadence=cadence, **source_settings)
+
+    raise ValueError(f"Unknown data_source {data_source}, use 'mast', 'mirror' or 'fixture'")
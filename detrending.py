@@ -0,0 +1,290 @@
+from astropy.time import Time
+import hashlib
+import json
+import lightkurve as lk
+import numpy as np
+import os
+from os.path import exists
+
+
+class Detrender(object):
+    def __init__(self, window=None, method='median', clip_sigma=5.0, centers_per_window=10, min_coverage=0.25,
+                 biweight_c=5.0, cache_dir=None):
+        # Days of the running statistic each sector is divided by (None to only normalize by the sector median),
+        # periods much shorter than the window pass through while longer trends are removed
+        self.window = window
+        self.method = method # 'median' or 'biweight'
+
+        # Points further than clip_sigma standard deviations from the median are removed, iterating as
+        # remove_outliers does (None to keep all)
+        self.clip_sigma = clip_sigma
+
+        # The running statistic is evaluated at centers_per_window points per window and interpolated between,
+        # ignoring windows less than min_coverage full
+        self.centers_per_window = centers_per_window
+        self.min_coverage = min_coverage
+
+        # Tuning constant of the biweight, in median absolute deviations
+        self.biweight_c = biweight_c
+
+        # Directory processed sectors are kept in, so reruns skip reading and processing them (None to not keep them)
+        self.cache_dir = cache_dir
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+
+    def get_settings(self):
+        """
+            Gets the settings that change a processed sector, identifying its cached copy
+            Parameters:
+                        None
+            Returns:
+                        settings: dictionary of settings
+        """
+        # Format of processed sectors (clip and normalize order, kept meta), so sectors cached before it changed are
+        # processed again
+        return {'version': 3, 'window': self.window, 'method': self.method, 'clip_sigma': self.clip_sigma,
+                'centers_per_window': self.centers_per_window, 'min_coverage': self.min_coverage, 'biweight_c': self.biweight_c}
+
+
+    def create_dir(self, name, sector, exptime):
+        """
+            Creates the path of a processed sector in the cache
+            Parameters:
+                        name: catalog name of the star
+                        sector: TESS sector
+                        exptime: exposure time of the product (seconds)
+            Returns:
+                        path: path of the npz file
+        """
+        settings = hashlib.sha1(json.dumps(self.get_settings(), sort_keys=True).encode()).hexdigest()[:10]
+
+        return os.path.join(self.cache_dir, f'{name}-s{int(sector):04d}-{float(exptime):g}-{settings}.npz')
+
+
+    def grid(self, time):
+        """
+            Places time onto a regular cadence grid, so windows are a fixed number of grid points across gaps. Repeated
+            timestamps share a grid position, and don't count towards the spacing
+            Parameters:
+                        time: sorted time data (days)
+            Returns:
+                        positions: grid position of each point
+                        num_positions: length of the grid
+                        step: grid spacing (days)
+        """
+        steps = np.diff(time)
+        steps = steps[steps > 0]
+        if not len(steps):
+            raise ValueError(f'Cannot detrend {len(time)} points that all share one timestamp')
+
+        step = np.median(steps)
+        positions = np.round((time - time[0]) / step).astype(np.int64)
+
+        return positions, int(positions[-1]) + 1, step
+
+
+    def window_statistic(self, windows):
+        """
+            Calculates the robust location of every window at once
+            Parameters:
+                        windows: (windows, points) flux, NaN where the grid has no data
+            Returns:
+                        location: median or biweight location of each window (NaN for windows with too little data)
+        """
+        coverage = np.isfinite(windows).mean(axis=1)
+        location = np.full(len(windows), np.nan)
+
+        full = coverage >= self.min_coverage
+        if not full.any():
+            return location
+
+        windows = windows[full]
+        median = np.nanmedian(windows, axis=1)
+
+        if self.method == 'biweight':
+            deviation = windows - median[:, None]
+            mad = np.nanmedian(np.abs(deviation), axis=1)
+            scaled = deviation / (self.biweight_c * np.where(mad > 0, mad, np.inf))[:, None]
+
+            weights = np.where(np.abs(scaled) < 1, (1 - scaled ** 2) ** 2, 0.0)
+            weights[~np.isfinite(windows)] = 0.0
+            deviation = np.nan_to_num(deviation)
+
+            median = median + (weights * deviation).sum(axis=1) / np.maximum(weights.sum(axis=1), 1e-12)
+
+        location[full] = median
+
+        return location
+
+
+    def trend(self, time, flux):
+        """
+            Calculates the running median (or biweight) of a sector with strided windows on its cadence grid,
+            interpolated between the window centers
+            Parameters:
+                        time: time data of the sector (days)
+                        flux: flux data of the sector
+            Returns:
+                        trend: trend at each point
+        """
+        if not self.window or len(time) < 3:
+            return np.full(len(flux), np.nanmedian(flux))
+
+        positions, num_positions, step = self.grid(time)
+        width = max(3, int(round(self.window / step)) | 1)
+        stride = max(1, width // self.centers_per_window)
+
+        # Gaps are NaN, and half a window of NaN pads each end
+        gridded = np.full(num_positions + width - 1, np.nan)
+        gridded[positions + width // 2] = flux
+
+        windows = np.lib.stride_tricks.sliding_window_view(gridded, width)[::stride]
+        centers = np.arange(0, num_positions, stride)[:len(windows)]
+        location = self.window_statistic(windows)
+
+        finite = np.isfinite(location)
+        if not finite.any():
+            return np.full(len(flux), np.nanmedian(flux))
+
+        return np.interp(positions, centers[finite], location[finite])
+
+
+    def clip(self, flux):
+        """
+            Finds the points within clip_sigma standard deviations of the median, repeating on the kept points until
+            none change (at most 5 times), as remove_outliers does
+            Parameters:
+                        flux: flux data
+            Returns:
+                        kept: True for points that are kept
+        """
+        if not self.clip_sigma:
+            return np.ones(len(flux), dtype=bool)
+
+        # Clipped on the standard deviation, since a robust scale would clip deep eclipses
+        remaining = flux
+        for _ in range(5):
+            median, std = np.median(remaining), np.std(remaining)
+            lower, upper = median - self.clip_sigma * std, median + self.clip_sigma * std
+
+            within = (remaining >= lower) & (remaining <= upper)
+            if within.all():
+                break
+
+            remaining = remaining[within]
+
+        return (flux >= lower) & (flux <= upper)
+
+
+    def process(self, time, flux, flux_err):
+        """
+            Removes NaNs, sigma clips a sector and divides it by its median, centering it on 0, in the same order as
+            remove_nans().remove_outliers().normalize() - 1. With a window the sector is divided by its trend before
+            clipping instead, as the trend would otherwise dominate the scatter
+            Parameters:
+                        time: time data of the sector (days)
+                        flux: flux data of the sector
+                        flux_err: flux error data of the sector
+            Returns:
+                        time: kept time data
+                        flux: detrended flux, about 0
+                        flux_err: flux error relative to the trend
+        """
+        time, flux, flux_err = (np.ascontiguousarray(array, dtype=float) for array in (time, flux, flux_err))
+
+        finite = np.isfinite(time) & np.isfinite(flux)
+        time, flux, flux_err = time[finite], flux[finite], flux_err[finite]
+
+        if not len(time):
+            return time, flux, flux_err
+
+        if not self.window:
+            kept = self.clip(flux)
+            time, flux, flux_err = time[kept], flux[kept], flux_err[kept]
+
+            median = np.median(flux)
+            return time, flux / median - 1, flux_err / median
+
+        trend = self.trend(time, flux)
+        flux, flux_err = flux / trend - 1, flux_err / np.abs(trend)
+
+        kept = self.clip(flux)
+
+        return time[kept], flux[kept], flux_err[kept]
+
+
+    def process_lightcurve(self, lightcurve):
+        """
+            Processes a downloaded sector into a lightcurve about 0
+            Parameters:
+                        lightcurve: lightkurve LightCurve of one sector
+            Returns:
+                        lightcurve: processed lightkurve LightCurve
+        """
+        lightcurve = lightcurve.remove_nans()
+        time, flux, flux_err = self.process(lightcurve.time.value, np.asarray(lightcurve.flux.value, dtype=float),
+                                            np.asarray(lightcurve.flux_err.value, dtype=float))
+
+        return lk.LightCurve(time=Time(time, format=lightcurve.time.format, scale=lightcurve.time.scale), flux=flux,
+                             flux_err=flux_err, meta=self.create_meta(lightcurve.meta))
+
+
+    def create_meta(self, meta):
+        """
+            Creates the meta of a processed sector: the sector's own header values that can be cached, marked normalized
+            as normalize() does, so cached and freshly processed sectors carry the same meta
+            Parameters:
+                        meta: meta of the downloaded sector
+            Returns:
+                        meta: dictionary of strings, numbers, booleans and None
+        """
+        kept = {}
+        for key, value in meta.items():
+            value = value.item() if isinstance(value, np.generic) else value
+            if value is None or isinstance(value, (str, bool, int, float)):
+                kept[str(key)] = value
+
+        kept['NORMALIZED'] = True
+
+        return kept
+
+
+    def load(self, name, sector, exptime):
+        """
+            Loads a processed sector from the cache
+            Parameters:
+                        name: catalog name of the star
+                        sector: TESS sector
+                        exptime: exposure time of the product (seconds)
+            Returns:
+                        lightcurve: processed lightkurve LightCurve (None if not cached)
+        """
+        if not self.cache_dir or not exists(self.create_dir(name, sector, exptime)):
+            return None
+
+        with np.load(self.create_dir(name, sector, exptime)) as stored:
+            return lk.LightCurve(time=Time(stored['time'], format=str(stored['time_format']), scale=str(stored['time_scale'])),
+                                 flux=stored['flux'], flux_err=stored['flux_err'], meta=json.loads(str(stored['meta'])))
+
+
+    def save(self, name, sector, exptime, lightcurve):
+        """
+            Atomically keeps a processed sector in the cache
+            Parameters:
+                        name: catalog name of the star
+                        sector: TESS sector
+                        exptime: exposure time of the product (seconds)
+                        lightcurve: processed lightkurve LightCurve
+            Returns:
+                        None
+        """
+        if not self.cache_dir:
+            return
+
+        path = self.create_dir(name, sector, exptime)
+        tmp_dir = path + '.tmp.npz'
+        np.savez(tmp_dir, time=lightcurve.time.value, time_format=lightcurve.time.format, time_scale=lightcurve.time.scale,
+                 flux=np.asarray(lightcurve.flux.value), flux_err=np.asarray(lightcurve.flux_err.value),
+                 meta=json.dumps(dict(lightcurve.meta)))
+        os.replace(tmp_dir, path)
@@ -6,8 +6,47 @@ import numpy as np
 import seaborn as sns
 import sys
 
+# stella (and its deep learning backend) is imported at first use, from here or the parent directory
 sys.path.insert(0, '../')
-import stella
+
+from stage_metrics import timed
+
+# Stella network of this process, created once rather than for every star
+stella_cnn = None
+
+
+@timed('stella')
+def predict_flares(time, flux, flux_err, residuals):
+    """
+        Runs stella on the residuals and on the lightcurve flux
+        Parameters:
+                    time: time data (days)
+                    flux: flux data, about 0
+                    flux_err: flux error data
+                    residuals: flux minus the fitted sine wave
+        Returns:
+                    flare_predictions: {'residuals': (time, flux, probability), 'flux': (time, flux, probability)}
+    """
+    global stella_cnn
+    import stella
+
+    # Stella
+    OUT_DIR = 'stella_results'
+    if stella_cnn is None:
+        stella_cnn = stella.ConvNN(output_dir = OUT_DIR) 
+    cnn = stella_cnn
+
+    # Find flares on the residuals and on the flux data
+    flare_predictions = {}
+    for key, fluxes in (('residuals', residuals), ('flux', flux)):
+        cnn.predict(modelname='stella_results/ensemble_s0002_i0325_b0.73.h5', # change to results name
+            times = time, 
+            fluxes = fluxes + 1, 
+            errs = flux_err)
+
+        flare_predictions[key] = (cnn.predict_time[0], cnn.predict_flux[0], cnn.predictions[0])
+
+    return flare_predictions
 
 
 class ExoplanetEffects(object):
@@ -22,15 +61,23 @@ class ExoplanetEffects(object):
         # List of effects found in the lightcurve data
         self.effects_found = [] # [Eclipsing, Doppler beaming, Flares, Irradiation, Ellipsodial]
 
-        # Iterate through all effects
-        for effect in self.effects:
-            self.effects_plots(effect)
+        # Stella flare probabilities of the residuals and the lightcurve
+        self.flare_predictions = {} # {'residuals': (time, flux, probability), 'flux': (time, flux, probability)}
+
+        # Products are rendered at review, so only the flares need predicting
+        if preload_plots.preload and preload_plots.products:
+            self.predict_flares()
 
-            # Either save or show plot depending on preload
-            if preload_plots.preload:
-                preload_plots.save_plot(effect, lightcurve_data.name)
-            else:
-                plt.show()
+        else:
+            # Iterate through all effects
+            for effect in self.effects:
+                self.effects_plots(effect)
+
+                # Either save or show plot depending on preload
+                if preload_plots.preload:
+                    preload_plots.save_plot(effect, lightcurve_data.name)
+                else:
+                    plt.show()
         
         # Check for irradiation and ellipsodial
         self.irradiation_ellipsodial_check()
@@ -116,6 +163,21 @@ class ExoplanetEffects(object):
         ax.legend()
 
 
+    def predict_flares(self):
+        """
+            Runs stella on the residuals and on the lightcurve flux, storing the flare probabilities
+            Parameters:
+                        None
+            Returns:
+                        None
+        """
+        # Calculate residuals
+        residuals = self.lightcurve_data.flux - self.orb_calculator.sine_fit.best_fit
+
+        self.flare_predictions = predict_flares(self.lightcurve_data.time, self.lightcurve_data.flux, 
+                                                self.lightcurve_data.flux_err, residuals)
+
+
     def stella_flares_plot(self, fig):
         """
 
@@ -129,40 +191,26 @@ class ExoplanetEffects(object):
         ax2 = fig.add_subplot(gs[1, 0])
         plt.subplots_adjust(hspace=0.5)
 
-        # Stella
-        OUT_DIR = 'stella_results'
-        cnn = stella.ConvNN(output_dir = OUT_DIR) 
-
-        # Calculate residuals
-        residuals = self.lightcurve_data.flux - self.orb_calculator.sine_fit.best_fit
-
-        # Find flares on the residuals
-        cnn.predict(modelname='stella_results/ensemble_s0002_i0325_b0.73.h5', # change to results name
-            times = self.lightcurve_data.time, 
-            fluxes = residuals + 1, 
-            errs = self.lightcurve_data.flux_err)     
+        # Find flares with stella
+        self.predict_flares()
         
         # Use the Seaborn "flare" colormap
         flare_cmap = sns.color_palette("flare", as_cmap=True)
 
         # Plot residuals
-        ax1.scatter(cnn.predict_time[0], cnn.predict_flux[0],
-                    c=cnn.predictions[0], vmin=0, vmax=1, s=10, cmap=flare_cmap)
+        predict_time, predict_flux, predictions = self.flare_predictions['residuals']
+        ax1.scatter(predict_time, predict_flux,
+                    c=predictions, vmin=0, vmax=1, s=10, cmap=flare_cmap)
         
         # Residual plot info
         ax1.set_title('Flux - Fitted Sine Wave', fontsize=12)
         ax1.set_xlabel('Time (days)', fontsize=10)
         ax1.set_ylabel('Normalized Flux', fontsize=10)
 
-        # Find flares of the flux data
-        cnn.predict(modelname='stella_results/ensemble_s0002_i0325_b0.73.h5', # change to results name
-            times = self.lightcurve_data.time, 
-            fluxes = self.lightcurve_data.flux + 1, 
-            errs = self.lightcurve_data.flux_err) 
-
         # Plot flux
-        ax2.scatter(cnn.predict_time[0], cnn.predict_flux[0],
-                    c=cnn.predictions[0], vmin=0, vmax=1, s=10, cmap=flare_cmap)
+        predict_time, predict_flux, predictions = self.flare_predictions['flux']
+        ax2.scatter(predict_time, predict_flux,
+                    c=predictions, vmin=0, vmax=1, s=10, cmap=flare_cmap)
         
         # Residual plot info
         ax2.set_title('Lightcurve', fontsize=12)
@@ -202,6 +250,7 @@ class ExoplanetEffects(object):
         self.orb_calculator.plot_residuals(ax2)
 
 
+    @timed('effects_figure')
     def effects_plots(self, effect):
         """
             Presents an effects plot depending on the given effect
@@ -1,15 +1,22 @@
+import os
 from os.path import exists
 
 
 class InputCheck(object):
     def __init__(self, raw_catalog_dir, catalog_dir, 
-                 porb_dir, preload, autopilot):
+                 porb_dir, preload, autopilot, resume=True, autopilot_model_dir=None, data_source='mast',
+                 mirror_dir=None, review_only=False):
 
         self.raw_catalog_dir = raw_catalog_dir
         self.catalog_dir = catalog_dir
         self.porb_dir = porb_dir
         self.preload = preload
         self.autopilot = autopilot
+        self.resume = resume
+        self.autopilot_model_dir = autopilot_model_dir
+        self.data_source = data_source
+        self.mirror_dir = mirror_dir
+        self.review_only = review_only
 
         # Check files
         self.check_files()
@@ -39,6 +46,15 @@ class InputCheck(object):
         # Check values
         if not exists(self.raw_catalog_dir):
             raise FileNotFoundError(f"The file for raw_catalog_dir: {self.raw_catalog_dir} does not exist")
+
+        if self.autopilot and not exists(self.autopilot_model_dir or ''):
+            raise FileNotFoundError(f"The file for autopilot_model_dir: {self.autopilot_model_dir} does not exist, train one with Autopilot.train()")
+
+        if self.data_source not in ['mast', 'mirror', 'fixture']:
+            raise ValueError(f"Variable data_source must be 'mast', 'mirror' or 'fixture'")
+
+        if self.data_source == 'mirror' and not os.path.isdir(self.mirror_dir or ''):
+            raise FileNotFoundError(f"The directory for mirror_dir: {self.mirror_dir} does not exist")
         
     
     def check_booleans(self):
@@ -55,3 +71,9 @@ class InputCheck(object):
         
         if not isinstance(self.autopilot, bool):
             raise TypeError(f"Variable autopilot must be of type 'bool'")
+
+        if not isinstance(self.resume, bool):
+            raise TypeError(f"Variable resume must be of type 'bool'")
+
+        if not isinstance(self.review_only, bool):
+            raise TypeError(f"Variable review_only must be of type 'bool'")
@@ -1,15 +1,77 @@
+from astropy.time import Time
 import astropy.units as u
 import lightkurve as lk
+from lightkurve.periodogram import Periodogram
+import numpy as np
+
+from data_sources import *
+from detrending import *
+from period_consensus import *
+from period_uncertainty import *
+from stage_metrics import stage, timed
+from streaming_periodogram import *
 
 
 class LightcurveData(object):
-    def __init__(self, catalog_row, cadence):
+    def __init__(self, catalog_row, cadence, multi_cadence=False, ffi_weight=0.25, periodogram_cache=None, refresh=False,
+                 periodogram_memory=None, data_source=None, bootstrap_samples=200, detrender=None,
+                 consensus_candidates=5):
         self.catalog_row = catalog_row
         self.cadence = cadence
 
+        # Where lightcurves are searched for and read from (None searches and downloads from MAST)
+        self.data_source = data_source or MastSource()
+
+        # Residual resamples the period and amplitude uncertainties are bootstrapped from (0 to skip them)
+        self.bootstrap_samples = bootstrap_samples
+
+        # Candidate periods ranked by the agreement of Lomb-Scargle, phase dispersion minimization and the
+        # autocorrelation (0 to skip them)
+        self.consensus_candidates = consensus_candidates
+
+        # Normalizes, detrends and clips each sector (None only normalizes and clips)
+        self.detrender = detrender or Detrender()
+
+        # Store of per sector periodogram sums (None to compute the periodogram from scratch), and whether to 
+        # skip stars whose sectors all have stored sums
+        self.periodogram_cache = periodogram_cache
+        self.refresh = refresh
+
+        # Memory in MB to compute the periodogram in, in blocks (None for lightkurve's periodogram)
+        self.periodogram_memory = periodogram_memory
+
+        # Weight of each lightcurve point (None if all are equal)
+        self.weights = None
+
+        # Multi cadence mode, where faster products are rebinned to the cadence and slower (FFI) products are 
+        # kept with ffi_weight times the weight of the rest
+        self.multi_cadence = multi_cadence
+        self.ffi_weight = ffi_weight
+
+        # Coarsest cadence in the lightcurve, setting the periodogram's minimum period
+        self.coarsest_cadence = cadence
+
+        # Sector and cadence of every product in the lightcurve
+        self.contributions = []
+
+        # Data of each sector {sector: (time, flux, weights)}, for the periodogram cache
+        self.segments = {}
+
+        # True if refreshing and no sector was added since the star's periodogram was stored
+        self.unchanged = False
+
+        # Error of the lightcurve search (None if there was none)
+        self.error = None
+
+        # Number of sectors at the desired cadence (None if the search failed)
+        self.sectors = None
+
         # Get lightcurve data
         self.lightcurve, self.name, self.imag, self.lit_period = self.get_lightcurve()
 
+        # Check if there was a lightcurve of the desired cadence
+        if not self.lightcurve: return
+
         # Lightcurve data
         self.time = self.lightcurve.time.value
         self.flux = self.lightcurve.flux.value
@@ -21,13 +83,48 @@ class LightcurveData(object):
         # Get period at max power
         self.period_at_max_power = self.get_period_at_max_power()
 
+        # Get the uncertainties of the period and of its amplitude
+        self.period_error, self.amplitude, self.amplitude_error = self.get_uncertainties()
+
+        # Get the candidate periods the methods agree on
+        self.period_candidates = self.get_period_candidates()
+        self.consensus_period = self.period_candidates[0]['period'] if self.period_candidates else np.nan
+        self.consensus_score = self.period_candidates[0]['score'] if self.period_candidates else np.nan
+
+
+    def download_product(self, result, i):
+        """
+            Downloads one product and cleans it (NaNs and outliers removed, detrended and normalized about 0), or
+            loads it already cleaned from the detrender's cache
+            Parameters:
+                        result: Products found by the data source
+                        i: index of the product
+            Returns:
+                        lightcurve: cleaned lightcurve
+        """
+        sector, exptime = result.sectors[i], result.exptime[i].value
+
+        lightcurve = self.detrender.load(self.catalog_row['iau_name'], sector, exptime)
+        if lightcurve is not None:
+            return lightcurve
+
+        with stage('download'):
+            lightcurve = result.download(i)
+
+        with stage('detrend'):
+            lightcurve = self.detrender.process_lightcurve(lightcurve)
+
+        self.detrender.save(self.catalog_row['iau_name'], sector, exptime, lightcurve)
+
+        return lightcurve
+
 
     def append_lightcurves(self, result, result_exposures):
         """
             Appends lightcurves of the wanted cadence together
             Parameters: 
-                        result: Lightkurve query result
-                        result_exposures: Lightkurve query result exposures
+                        result: Products found by the data source
+                        result_exposures: exposure times of the products
             Returns:
                         combined_lightcurve: appended lightcurves 
                         (None if none of the query results are of the desired cadence)
@@ -38,9 +135,15 @@ class LightcurveData(object):
         for i, exposure in enumerate(result_exposures):
             # Check to see if exposure matches cadence 
             if exposure.value == self.cadence:
-                lightcurve = result[i].download().remove_nans().remove_outliers().normalize() - 1
+                lightcurve = self.download_product(result, i)
                 all_lightcurves.append(lightcurve)
+
+                time = np.asarray(lightcurve.time.value, dtype=float)
+                flux = np.asarray(lightcurve.flux.value, dtype=float)
+                self.add_segment(result.sectors[i], time, flux, np.ones_like(time))
         
+        self.sectors = len(all_lightcurves)
+
         # Check if there are lightcurves
         if all_lightcurves:
             combined_lightcurve = all_lightcurves[0]
@@ -53,6 +156,184 @@ class LightcurveData(object):
         return combined_lightcurve  
 
 
+    def rebin(self, time, flux, flux_err, bin_size):
+        """
+            Rebins a lightcurve onto a grid of a given bin size with an inverse variance weighted mean
+            Parameters:
+                        time: time data of the lightcurve (days)
+                        flux: flux data of the lightcurve
+                        flux_err: flux error data of the lightcurve
+                        bin_size: size of each bin (days)
+            Returns:
+                        binned_time: mean time of each filled bin
+                        binned_flux: weighted mean flux of each filled bin
+                        binned_flux_err: error of the weighted mean of each filled bin
+        """
+        bins = np.floor((time - time[0]) / bin_size).astype(np.int64)
+
+        # Points without a usable error count with the median weight
+        weights = 1 / flux_err ** 2
+        bad = ~np.isfinite(weights)
+        weights[bad] = np.median(weights[~bad]) if (~bad).any() else 1.0
+
+        counts = np.bincount(bins)
+        sum_weights = np.bincount(bins, weights)
+        filled = counts > 0
+
+        binned_time = np.bincount(bins, time)[filled] / counts[filled]
+        binned_flux = np.bincount(bins, weights * flux)[filled] / sum_weights[filled]
+        binned_flux_err = 1 / np.sqrt(sum_weights[filled])
+
+        return binned_time, binned_flux, binned_flux_err
+
+
+    def choose_products(self, result, result_exposures):
+        """
+            Chooses one product per sector for multi cadence mode, preferring the desired cadence, then faster
+            cadences (to be rebinned), then the fastest slower (FFI) cadence
+            Parameters:
+                        result: Products found by the data source
+                        result_exposures: exposure times of the products
+            Returns:
+                        chosen: list of (result index, sector, exposure in seconds)
+        """
+        best = {}
+        for i, exposure in enumerate(result_exposures):
+            exptime = float(exposure.value)
+            sector = result.sectors[i]
+
+            # Rank by desired cadence first, then faster, then slower, each closest to the cadence
+            rank = (0 if exptime == self.cadence else 1 if exptime < self.cadence else 2, abs(exptime - self.cadence))
+
+            if sector not in best or rank < best[sector][0]:
+                best[sector] = (rank, i, exptime)
+
+        chosen = [(i, sector, exptime) for sector, (_, i, exptime) in sorted(best.items())]
+
+        return chosen
+
+
+    def combine_cadences(self, result, result_exposures):
+        """
+            Combines the products of every cadence into one lightcurve, rebinning faster products to the cadence
+            and down weighting slower (FFI) products
+            Parameters:
+                        result: Products found by the data source
+                        result_exposures: exposure times of the products
+            Returns:
+                        combined_lightcurve: combined lightcurve (None if no product could be used)
+        """
+        times, fluxes, flux_errs = [], [], []
+        first_lightcurve = None
+
+        for i, sector, exptime in self.choose_products(result, result_exposures):
+            try:
+                lightcurve = self.download_product(result, i)
+            except Exception as e:
+                print(f"Error for {self.catalog_row['iau_name']} sector {sector} ({exptime:g} s): {e} \n")
+                continue
+
+            if len(lightcurve) == 0:
+                continue
+
+            if first_lightcurve is None:
+                first_lightcurve = lightcurve
+
+            time = np.asarray(lightcurve.time.value, dtype=float)
+            flux = np.asarray(lightcurve.flux.value, dtype=float)
+            flux_err = np.asarray(lightcurve.flux_err.value, dtype=float)
+            weight = 1.0
+
+            # Rebin faster products to the cadence
+            if exptime < self.cadence:
+                time, flux, flux_err = self.rebin(time, flux, flux_err, (self.cadence * u.second).to(u.day).value)
+
+            # Keep slower products as a lower weight supplement
+            elif exptime > self.cadence:
+                weight = self.ffi_weight
+                flux_err = flux_err / np.sqrt(weight)
+
+            times.append(time)
+            fluxes.append(flux)
+            flux_errs.append(flux_err)
+            self.add_segment(sector, time, flux, np.full_like(time, weight))
+            self.contributions.append({'sector': sector, 'cadence': exptime, 'points': len(time), 
+                                       'rebinned': exptime < self.cadence, 'weight': weight})
+
+        self.sectors = len(self.contributions)
+
+        if not self.contributions:
+            return None
+
+        self.coarsest_cadence = max(max(contribution['cadence'], self.cadence) for contribution in self.contributions)
+
+        # One time ordered lightcurve
+        time = np.concatenate(times)
+        order = np.argsort(time, kind='stable')
+
+        self.weights = np.concatenate([np.full(len(time), contribution['weight']) 
+                                       for time, contribution in zip(times, self.contributions)])[order]
+
+        combined_lightcurve = lk.LightCurve(time=Time(time[order], format=first_lightcurve.time.format, scale=first_lightcurve.time.scale),
+                                            flux=np.concatenate(fluxes)[order], flux_err=np.concatenate(flux_errs)[order],
+                                            meta={'TICID': first_lightcurve.meta['TICID']})
+
+        return combined_lightcurve
+
+
+    def add_segment(self, sector, time, flux, weights):
+        """
+            Keeps a sector's data for the periodogram cache, joining it to any data already kept for the sector
+            Parameters:
+                        sector: TESS sector
+                        time: time data (days)
+                        flux: flux data
+                        weights: weight of each point
+            Returns:
+                        None
+        """
+        if sector in self.segments:
+            time, flux, weights = (np.concatenate([kept, new]) for kept, new in zip(self.segments[sector], (time, flux, weights)))
+
+        self.segments[sector] = (time, flux, weights)
+
+
+    def available_sectors(self, result, result_exposures):
+        """
+            Finds the sectors a search result has data for, at the cadences that would be used
+            Parameters:
+                        result: Products found by the data source
+                        result_exposures: exposure times of the products
+            Returns:
+                        sectors: sorted list of sectors
+        """
+        if self.multi_cadence:
+            return sorted(sector for _, sector, _ in self.choose_products(result, result_exposures))
+
+        return sorted({result.sectors[i] for i, exposure in enumerate(result_exposures)
+                       if exposure.value == self.cadence})
+
+
+    def report_contributions(self):
+        """
+            Prints which sectors and cadences make up the lightcurve
+            Parameters:
+                        None
+            Returns:
+                        None
+        """
+        sectors = []
+        for contribution in self.contributions:
+            text = f"{contribution['sector']} ({contribution['cadence']:g} s"
+            if contribution['rebinned']:
+                text += f' rebinned to {self.cadence:g} s'
+            if contribution['weight'] != 1.0:
+                text += f", weight {contribution['weight']:g}"
+            sectors.append(text + ')')
+
+        print(f"{self.catalog_row['iau_name']}: sectors {', '.join(sectors)}, minimum period {2 * self.coarsest_cadence:g} s")
+
+
     def get_lightcurve(self):
         """
             Creates a lightcurve from the current catalog row's TIC number, as well as saves the TIC number,
@@ -70,13 +351,28 @@ class LightcurveData(object):
 
         # Pull data for that star
         try:
-            result = lk.search_lightcurve(self.catalog_row['iau_name'], mission='TESS')
+            with stage('search_lightcurve'):
+                result = self.data_source.search(self.catalog_row)
             result_exposures = result.exptime
         except Exception as e:
             print(f"Error for {self.catalog_row['iau_name']}: {e} \n")
-            error = True
+            self.error = repr(e)
+            return None, None, None, None
+
+        # Skip downloading stars with no new sectors since their periodogram was stored
+        if self.refresh and self.periodogram_cache:
+            sectors = self.available_sectors(result, result_exposures)
+            if sectors and sectors == self.periodogram_cache.get_sectors(self.catalog_row['iau_name']):
+                self.unchanged = True
+                self.sectors = len(sectors)
+                return None, None, None, None
 
-        lightcurve = self.append_lightcurves(result, result_exposures)
+        if self.multi_cadence:
+            lightcurve = self.combine_cadences(result, result_exposures)
+            if lightcurve:
+                self.report_contributions()
+        else:
+            lightcurve = self.append_lightcurves(result, result_exposures)
         
         if not lightcurve:
             error = True  # check if there was a result with the cadence needed
@@ -92,18 +388,40 @@ class LightcurveData(object):
             return None, None, None, None
 
 
+    @timed('periodogram')
     def get_periodogram(self):
         """
-            Creates a periodogram from the lightcurve with the minimum period being 2 * cadence, and the maximum 
-            period being 14 days
+            Creates a periodogram from the lightcurve with the minimum period being 2 * the coarsest cadence used, 
+            and the maximum period being 14 days
             Parameters: 
                         None
             Returns:
                         periodogram: lightcurve's periodogram
         """
+        # Update the stored sums with any new sectors
+        if self.periodogram_cache:
+            frequency, power, _ = self.periodogram_cache.update(self.catalog_row['iau_name'], self.segments)
+            frequency_mask = frequency <= 1 / (2 * self.coarsest_cadence * u.second).to(u.day).value
+
+            return Periodogram(frequency=frequency[frequency_mask] / u.day, 
+                               power=u.Quantity(power[frequency_mask], self.lightcurve.flux.unit),
+                               default_view='period', meta=self.lightcurve.meta)
+
+        # Compute in blocks under the memory limit, or with weighted sums when FFI points are down weighted, as
+        # lightkurve's periodogram weights every point equally
+        weighted = self.weights is not None and np.any(self.weights != 1)
+        if self.periodogram_memory or weighted:
+            streaming_periodogram = StreamingPeriodogram(self.periodogram_memory) if self.periodogram_memory else StreamingPeriodogram()
+            frequency, power = streaming_periodogram.compute(self.time, self.flux, self.weights, 
+                                                             minimum_period=(2 * self.coarsest_cadence * u.second).to(u.day).value, 
+                                                             maximum_period=14)
+
+            return Periodogram(frequency=frequency / u.day, power=u.Quantity(power, self.lightcurve.flux.unit),
+                               default_view='period', meta=self.lightcurve.meta)
+
         # Convert lightcurve to periodogram
         periodogram = self.lightcurve.to_periodogram(oversample_factor=10, 
-                                                     minimum_period=(2 * self.cadence * u.second).to(u.day).value, 
+                                                     minimum_period=(2 * self.coarsest_cadence * u.second).to(u.day).value, 
                                                      maximum_period=14)
         return periodogram
 
@@ -119,3 +437,43 @@ class LightcurveData(object):
         period_at_max_power = self.periodogram.period_at_max_power.value
 
         return period_at_max_power
+
+
+    @timed('bootstrap')
+    def get_uncertainties(self):
+        """
+            Bootstraps the uncertainty of the period at max power and of its amplitude, only evaluating the 
+            periodogram in a narrow window around the peak
+            Parameters:
+                        None
+            Returns:
+                        period_error: uncertainty of the period at max power (days, NaN if skipped)
+                        amplitude: amplitude of the sinusoid at the period
+                        amplitude_error: uncertainty of the amplitude (NaN if skipped)
+        """
+        if not self.bootstrap_samples:
+            return np.nan, np.nan, np.nan
+
+        period_uncertainty = PeriodUncertainty(self.bootstrap_samples)
+
+        return period_uncertainty.estimate(self.time, self.flux, self.weights, 1 / self.period_at_max_power)
+
+
+    @timed('period_consensus')
+    def get_period_candidates(self):
+        """
+            Ranks candidate periods by how well Lomb-Scargle, phase dispersion minimization and the autocorrelation 
+            agree on them, the latter two running in parallel
+            Parameters:
+                        None
+            Returns:
+                        period_candidates: list of {period, score, methods}, best first (empty if skipped)
+        """
+        if not self.consensus_candidates:
+            return []
+
+        period_consensus = PeriodConsensus(self.consensus_candidates)
+        period_candidates, _ = period_consensus.run(self.time, self.flux, self.periodogram.period.value, 
+                                                    self.periodogram.power.value)
+
+        return period_candidates
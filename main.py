@@ -1,64 +1,275 @@
+import argparse
 from tqdm import tqdm
 
 from input_check import *
 from catalog_data import *
 from preload_plots import *
-from lightcurve_data import *
-from orb_calculator import *
-from exoplanet_effects import *
-from save_data import *
+from preload_engine import *
+from run_ledger import *
+from results_store import *
+from target_scheduler import *
+from autopilot import *
+from catalog_shards import *
+from stage_metrics import StageMetrics, set_metrics, star
 
-def main():
+# The analysis stack (lightkurve, astropy, lmfit, scipy, seaborn and stella) is imported at first use, so reviewing
+# preloaded stars doesn't load it
+
+def process_star(row, cadence, preload, products, catalog_data, preload_plots, results_store, lightcurve_settings=None):
+    """
+        Runs the full analysis of one catalog row, presenting (or preloading) its plots and saving its data
+        Parameters:
+                    row: row of the catalog dataframe
+                    cadence: desired cadence for lightcurves
+                    preload: True if saving plots to look through later
+                    products: True if preload saves numerical products instead of plots
+                    catalog_data: CatalogData of the catalog
+                    preload_plots: PreloadPlots instance
+                    results_store: ResultsStore the star's results are written to
+                    lightcurve_settings: LightcurveData keyword arguments (multi_cadence, periodogram_cache, refresh, 
+                                         periodogram_memory, data_source, bootstrap_samples, detrender,
+                                         consensus_candidates)
+        Returns:
+                    status: run ledger status the star ended in (None if unchanged since the last run)
+                    tic: TIC name of the star (None if there was no lightcurve)
+                    error: error text (None if there was no error)
+                    sectors: number of sectors at the cadence (None if the search failed)
+    """
+    from lightcurve_data import LightcurveData
+
+    # Get lightcurve data
+    lightcurve_data = LightcurveData(row, cadence, **(lightcurve_settings or {}))
+
+    # Keep the earlier results of stars with no new sectors
+    if lightcurve_data.unchanged:
+        return None, None, None, lightcurve_data.sectors
+
+    if not lightcurve_data.lightcurve: 
+        return (FAILED if lightcurve_data.error else NO_DATA), None, lightcurve_data.error, lightcurve_data.sectors
+
+    from orb_calculator import OrbCalculator
+    from exoplanet_effects import ExoplanetEffects
+    from save_data import SaveData
+
+    # Present period plots
+    orb_calculator = OrbCalculator(lightcurve_data, preload_plots)
+
+    # Check if the period was real
+    if not orb_calculator.is_real_period and not preload: 
+        return REVIEWED, lightcurve_data.name, None, lightcurve_data.sectors
+
+    # Present effects plots -> take in orb calculator as an object
+    exoplanet_effects = ExoplanetEffects(lightcurve_data, orb_calculator, preload_plots)
+
+    # Save the data
+    if preload:
+        if products:
+            preload_plots.save_products(lightcurve_data, orb_calculator, exoplanet_effects)
+        preload_plots.save_period(lightcurve_data)
+
+        return COMPUTED, lightcurve_data.name, None, lightcurve_data.sectors
+
+    SaveData(catalog_data, lightcurve_data, exoplanet_effects, results_store)
+
+    return SAVED, lightcurve_data.name, None, lightcurve_data.sectors
+
+
+def main(shard=None):
     
     # Catalog data 
     raw_catalog_dir = 'raw_wdss_data.csv' # Raw query data from https://sdss-wdms.org/ 
-    catalog_dir = 'wdss_data.csv' # Query data w/ commas (file shouldn't exist on first run)
+    catalog_dir = 'wdss_data.feather' # Cached copy of the catalog columns used (rebuilt when the raw query changes)
     porb_dir = 'orbital_periods/periods.csv' # Where final orbital periods will be stored
 
     # Lightcurve data
     cadence = 120 # Desired cadence for lightcurves
+    multi_cadence = False # True to also use faster (rebinned to cadence) and slower (FFI, down weighted) products
+    data_source = 'mast' # Where lightcurves come from ('mast' to search and download live, 'mirror' to read mirror_dir, 'fixture' for synthetic lightcurves)
+    mirror_dir = None # Local directory of lightcurve FITS files, for data_source = 'mirror'
+    bootstrap_samples = 200 # Residual resamples the period and amplitude errors are bootstrapped from (0 to skip them)
+    detrend_window = None # Days of the running median each sector is divided by, removing longer trends (None to only normalize)
+    detrend_dir = None # Where processed sectors are kept, so reruns skip reading them again, e.g. 'orbital_periods/sectors/' (None to not keep them)
+    consensus_candidates = 5 # Candidate periods ranked by Lomb-Scargle, phase dispersion and autocorrelation agreement (0 to skip them)
 
     # Choose how to run
     preload = False # True if want to save all plots now, and look through them later
-    autopilot = False # True if want to just use a CNN to find periods
+    autopilot = False # True if want a trained classifier to answer the screens it is confident about
+    review_only = False # True to only review stars preloaded by an earlier run, without loading the analysis stack
+    workers = 1 # Number of processes to preload with (1 runs serially in this process)
+    products = False # True if preload saves each star's numerical products, and plots are rendered at review
+    plot_format = 'png' # Encoding of packed preload plots ('png' or 'webp')
+    plot_dpi = None # Resolution of packed preload plots (None keeps the figure's dpi)
+    preload_dir = 'preload/' # Where preloaded plots, products and the review session are kept
+    lookahead = 0 # Stars analysed by workers ahead of the reviewer when not preloading (0 to analyse each star when reached)
+    max_memory = None # MB a process may be left at after a star, workers past it are recycled and a serial run stops to be resumed (None for no ceiling)
+
+    # Run ledger
+    ledger_dir = 'orbital_periods/run_ledger.db' # Where the status of every star is kept between runs
+    resume = True # True to skip stars finished by a previous run, False to start over
+    no_data_ttl = 30 # Days stars with no data at the cadence are skipped for, before being searched again
+    refresh = False # True to search finished stars again, redoing only those with new sectors
+
+    # Periodogram cache
+    periodogram_dir = None # Where per sector periodogram sums are kept, e.g. 'orbital_periods/periodograms/' (None to compute from scratch)
+    periodogram_memory = None # MB the periodogram is computed in, in blocks, for very long lightcurves (None for lightkurve's)
+
+    # Autopilot
+    autopilot_model_dir = 'cnn/autopilot_model.npz' # Trained classifier (see Autopilot.train())
+    autopilot_threshold = 0.9 # Confidence an answer needs to skip the reviewer
+
+    # Results store
+    results_dir = 'orbital_periods/results.db' # Where results are written as they come in (exported to porb_dir at the end)
+
+    # Stage metrics
+    metrics_dir = 'orbital_periods/metrics.jsonl' # Where each star's per stage timings are appended (None to not record them)
+
+    # Each shard of the catalog writes to its own directories, so nodes share no state (merged with catalog_shards.py)
+    if shard:
+        porb_dir, ledger_dir, results_dir, preload_dir = (create_shard_dir(path, shard) for path in 
+                                                          [porb_dir, ledger_dir, results_dir, preload_dir])
+        metrics_dir = create_shard_dir(metrics_dir, shard) if metrics_dir else None
 
     # Check inputs
-    InputCheck(raw_catalog_dir, catalog_dir, porb_dir, preload, autopilot)
+    InputCheck(raw_catalog_dir, catalog_dir, porb_dir, preload, autopilot, resume, autopilot_model_dir, data_source, mirror_dir,
+               review_only)
+
+    # Review the preloaded stars, writing their results, without reading the catalog or processing any star
+    if review_only:
+        results_store = ResultsStore(results_dir)
+        preload_plots = PreloadPlots(True, porb_dir, products, plot_format, plot_dpi, results_store, preload_dir)
+        preload_plots.run(RunLedger(ledger_dir, no_data_ttl=no_data_ttl * 86400))
+
+        results_store.export_csv('results', porb_dir)
+        results_store.export_csv('preload', preload_plots.preload_data_dir)
+        return
+
+    # Autopilot preloads every star's products headlessly, then scores them, leaving only uncertain screens for review
+    if autopilot:
+        preload, products = True, True
 
     # Process catalog data
-    catalog_data = CatalogData(raw_catalog_dir, catalog_dir, porb_dir)
+    catalog_data = CatalogData(raw_catalog_dir, catalog_dir, porb_dir, resume)
+
+    # Keep only the shard's stars
+    if shard:
+        catalog_data.catalog_df = select_shard(catalog_data.catalog_df, shard)
+
+    # Open the run ledger
+    ledger = RunLedger(ledger_dir, no_data_ttl=no_data_ttl * 86400)
+    if not resume:
+        ledger.reset()
+    ledger.register(catalog_data.catalog_df['iau_name'])
+
+    # Search the stars most likely to give periods first, skipping those known to have no data
+    catalog_data.catalog_df = TargetScheduler(ledger).order(catalog_data.catalog_df)
+
+    # Open the results store, bringing in the porb_dir of older runs
+    results_store = ResultsStore(results_dir)
+    if not resume:
+        results_store.reset()
+    elif not results_store.get_tics('results') and exists(porb_dir):
+        results_store.import_csv('results', porb_dir)
+
+    # Record the stages of every star
+    metrics = StageMetrics(metrics_dir) if metrics_dir else None
+    set_metrics(metrics)
+
+    from data_sources import create_source
+    from detrending import Detrender
+    from periodogram_cache import PeriodogramCache
+
+    # Settings of every star's lightcurve
+    lightcurve_settings = {'multi_cadence': multi_cadence, 'refresh': refresh, 'periodogram_memory': periodogram_memory,
+                           'data_source': create_source(data_source, mirror_dir, cadence), 'bootstrap_samples': bootstrap_samples,
+                           'detrender': Detrender(detrend_window, cache_dir=detrend_dir),
+                           'consensus_candidates': consensus_candidates}
 
     # Initiate an instance of preload
-    preload_plots = PreloadPlots(preload, porb_dir)
+    preload_plots = PreloadPlots(preload, porb_dir, products, plot_format, plot_dpi, results_store, preload_dir)
+
+    # Spread the preload across a process pool (a pool of one with a memory ceiling, so its worker can be recycled)
+    if preload and (workers > 1 or max_memory):
+        PreloadEngine(catalog_data, preload_plots, cadence, workers, ledger, lightcurve_settings=lightcurve_settings,
+                      periodogram_dir=periodogram_dir, metrics_settings=metrics.get_settings() if metrics else None,
+                      max_memory=max_memory).run()
 
-    # Iterate through each row in the catalog
-    for _, row in tqdm(catalog_data.catalog_df.iterrows(), 'Processing lightcurves', total = len(catalog_data.catalog_df)):
-        
-        # Get lightcurve data
-        lightcurve_data = LightcurveData(row, cadence)
+    # Analyse the next stars in a process pool while the reviewer looks at the current one
+    elif not preload and lookahead > 0:
+        from pipelined_review import PipelinedReview
 
-        if not lightcurve_data.lightcurve: continue
+        PipelinedReview(catalog_data, preload_plots, cadence, max(1, workers), ledger, lookahead, lightcurve_settings,
+                        periodogram_dir, metrics.get_settings() if metrics else None, max_memory).run()
 
-        # Present period plots
-        orb_calculator = OrbCalculator(lightcurve_data, preload_plots)
+    else:
+        from memory_guard import MemoryGuard
 
-        # Check if the period was real
-        if not orb_calculator.is_real_period and not preload: continue
+        statuses = ledger.get_statuses()
+        periodogram_cache = PeriodogramCache(periodogram_dir, cadence) if periodogram_dir else None
+        star_settings = dict(lightcurve_settings, periodogram_cache=periodogram_cache)
+        memory_guard = MemoryGuard(max_memory)
 
-        # Present effects plots -> take in orb calculator as an object
-        exoplanet_effects = ExoplanetEffects(lightcurve_data, orb_calculator, preload_plots)
+        # Iterate through each row in the catalog
+        for _, row in tqdm(catalog_data.catalog_df.iterrows(), 'Processing lightcurves', total = len(catalog_data.catalog_df)):
+            name = row['iau_name']
 
-        # Save the data
-        if preload:
-            preload_plots.save_period(lightcurve_data)
-        else:
-            SaveData(catalog_data, lightcurve_data, exoplanet_effects)
+            # Skip stars finished by a previous run, or being processed by another worker
+            if ledger.is_done(statuses[name], preload, refresh) or not ledger.claim(name): continue
+
+            with star(name) as outcome:
+                try:
+                    status, tic, error, sectors = process_star(row, cadence, preload, products, catalog_data, preload_plots,
+                                                               results_store, star_settings)
+                except KeyboardInterrupt:
+                    ledger.release(name)
+                    raise
+                except Exception as e:
+                    print(f'Error for {name}: {e} \n')
+                    status, tic, error, sectors = FAILED, None, repr(e), None
+
+                outcome['status'] = status
+
+                # Free the star's figures and objects before the next one
+                over = memory_guard.check(name)
+
+            # Stars with no new sectors keep their earlier status, and finished stars are only marked once their rows
+            # are written
+            if status is None:
+                ledger.release(name)
+            else:
+                if status in [COMPUTED, SAVED]:
+                    results_store.flush()
+                ledger.update(name, status, tic, error, sectors)
+
+            # This process can't be replaced, so stop once the star is recorded, and the next run resumes after it
+            if over:
+                print(f'Stopping after {name} as memory is over max_memory ({max_memory} MB), run again to resume')
+                break
+
+        memory_guard.summary()
+
+    # Answer the confident screens of every preloaded star
+    if autopilot:
+        Autopilot(preload_plots, autopilot_model_dir, ledger, autopilot_threshold).run()
+
+    # Slowest stages of the stars processed
+    if metrics:
+        metrics.summary()
 
     # Load plots if preload
-    preload_plots.run()
+    preload_plots.run(ledger)
+
+    # Write the stored results out as csvs
+    results_store.export_csv('results', porb_dir)
+    if preload:
+        results_store.export_csv('preload', preload_plots.preload_data_dir)
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Finds the orbital periods and effects of the catalog, or of one shard of it')
+    parser.add_argument('--shard', type=parse_shard, default=None, 
+                        help="shard of the catalog to process, as 'i/N' (e.g. 2/4), writing to its own directories")
+    args = parser.parse_args()
+
+    main(args.shard)
 
     print('All done!')
\ No newline at end of file
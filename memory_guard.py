@@ -0,0 +1,102 @@
+import ctypes
+import gc
+import numpy as np
+import sys
+
+from stage_metrics import get_rss
+
+# glibc's allocator, to hand freed memory back to the system (None elsewhere)
+try:
+    libc = ctypes.CDLL('libc.so.6')
+    libc.malloc_trim
+except (OSError, AttributeError):
+    libc = None
+
+
+def release_memory():
+    """
+        Frees what one star leaves behind: every open figure, reference cycles (figures, lightkurve objects and lmfit
+        results hold many) and the allocator's free memory
+        Parameters:
+                    None
+        Returns:
+                    rss: resident memory of this process afterwards in MB (None if it can't be read)
+    """
+    # Figures only exist if pyplot was imported
+    plt = sys.modules.get('matplotlib.pyplot')
+    if plt is not None:
+        plt.close('all')
+
+    gc.collect()
+
+    if libc is not None:
+        libc.malloc_trim(0)
+
+    return get_rss()
+
+
+class MemoryGuard(object):
+    def __init__(self, max_memory=None, warmup=20):
+        # Resident memory in MB a process may stay at after a star (None for no ceiling)
+        self.max_memory = max_memory
+
+        # Stars left out of the growth estimate, while imports and caches settle
+        self.warmup = warmup
+
+        # Resident memory after each star was released, in MB
+        self.rss = []
+        self.warned = False
+
+
+    def check(self, name):
+        """
+            Releases a finished star and records the memory left afterwards
+            Parameters:
+                        name: catalog name of the star
+            Returns:
+                        over: True if the process is still over max_memory after releasing the star
+        """
+        rss = release_memory()
+        if rss is None:
+            return False
+
+        self.rss.append(rss)
+        over = self.max_memory is not None and rss > self.max_memory
+
+        if over and not self.warned:
+            print(f'Memory is at {rss:.0f} MB after releasing {name}, over max_memory ({self.max_memory} MB)')
+            self.warned = True
+
+        return over
+
+
+    def growth(self):
+        """
+            Estimates how fast memory grows from star to star, after the warmup
+            Parameters:
+                        None
+            Returns:
+                        growth: MB per star of the fitted trend (None without enough stars)
+        """
+        rss = self.rss[self.warmup:]
+        if len(rss) < 2:
+            return None
+
+        return np.polyfit(np.arange(len(rss)), rss, 1)[0]
+
+
+    def summary(self):
+        """
+            Prints the memory left after the first and last stars, the peak and the growth per star
+            Parameters:
+                        None
+            Returns:
+                        None
+        """
+        if not self.rss:
+            return
+
+        growth = self.growth()
+        growth = f', growing {growth * 1000:.1f} MB per 1000 stars' if growth is not None else ''
+        print(f'Memory after each star: {self.rss[0]:.0f} MB first, {self.rss[-1]:.0f} MB last, {max(self.rss):.0f} MB '
+              f'peak over {len(self.rss)} stars{growth}')
@@ -8,6 +8,8 @@ import numpy as np
 from scipy.stats import zscore
 import seaborn as sns
 
+from stage_metrics import timed
+
 
 class OrbCalculator(object):
     def __init__(self, lightcurve_data, preload_plots):
@@ -39,6 +41,9 @@ class OrbCalculator(object):
         self.xmin = min(self.lightcurve_data.time) + 1 + self.lightcurve_data.period_at_max_power
         self.xmax = min(self.lightcurve_data.time) + 1 + 4 * self.lightcurve_data.period_at_max_power
 
+        # Products are rendered at review instead of plotted now
+        if preload_plots.preload and preload_plots.products: return
+
         # Create plots for determining if the period is real
         self.is_real_period_plot()
 
@@ -49,6 +54,7 @@ class OrbCalculator(object):
             plt.show()
 
 
+    @timed('plausible_period')
     def plausible_period(self):
         """
             Determines if the period at max power of a periodogram is plausible based off of standard deviation
@@ -128,6 +134,7 @@ class OrbCalculator(object):
         return significant_eclipses
     
 
+    @timed('gaussian_eclipse_fit')
     def remove_eclipses(self):
         """
 
@@ -204,6 +211,7 @@ class OrbCalculator(object):
         return bin_value
 
 
+    @timed('sine_fit')
     def fit_sine_wave(self, time, flux):
         """
             Fits a sine wave to a lightcurve using the lmfit package
@@ -224,6 +232,7 @@ class OrbCalculator(object):
         return result
 
 
+    @timed('fold')
     def fold_lightcurve(self, num_folds=1):
         """
             Folds the lightcurve on the period at max power, and bins it into 50 bins
@@ -245,6 +254,7 @@ class OrbCalculator(object):
         return binned_lightcurve
 
 
+    @timed('fold')
     def fold_sine_wave(self, x, frequency, sine_wave, num_folds=1):
         """
             Folds the fitted sine wave on its period and bins it into 50 bins
@@ -297,6 +307,11 @@ class OrbCalculator(object):
             axis.axvline(x=self.lightcurve_data.lit_period, color='#A30015', 
                          label=fr'Literature $P_{{\text{{orb}}}}={np.round(self.lightcurve_data.lit_period, 3)}$ days')
 
+        # Plot the candidate periods the methods agree on
+        for rank, candidate in enumerate(self.lightcurve_data.period_candidates[:3]):
+            axis.axvline(x=candidate['period'], color='#E3A72F', ls=':', lw=2 - 0.5 * rank,
+                         label=fr'Consensus $P_{{{rank + 1}}}={np.round(candidate["period"], 3)}$ days ({candidate["score"]:.2f})')
+
         # Plot 5 sigma cutoff
         axis.axhline(y=self.cutoff, color='#4A5D96', ls=(0, (4, 5)), lw=2, label='5-sigma cutoff')
 
@@ -390,6 +405,7 @@ class OrbCalculator(object):
         axis.set_xlim(self.xmin, self.xmax)
 
 
+    @timed('period_figure')
     def is_real_period_plot(self):
         """
             Present a plot of the periodogram, binned lightcurve, lightcurve, and residuals, which are then used to
@@ -0,0 +1,274 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# Period estimators, in the order their candidates are reported
+METHODS = ['lomb_scargle', 'pdm', 'acf']
+
+# Thread pools shared by every star of a process {workers: executor}
+executors = {}
+
+
+class PeriodConsensus(object):
+    def __init__(self, num_candidates=5, pdm_bins=50, pdm_widths=2.0, pdm_points=41, acf_smooth=0.1, tolerance=0.01,
+                 harmonic_weight=0.5, workers=3, chunk_elements=4000000):
+        # Candidates kept from each method, and in the ranked list
+        self.num_candidates = num_candidates
+
+        # Phase dispersion minimization over pdm_bins phase bins, on pdm_points periods within pdm_widths peak
+        # widths (P^2 / baseline) of each Lomb-Scargle candidate, its half and its double
+        self.pdm_bins = pdm_bins
+        self.pdm_widths = pdm_widths
+        self.pdm_points = pdm_points
+
+        # Autocorrelation smoothed over acf_smooth of the lag of each point (as a fraction)
+        self.acf_smooth = acf_smooth
+
+        # Periods within tolerance (relative) of each other agree, and half or double periods agree with
+        # harmonic_weight of the weight
+        self.tolerance = tolerance
+        self.harmonic_weight = harmonic_weight
+
+        # Threads the methods run on, and the most periods x points phase folded at a time
+        self.workers = workers
+        self.chunk_elements = chunk_elements
+
+
+    def get_executor(self):
+        """
+            Gets the thread pool of this process, creating it the first time
+            Parameters:
+                        None
+            Returns:
+                        executor: thread pool executor
+        """
+        if self.workers not in executors:
+            executors[self.workers] = ThreadPoolExecutor(max_workers=self.workers)
+
+        return executors[self.workers]
+
+
+    def find_peaks(self, values, num_peaks):
+        """
+            Finds the highest local maxima of an array
+            Parameters:
+                        values: array of values
+                        num_peaks: number of peaks
+            Returns:
+                        peaks: indices of the highest peaks, highest first
+        """
+        if len(values) < 3:
+            return np.array([], dtype=int)
+
+        interior = np.flatnonzero((values[1:-1] > values[:-2]) & (values[1:-1] >= values[2:])) + 1
+        interior = interior[np.isfinite(values[interior])]
+
+        return interior[np.argsort(values[interior])[::-1][:num_peaks]]
+
+
+    def lomb_scargle(self, period, power):
+        """
+            Takes the highest peaks of the lightcurve's Lomb-Scargle periodogram
+            Parameters:
+                        period: periodogram periods (days)
+                        power: periodogram power
+            Returns:
+                        candidates: list of (period, strength), strength as a fraction of the highest peak
+        """
+        peaks = self.find_peaks(power, self.num_candidates)
+        if not len(peaks):
+            return []
+
+        return [(period[peak], power[peak] / power[peaks[0]]) for peak in peaks]
+
+
+    def dispersion(self, time, flux, periods):
+        """
+            Calculates the phase dispersion statistic (pooled variance in phase bins over the total variance) of many
+            periods at once, a chunk of periods at a time
+            Parameters:
+                        time: time data (days)
+                        flux: flux data
+                        periods: trial periods (days)
+            Returns:
+                        theta: dispersion of each period (0 for a perfect fold, about 1 for no signal)
+        """
+        flux = flux - flux.mean()
+        total = np.dot(flux, flux)
+        theta = np.empty(len(periods))
+        chunk_size = max(1, self.chunk_elements // len(time))
+
+        for start in range(0, len(periods), chunk_size):
+            chunk = periods[start:start + chunk_size]
+
+            # Bin of each point at each period, offset so every period has its own bins
+            bins = (((time[None, :] / chunk[:, None]) % 1) * self.pdm_bins).astype(np.int64)
+            bins += (np.arange(len(chunk)) * self.pdm_bins)[:, None]
+            bins = bins.ravel()
+
+            size = len(chunk) * self.pdm_bins
+            counts = np.bincount(bins, minlength=size).reshape(len(chunk), self.pdm_bins)
+            sums = np.bincount(bins, np.tile(flux, len(chunk)), minlength=size).reshape(len(chunk), self.pdm_bins)
+
+            # Within bin sum of squares = total - sum over bins of (bin sum)^2 / count
+            between = np.where(counts > 0, sums ** 2 / np.maximum(counts, 1), 0.0).sum(axis=1)
+            filled = (counts > 1).sum(axis=1)
+
+            theta[start:start + len(chunk)] = ((total - between) / np.maximum(len(time) - filled, 1)) / (total / (len(time) - 1))
+
+        return theta
+
+
+    def pdm(self, time, flux, seeds):
+        """
+            Refines the phase dispersion minimum around each seed period, its half and its double
+            Parameters:
+                        time: time data (days)
+                        flux: flux data
+                        seeds: seed periods (days)
+            Returns:
+                        candidates: list of (period, strength), strength being 1 - dispersion
+        """
+        baseline = time.max() - time.min()
+        centers = np.unique(np.concatenate([np.asarray(seeds) * ratio for ratio in [0.5, 1, 2]]))
+        centers = centers[centers < baseline / 2]
+
+        if not len(centers):
+            return []
+
+        # Local grid of each center, one peak width either side
+        offsets = np.linspace(-self.pdm_widths, self.pdm_widths, self.pdm_points)
+        periods = (centers[:, None] + offsets[None, :] * centers[:, None] ** 2 / baseline).ravel()
+        theta = self.dispersion(time - time.min(), flux, np.clip(periods, 1e-6, None)).reshape(len(centers), -1)
+
+        best = np.argmin(theta, axis=1)
+        candidates = [(periods.reshape(len(centers), -1)[row, column], 1 - theta[row, column]) for row, column in enumerate(best)]
+        candidates.sort(key=lambda candidate: -candidate[1])
+
+        return candidates[:self.num_candidates]
+
+
+    def acf(self, time, flux, maximum_period):
+        """
+            Finds the highest peaks of the autocorrelation, computed with FFTs on the cadence grid with gaps left out
+            Parameters:
+                        time: time data (days)
+                        flux: flux data
+                        maximum_period: longest lag to consider (days)
+            Returns:
+                        candidates: list of (period, strength), strength being the autocorrelation
+        """
+        step = np.median(np.diff(time))
+        positions = np.round((time - time[0]) / step).astype(np.int64)
+        num_positions = int(positions[-1]) + 1
+
+        gridded, mask = np.zeros(num_positions), np.zeros(num_positions)
+        gridded[positions] = flux - flux.mean()
+        mask[positions] = 1.0
+
+        # Correlations of the flux and of the mask, so each lag is normalized by the pairs it has
+        size = 1 << int(np.ceil(np.log2(2 * num_positions)))
+        flux_fft, mask_fft = np.fft.rfft(gridded, size), np.fft.rfft(mask, size)
+        correlation = np.fft.irfft(flux_fft * np.conj(flux_fft), size)[:num_positions]
+        pairs = np.fft.irfft(mask_fft * np.conj(mask_fft), size)[:num_positions]
+
+        max_lag = min(num_positions - 1, int(maximum_period / step))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            acf = np.where(pairs[:max_lag + 1] > 0.1 * pairs[0], correlation[:max_lag + 1] / pairs[:max_lag + 1], 0.0)
+        acf /= acf[0] if acf[0] > 0 else 1.0
+
+        # Running mean over a fixed fraction of each lag, so short periods keep their peaks
+        cumulative = np.concatenate([[0.0], np.cumsum(acf)])
+        lags = np.arange(len(acf))
+        half_widths = np.maximum(1, (self.acf_smooth * lags / 2).astype(np.int64))
+        low, high = np.clip(lags - half_widths, 0, len(acf)), np.clip(lags + half_widths + 1, 0, len(acf))
+        smoothed = (cumulative[high] - cumulative[low]) / (high - low)
+
+        # Ignore the zero lag peak, up to the first time the autocorrelation drops below 0
+        below = np.flatnonzero(smoothed < 0)
+        if not len(below):
+            return []
+        smoothed[:below[0]] = -np.inf
+
+        peaks = self.find_peaks(smoothed, self.num_candidates)
+
+        return [(lag * step, smoothed[lag]) for lag in peaks if smoothed[lag] > 0]
+
+
+    def agreement(self, period, other):
+        """
+            Weighs how well two periods agree
+            Parameters:
+                        period: period (days)
+                        other: other period (days)
+            Returns:
+                        weight: 1 if equal, harmonic_weight if one is half the other, 0 otherwise
+        """
+        ratio = period / other
+
+        if abs(ratio - 1) <= self.tolerance:
+            return 1.0
+
+        if abs(ratio - 2) <= 2 * self.tolerance or abs(ratio - 0.5) <= 0.5 * self.tolerance:
+            return self.harmonic_weight
+
+        return 0.0
+
+
+    def reconcile(self, candidates):
+        """
+            Ranks every candidate period by how strongly the methods agree on it
+            Parameters:
+                        candidates: {method: [(period, strength), ...]}
+            Returns:
+                        ranked: list of {period, score, methods: {method: strength}}, best first, merging equal periods
+        """
+        ranked = []
+
+        for method in METHODS:
+            for period, _ in candidates.get(method, []):
+                # Periods already ranked
+                if any(self.agreement(period, entry['period']) == 1.0 for entry in ranked):
+                    continue
+
+                support = {}
+                for other_method, other_candidates in candidates.items():
+                    weights = [self.agreement(period, other_period) * strength for other_period, strength in other_candidates]
+                    if weights and max(weights) > 0:
+                        support[other_method] = float(max(weights))
+
+                ranked.append({'period': float(period), 'score': sum(support.values()) / len(METHODS), 'methods': support})
+
+        # Best agreement first, then the strongest Lomb-Scargle support
+        ranked.sort(key=lambda entry: (-entry['score'], -entry['methods'].get('lomb_scargle', 0.0)))
+
+        return ranked[:self.num_candidates]
+
+
+    def run(self, time, flux, period, power, maximum_period=14):
+        """
+            Runs Lomb-Scargle, phase dispersion minimization and the autocorrelation on the same arrays, on the
+            thread pool, and ranks their candidate periods by agreement
+            Parameters:
+                        time: time data (days)
+                        flux: flux data
+                        period: Lomb-Scargle periodogram periods (days)
+                        power: Lomb-Scargle periodogram power
+                        maximum_period: longest period considered (days)
+            Returns:
+                        ranked: list of {period, score, methods: {method: strength}}, best first
+                        candidates: {method: [(period, strength), ...]}
+        """
+        time, flux = np.ascontiguousarray(time, dtype=float), np.ascontiguousarray(flux, dtype=float)
+        period, power = np.asarray(period, dtype=float), np.asarray(power, dtype=float)
+
+        candidates = {'lomb_scargle': self.lomb_scargle(period, power)}
+        seeds = [candidate_period for candidate_period, _ in candidates['lomb_scargle']]
+
+        executor = self.get_executor()
+        pdm_future = executor.submit(self.pdm, time, flux, seeds)
+        acf_future = executor.submit(self.acf, time, flux, maximum_period)
+
+        candidates['pdm'] = pdm_future.result()
+        candidates['acf'] = acf_future.result()
+
+        return self.reconcile(candidates), candidates
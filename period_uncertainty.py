@@ -0,0 +1,176 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# Thread pools shared by every star of a process {workers: executor}
+executors = {}
+
+
+class PeriodUncertainty(object):
+    def __init__(self, num_samples=200, window_widths=1.0, window_points=33, workers=4, chunk_elements=4000000, seed=0):
+        # Bootstrap resamples of the residuals
+        self.num_samples = num_samples
+
+        # The periodogram is only evaluated within window_widths peak widths (1 / baseline) either side of the peak,
+        # on window_points frequencies, with the peak of each resample refined by a parabola
+        self.window_widths = window_widths
+        self.window_points = window_points
+
+        # Threads the resamples are spread over, with at most chunk_elements resampled points per chunk
+        self.workers = workers
+        self.chunk_elements = chunk_elements
+
+        self.seed = seed
+
+
+    def get_executor(self):
+        """
+            Gets the thread pool of this process, creating it the first time
+            Parameters:
+                        None
+            Returns:
+                        executor: thread pool executor
+        """
+        if self.workers not in executors:
+            executors[self.workers] = ThreadPoolExecutor(max_workers=self.workers)
+
+        return executors[self.workers]
+
+
+    def create_basis(self, time, weights, frequency):
+        """
+            Precomputes the weighted sine and cosine of every window frequency, and the inverse of each frequency's
+            floating mean normal matrix, which only depend on the time sampling
+            Parameters:
+                        time: time data (days)
+                        weights: weight of each point
+                        frequency: window frequencies (1/day)
+            Returns:
+                        basis: (weighted cos, weighted sin, inverse normal matrices)
+        """
+        angle = 2 * np.pi * np.outer(frequency, time)
+        cos, sin = np.cos(angle), np.sin(angle)
+        weighted_cos, weighted_sin = cos * weights, sin * weights
+
+        normal = np.empty((len(frequency), 3, 3))
+        normal[:, 0, 0] = weights.sum()
+        normal[:, 0, 1] = normal[:, 1, 0] = weighted_cos.sum(axis=1)
+        normal[:, 0, 2] = normal[:, 2, 0] = weighted_sin.sum(axis=1)
+        normal[:, 1, 1] = (weighted_cos * cos).sum(axis=1)
+        normal[:, 1, 2] = normal[:, 2, 1] = (weighted_cos * sin).sum(axis=1)
+        normal[:, 2, 2] = (weighted_sin * sin).sum(axis=1)
+
+        return weighted_cos, weighted_sin, np.linalg.inv(normal)
+
+
+    def fit_window(self, flux, weights, basis):
+        """
+            Fits a floating mean sinusoid at every window frequency to a batch of lightcurves at once
+            Parameters:
+                        flux: (batch, points) flux data
+                        weights: weight of each point
+                        basis: window basis from create_basis()
+            Returns:
+                        coefficients: (batch, frequencies, 3) offset, cosine and sine amplitudes
+        """
+        weighted_cos, weighted_sin, inverse = basis
+
+        # Only these projections depend on the flux, as two matrix products over the whole batch
+        projections = np.stack([np.broadcast_to((flux @ weights)[:, None], (len(flux), len(inverse))),
+                                flux @ weighted_cos.T, flux @ weighted_sin.T], axis=2)
+
+        return np.einsum('kij,bkj->bki', inverse, projections)
+
+
+    def find_peaks(self, frequency, amplitude):
+        """
+            Finds the peak of each window, refined between frequencies with a parabola through the highest three
+            Parameters:
+                        frequency: window frequencies (1/day)
+                        amplitude: (batch, frequencies) amplitudes
+            Returns:
+                        peak_frequency: frequency of each peak (1/day)
+                        peak_amplitude: amplitude of each peak
+        """
+        rows = np.arange(len(amplitude))
+        peak = np.clip(np.argmax(amplitude, axis=1), 1, len(frequency) - 2)
+
+        before, center, after = amplitude[rows, peak - 1], amplitude[rows, peak], amplitude[rows, peak + 1]
+        curvature = before - 2 * center + after
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            offset = np.where(curvature < 0, 0.5 * (before - after) / curvature, 0.0)
+        offset = np.clip(offset, -1, 1)
+
+        peak_frequency = frequency[peak] + offset * (frequency[1] - frequency[0])
+        peak_amplitude = center - 0.25 * (before - after) * offset
+
+        return peak_frequency, peak_amplitude
+
+
+    def bootstrap_chunk(self, chunk, num_samples, model, residuals, weights, frequency, basis):
+        """
+            Resamples the residuals of one chunk of bootstraps onto the model and finds each resample's peak
+            Parameters:
+                        chunk: number of the chunk, seeding it
+                        num_samples: resamples in the chunk
+                        model: best fit sinusoid at each point
+                        residuals: flux minus the model
+                        weights: weight of each point
+                        frequency: window frequencies (1/day)
+                        basis: window basis from create_basis()
+            Returns:
+                        peak_frequency: frequency of each resample's peak (1/day)
+                        peak_amplitude: amplitude of each resample's peak
+        """
+        rng = np.random.default_rng(np.random.SeedSequence([self.seed, chunk]))
+
+        flux = model + residuals[rng.integers(0, len(residuals), (num_samples, len(residuals)))]
+        coefficients = self.fit_window(flux, weights, basis)
+
+        return self.find_peaks(frequency, np.hypot(coefficients[..., 1], coefficients[..., 2]))
+
+
+    def estimate(self, time, flux, weights, frequency):
+        """
+            Estimates the uncertainty of a periodogram peak's period and amplitude by bootstrapping the residuals
+            of the best fit sinusoid at the peak
+            Parameters:
+                        time: time data (days)
+                        flux: flux data
+                        weights: weight of each point (None if all are equal)
+                        frequency: frequency of the periodogram peak (1/day)
+            Returns:
+                        period_error: standard deviation of the bootstrapped periods (days)
+                        amplitude: amplitude of the peak
+                        amplitude_error: standard deviation of the bootstrapped amplitudes
+        """
+        time = np.asarray(time, dtype=float)
+        flux = np.asarray(flux, dtype=float)
+        weights = np.ones_like(time) if weights is None else np.asarray(weights, dtype=float)
+        weights = weights / weights.sum()
+
+        # Narrow window around the peak, centered on the data so the phases stay small
+        time = time - time.mean()
+        half_width = self.window_widths / (time.max() - time.min())
+        window = np.linspace(max(frequency - half_width, frequency / 2), frequency + half_width, self.window_points)
+        basis = self.create_basis(time, weights, window)
+
+        # Refined peak of the data, and the sinusoid at it
+        coefficients = self.fit_window(flux[None, :], weights, basis)
+        peak_frequency, peak_amplitude = self.find_peaks(window, np.hypot(coefficients[..., 1], coefficients[..., 2]))
+        offset, cos_amplitude, sin_amplitude = self.fit_window(flux[None, :], weights, self.create_basis(time, weights, peak_frequency))[0, 0]
+
+        angle = 2 * np.pi * peak_frequency[0] * time
+        model = offset + cos_amplitude * np.cos(angle) + sin_amplitude * np.sin(angle)
+        residuals = flux - model
+
+        # Chunks of resamples, bounding the (resamples x points) arrays, spread over the threads
+        chunk_size = max(1, self.chunk_elements // len(time))
+        sizes = [min(chunk_size, self.num_samples - start) for start in range(0, self.num_samples, chunk_size)]
+        results = list(self.get_executor().map(lambda chunk: self.bootstrap_chunk(chunk, sizes[chunk], model, residuals, weights,
+                                                                                  window, basis), range(len(sizes))))
+
+        periods = 1 / np.concatenate([peak_frequency for peak_frequency, _ in results])
+        amplitudes = np.concatenate([peak_amplitude for _, peak_amplitude in results])
+
+        return np.std(periods, ddof=1), np.hypot(cos_amplitude, sin_amplitude), np.std(amplitudes, ddof=1)
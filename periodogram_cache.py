@@ -0,0 +1,252 @@
+import astropy.units as u
+import numpy as np
+import os
+from os.path import exists
+
+from streaming_periodogram import *
+
+# Per frequency sums kept for each sector {name: row in the stored sums}
+FREQUENCY_SUMS = ['C', 'S', 'YC', 'YS', 'C2', 'S2']
+
+
+class PeriodogramCache(object):
+    def __init__(self, cache_dir, cadence, maximum_period=14, oversample_factor=10, grid_baseline=27.4,
+                 chunk_elements=1000000, refine_peaks=5):
+        self.cache_dir = cache_dir
+
+        # Fixed frequency grid (1/day), from 1 / maximum_period up to 1 / (2 * cadence), spaced as a lightkurve
+        # periodogram of a grid_baseline day lightcurve
+        self.minimum_frequency = 1 / maximum_period
+        self.maximum_frequency = 1 / (2 * cadence * u.second).to(u.day).value
+        self.oversample_factor = oversample_factor
+        self.frequency_spacing = 1 / (oversample_factor * grid_baseline)
+        self.frequency = np.arange(self.minimum_frequency, self.maximum_frequency, self.frequency_spacing)
+
+        # Highest peaks recalculated on lightkurve's finer grid, for stars observed over longer than grid_baseline
+        self.refine_peaks = refine_peaks
+
+        # Points x frequencies evaluated at a time, bounding memory
+        self.chunk_elements = chunk_elements
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+
+    def create_dir(self, name):
+        """
+            Creates the path of a star's stored sums
+            Parameters:
+                        name: catalog name of the star
+            Returns:
+                        path: path of the npz file
+        """
+        return os.path.join(self.cache_dir, f'{name}.npz')
+
+
+    def fingerprint(self, time, flux, weights):
+        """
+            Summarizes a sector's data, so reprocessed data is noticed
+            Parameters:
+                        time: time data of the sector (days)
+                        flux: flux data of the sector
+                        weights: weight of each point
+            Returns:
+                        fingerprint: (number of points, first time, last time, weighted flux sum)
+        """
+        return np.array([len(time), time[0], time[-1], np.dot(weights, flux)])
+
+
+    def sector_sums(self, time, flux, weights, frequency=None):
+        """
+            Calculates a sector's Lomb-Scargle sums on the frequency grid, a chunk of frequencies at a time
+            Parameters:
+                        time: time data of the sector (days)
+                        flux: flux data of the sector
+                        weights: weight of each point
+                        frequency: evenly spaced frequencies (1/day) to use instead of the stored grid
+            Returns:
+                        scalar_sums: [sum w, sum w y, sum w y^2]
+                        frequency_sums: (len(FREQUENCY_SUMS), number of frequencies) sums
+        """
+        if frequency is None:
+            frequency, frequency_spacing = self.frequency, self.frequency_spacing
+        else:
+            frequency_spacing = frequency[1] - frequency[0] if len(frequency) > 1 else 0.0
+
+        scalar_sums = np.array([weights.sum(), np.dot(weights, flux), np.dot(weights, flux * flux)])
+        frequency_sums = np.empty((len(FREQUENCY_SUMS), len(frequency)))
+
+        # Weight columns, so each chunk is one matrix product
+        weight_columns = np.stack([weights, weights * flux], axis=1)
+
+        # The grid is uniform, so exp(i w t) over a chunk is the chunk's first row times a fixed block of
+        # exp(i k dw t), avoiding a sine and cosine per point and frequency
+        chunk_size = max(1, self.chunk_elements // max(len(time), 1))
+        steps = np.exp(2j * np.pi * frequency_spacing * np.outer(np.arange(min(chunk_size, len(frequency))), time))
+
+        for start in range(0, len(frequency), chunk_size):
+            stop = min(start + chunk_size, len(frequency))
+            exp_omega_t = np.exp(2j * np.pi * frequency[start] * time) * steps[:stop - start]
+
+            sums = exp_omega_t @ weight_columns
+            frequency_sums[[0, 2], start:stop] = sums.real.T
+            frequency_sums[[1, 3], start:stop] = sums.imag.T
+
+            # Double angle sums, for the cos^2, sin^2 and cos sin terms
+            double_sums = (exp_omega_t * exp_omega_t) @ weights
+            frequency_sums[4, start:stop] = double_sums.real
+            frequency_sums[5, start:stop] = double_sums.imag
+
+        return scalar_sums, frequency_sums
+
+
+    def load(self, name):
+        """
+            Loads a star's stored sums, if they were made on the current frequency grid
+            Parameters:
+                        name: catalog name of the star
+            Returns:
+                        stored: {sector: (fingerprint, scalar sums, frequency sums)}
+        """
+        path = self.create_dir(name)
+        if not exists(path):
+            return {}
+
+        with np.load(path) as data:
+            if not np.array_equal(data['grid'], [self.minimum_frequency, self.frequency_spacing, len(self.frequency)]):
+                return {}
+
+            stored = {int(sector): (fingerprint, scalar_sums, frequency_sums.astype(np.float64))
+                      for sector, fingerprint, scalar_sums, frequency_sums
+                      in zip(data['sectors'], data['fingerprints'], data['scalar_sums'], data['frequency_sums'])}
+
+        return stored
+
+
+    def save(self, name, stored):
+        """
+            Atomically saves a star's sums, with the frequency sums as float32
+            Parameters:
+                        name: catalog name of the star
+                        stored: {sector: (fingerprint, scalar sums, frequency sums)}
+            Returns:
+                        None
+        """
+        sectors = sorted(stored)
+        path = self.create_dir(name)
+        tmp_path = path + '.tmp.npz'
+
+        np.savez(tmp_path,
+                 grid=np.array([self.minimum_frequency, self.frequency_spacing, len(self.frequency)]),
+                 sectors=np.array(sectors, dtype=np.int64),
+                 fingerprints=np.array([stored[sector][0] for sector in sectors]),
+                 scalar_sums=np.array([stored[sector][1] for sector in sectors]),
+                 frequency_sums=np.array([stored[sector][2] for sector in sectors], dtype=np.float32))
+
+        os.replace(tmp_path, path)
+
+
+    def get_sectors(self, name):
+        """
+            Gets the sectors a star's sums were stored for
+            Parameters:
+                        name: catalog name of the star
+            Returns:
+                        sectors: sorted list of sectors
+        """
+        path = self.create_dir(name)
+        if not exists(path):
+            return []
+
+        # Only read the grid and sectors, not the sums
+        with np.load(path) as data:
+            if not np.array_equal(data['grid'], [self.minimum_frequency, self.frequency_spacing, len(self.frequency)]):
+                return []
+
+            sectors = sorted(int(sector) for sector in data['sectors'])
+
+        return sectors
+
+
+    def update(self, name, segments):
+        """
+            Updates a star's periodogram, only calculating sums for sectors that are new or whose data changed
+            Parameters:
+                        name: catalog name of the star
+                        segments: {sector: (time, flux, weights)}
+            Returns:
+                        frequency: grid frequencies (1/day)
+                        power: amplitude at each grid frequency
+                        num_new: number of sectors whose sums were calculated
+        """
+        stored = self.load(name)
+        updated = {}
+        num_new = 0
+
+        for sector, (time, flux, weights) in segments.items():
+            fingerprint = self.fingerprint(time, flux, weights)
+
+            # Reuse sums of sectors whose data didn't change
+            if sector in stored and np.allclose(stored[sector][0], fingerprint, rtol=1e-9, atol=0):
+                updated[sector] = stored[sector]
+            else:
+                updated[sector] = (fingerprint, *self.sector_sums(time, flux, weights))
+                num_new += 1
+
+        if num_new or set(updated) != set(stored):
+            self.save(name, updated)
+
+        scalar_sums = sum(sums[1] for sums in updated.values())
+        frequency_sums = sum(sums[2] for sums in updated.values())
+        frequency, power = self.refine(segments, scalar_sums, lomb_scargle_amplitude(scalar_sums, frequency_sums))
+
+        return frequency, power, num_new
+
+
+    def refine(self, segments, scalar_sums, power):
+        """
+            Recalculates the highest peaks on the grid lightkurve would use for the star's whole time span, which is
+            finer than the stored grid once the star's sectors span more than grid_baseline days, so the peak period
+            and power match an uncached periodogram
+            Parameters:
+                        segments: {sector: (time, flux, weights)}
+                        scalar_sums: [sum w, sum w y, sum w y^2] of every sector
+                        power: amplitude at each stored grid frequency
+            Returns:
+                        frequency: stored grid frequencies, with lightkurve's finer grid around each peak (1/day)
+                        power: amplitude at each frequency
+        """
+        time_start = min(time.min() for time, _, _ in segments.values())
+        time_end = max(time.max() for time, _, _ in segments.values())
+        native_spacing = 1 / (self.oversample_factor * (time_end - time_start))
+
+        if native_spacing >= self.frequency_spacing or not self.refine_peaks:
+            return self.frequency, power
+
+        # Highest local maxima of the stored grid
+        is_peak = np.r_[False, (power[1:-1] > power[:-2]) & (power[1:-1] >= power[2:]), False]
+        peaks = np.flatnonzero(is_peak)
+        peaks = peaks[np.argsort(power[peaks])[::-1][:self.refine_peaks]]
+
+        # Frequencies of lightkurve's grid within a stored grid step of each peak
+        windows = []
+        for peak in peaks:
+            first = np.ceil((self.frequency[peak - 1] - self.minimum_frequency) / native_spacing)
+            last = np.floor((self.frequency[peak + 1] - self.minimum_frequency) / native_spacing)
+            windows.append(self.minimum_frequency + np.arange(first, last + 1) * native_spacing)
+
+        keep = np.ones(len(self.frequency), dtype=bool)
+        frequency, refined = [], []
+        for window in windows:
+            if not len(window):
+                continue
+
+            window_sums = sum(self.sector_sums(time, flux, weights, window)[1] for time, flux, weights in segments.values())
+            frequency.append(window)
+            refined.append(lomb_scargle_amplitude(scalar_sums, window_sums))
+            keep &= (self.frequency < window[0]) | (self.frequency > window[-1])
+
+        frequency = np.concatenate([self.frequency[keep]] + frequency)
+        power = np.concatenate([power[keep]] + refined)
+        order = np.argsort(frequency, kind='stable')
+
+        return frequency[order], power[order]
@@ -0,0 +1,448 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing as mp
+import numpy as np
+import threading
+import time
+
+from memory_guard import release_memory
+from preload_engine import init_worker
+from review_session import ReviewSession
+from run_ledger import *
+from stage_metrics import StageMetrics, set_metrics, star
+
+# Each worker's own periodogram cache
+worker_periodogram_cache = None
+
+# Each worker's own stage metrics recorder
+worker_metrics = None
+
+
+def compute_period(catalog_row, cadence, preload_settings, lightcurve_settings=None, periodogram_dir=None,
+                   metrics_settings=None):
+    """
+        Runs the analysis of one catalog row up to its period screen in a worker process
+        Parameters:
+                    catalog_row: row of the catalog dataframe
+                    cadence: desired cadence for lightcurves
+                    preload_settings: PreloadPlots arguments, from get_settings(), of a headless products instance
+                    lightcurve_settings: LightcurveData keyword arguments, other than the periodogram cache
+                    periodogram_dir: directory of the periodogram cache (None to not keep one)
+                    metrics_settings: StageMetrics arguments, from get_settings() (None to not record stages)
+        Returns:
+                    result: {'status', 'tic', 'error', 'sectors', and for computed stars 'row', 'products',
+                             'period_image', 'flare_inputs' and 'rss', the worker's memory in MB after releasing the
+                             star} (None if the star is unchanged since the last run)
+    """
+    global worker_periodogram_cache, worker_metrics
+    from preload_plots import PreloadPlots
+    from lightcurve_data import LightcurveData
+    from orb_calculator import OrbCalculator
+    from periodogram_cache import PeriodogramCache
+
+    if periodogram_dir and worker_periodogram_cache is None:
+        worker_periodogram_cache = PeriodogramCache(periodogram_dir, cadence)
+
+    if metrics_settings and worker_metrics is None:
+        worker_metrics = StageMetrics(**metrics_settings)
+        set_metrics(worker_metrics)
+
+    # Products are only rendered, never saved
+    preload_plots = PreloadPlots(**preload_settings)
+
+    with star(catalog_row['iau_name']) as outcome:
+        try:
+            # Get lightcurve data
+            lightcurve_data = LightcurveData(catalog_row, cadence, periodogram_cache=worker_periodogram_cache,
+                                             **(lightcurve_settings or {}))
+
+            # Keep the earlier results of stars with no new sectors
+            if lightcurve_data.unchanged:
+                return None
+
+            if not lightcurve_data.lightcurve:
+                outcome['status'] = FAILED if lightcurve_data.error else NO_DATA
+                return {'status': outcome['status'], 'tic': None, 'error': lightcurve_data.error,
+                        'sectors': lightcurve_data.sectors}
+
+            # Fit the period, leaving the flares for the effects stage
+            orb_calculator = OrbCalculator(lightcurve_data, preload_plots)
+            products = preload_plots.star_products.create_products(lightcurve_data, orb_calculator)
+
+            result = {
+                'status': COMPUTED,
+                'tic': lightcurve_data.name,
+                'error': None,
+                'sectors': lightcurve_data.sectors,
+                'row': preload_plots.create_preload_row(lightcurve_data),
+                'products': products,
+                'period_image': preload_plots.product_plots.render_products(products, ['Period'])['Period'],
+                'flare_inputs': (lightcurve_data.time, lightcurve_data.flux, lightcurve_data.flux_err,
+                                 lightcurve_data.flux - orb_calculator.sine_fit.best_fit)
+            }
+
+        except Exception:
+            outcome['status'] = FAILED
+            raise
+
+        finally:
+            # Release every figure and the heavy lightcurve objects before the next star
+            lightcurve_data = orb_calculator = None
+            rss = release_memory()
+
+        outcome['status'] = COMPUTED
+        result['rss'] = rss
+
+        return result
+
+
+def compute_effects(products, flare_inputs, effects, preload_settings):
+    """
+        Predicts a star's flares and renders its effects screens in a worker process
+        Parameters:
+                    products: star products from compute_period()
+                    flare_inputs: (time, flux, flux_err, residuals) of the star
+                    effects: effects to render
+                    preload_settings: PreloadPlots arguments, from get_settings(), of a headless products instance
+        Returns:
+                    images: {effect: RGBA image}
+    """
+    from preload_plots import PreloadPlots
+    from exoplanet_effects import predict_flares
+
+    preload_plots = PreloadPlots(**preload_settings)
+
+    try:
+        preload_plots.star_products.add_flares(products, predict_flares(*flare_inputs))
+
+        return preload_plots.product_plots.render_products(products, effects)
+
+    finally:
+        release_memory()
+
+
+class PipelinedReview(object):
+    def __init__(self, catalog_data, preload_plots, cadence, workers, ledger, lookahead=3, lightcurve_settings=None,
+                 periodogram_dir=None, metrics_settings=None, max_memory=None):
+        self.catalog_data = catalog_data
+        self.preload_plots = preload_plots
+        self.cadence = cadence
+        self.workers = workers
+        self.ledger = ledger
+        self.lookahead = lookahead # Stars analysed ahead of the one being reviewed
+        self.lightcurve_settings = lightcurve_settings or {} # LightcurveData keyword arguments
+        self.periodogram_dir = periodogram_dir # Directory of the periodogram cache (None to not keep one)
+        self.metrics_settings = metrics_settings # StageMetrics arguments of the workers (None to not record stages)
+        self.refresh = self.lightcurve_settings.get('refresh', False) # True to search finished stars again for new sectors
+        self.max_memory = max_memory # Memory in MB a worker may be left at after a star before the pool is recycled
+
+        # Workers render products headlessly, without saving them
+        self.worker_settings = dict(preload_plots.get_settings(), preload=True, products=True)
+
+        # Screens are shown the way a review session shows them
+        self.review_session = ReviewSession(preload_plots)
+
+        # Stars being analysed, in review order {iau_name: {'period': future, 'effects': future or None}}
+        self.pending = {}
+        self.rows = {} # {iau_name: catalog row} of the pending stars
+        self.crashes = {} # {iau_name: times a worker crashed while it was the star being reviewed}
+        self.answered = set() # Stars whose period was answered real before a crash lost their effects
+        self.lock = threading.Lock()
+        self.executor = None
+
+        # Seconds the reviewer waited on the workers, per star reviewed
+        self.waits = []
+
+
+    def create_executor(self):
+        """
+            Creates a process pool of headless workers
+            Parameters:
+                        None
+            Returns:
+                        executor: process pool executor
+        """
+        executor = ProcessPoolExecutor(max_workers = self.workers,
+                                       mp_context = mp.get_context('spawn'),
+                                       initializer = init_worker,
+                                       initargs = (mp.get_context('spawn').SimpleQueue(), None))
+
+        return executor
+
+
+    def submit(self, name, row):
+        """
+            Starts analysing a star up to its period screen, queueing its effects as soon as that finishes
+            Parameters:
+                        name: catalog name of the star
+                        row: row of the catalog dataframe
+            Returns:
+                        None
+        """
+        futures = {'period': None, 'effects': None}
+        self.pending[name] = futures
+        self.rows[name] = row
+
+        futures['period'] = self.executor.submit(compute_period, row, self.cadence, self.worker_settings,
+                                                 self.lightcurve_settings, self.periodogram_dir, self.metrics_settings)
+        futures['period'].add_done_callback(lambda future: self.submit_effects(name, future))
+
+
+    def submit_effects(self, name, future):
+        """
+            Queues the effects stage of a star whose period stage finished, if it isn't queued yet (called from the
+            executor's thread, or by the reviewer's if it gets there first)
+            Parameters:
+                        name: catalog name of the star
+                        future: finished future of the star's period stage
+            Returns:
+                        effects: future of the star's effects stage (None if the star has no effects to compute)
+        """
+        if future.cancelled() or future.exception() is not None:
+            return None
+
+        result = future.result()
+        if not result or result['status'] != COMPUTED:
+            return None
+
+        with self.lock:
+            # The reviewer may have already answered the star
+            futures = self.pending.get(name)
+            if futures is None or futures['period'] is not future or futures['effects'] is not None:
+                return futures and futures['effects'] or None
+
+            try:
+                futures['effects'] = self.executor.submit(compute_effects, result['products'], result['flare_inputs'],
+                                                          self.preload_plots.effects, self.worker_settings)
+            except RuntimeError:
+                # The pool was shut down
+                return None
+
+            return futures['effects']
+
+
+    def cancel(self, name):
+        """
+            Cancels the speculative work of a star and forgets it
+            Parameters:
+                        name: catalog name of the star
+            Returns:
+                        None
+        """
+        with self.lock:
+            futures = self.pending.pop(name, None)
+            self.rows.pop(name, None)
+            self.answered.discard(name)
+
+            # Mark the effects as taken, so a late period stage doesn't queue them
+            if futures is not None and futures['effects'] is None:
+                futures['effects'] = False
+
+        if futures:
+            for future in futures.values():
+                if future:
+                    future.cancel()
+
+
+    def restart(self, name):
+        """
+            Replaces a crashed process pool and analyses every pending star again, giving up on the star being
+            reviewed if it keeps crashing workers
+            Parameters:
+                        name: catalog name of the star being reviewed
+            Returns:
+                        None
+        """
+        self.crashes[name] = self.crashes.get(name, 0) + 1
+
+        if self.crashes[name] > 1:
+            print(f'Error for {name}: Worker crashed \n')
+            self.cancel(name)
+            self.ledger.update(name, FAILED, error='Worker crashed')
+
+        print(f'A worker crashed, restarting the {len(self.pending)} pending stars ...')
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = self.create_executor()
+
+        for retry, row in list(self.rows.items()):
+            self.submit(retry, row)
+
+
+    def recycle(self):
+        """
+            Hands new stars to a fresh process pool, letting the old pool finish the stars it already has and exit
+            Parameters:
+                        None
+            Returns:
+                        None
+        """
+        print(f'\nA worker is over max_memory ({self.max_memory} MB) after a star, recycling the workers ...')
+
+        with self.lock:
+            executor, self.executor = self.executor, self.create_executor()
+
+        executor.shutdown(wait=False)
+
+
+    def wait(self, future):
+        """
+            Waits for a stage of the star being reviewed, adding the time blocked to the star's wait
+            Parameters:
+                        future: future of the stage
+            Returns:
+                        result: result of the stage
+        """
+        start = time.perf_counter()
+
+        try:
+            return future.result()
+        finally:
+            self.waits[-1] += time.perf_counter() - start
+
+
+    def review(self, name, result):
+        """
+            Shows the screens of an analysed star, keeping its results if the reviewer says the period is real
+            Parameters:
+                        name: catalog name of the star
+                        result: result of the star's period stage
+            Returns:
+                        status: run ledger status the star ended in (None if the reviewer closed the window)
+        """
+        # A star analysed again after a crash isn't asked its period twice
+        answers = {'Period': True if name in self.answered else self.review_session.show(result['period_image'])}
+
+        if answers['Period'] is None:
+            return None
+
+        # Drop the star's effects, queued or running, if the period isn't real
+        if not answers['Period']:
+            print('Period is not real, loading next plot ... \n')
+            self.cancel(name)
+            return REVIEWED
+
+        self.answered.add(name)
+
+        # Usually queued the moment the period stage finished
+        effects = self.submit_effects(name, self.pending[name]['period'])
+        if effects is None:
+            raise RuntimeError('Effects could not be queued')
+
+        images = self.wait(effects)
+
+        for effect in self.preload_plots.effects:
+            answers[effect] = self.review_session.show(images[effect])
+
+            if answers[effect] is None:
+                return None
+
+        self.preload_plots.add_result(result['row'], answers)
+
+        return SAVED
+
+
+    def log_waits(self):
+        """
+            Prints how long the reviewer waited on the workers per star
+            Parameters:
+                        None
+            Returns:
+                        None
+        """
+        if not self.waits:
+            return
+
+        p50, p95 = np.percentile(self.waits, [50, 95])
+        print(f'Waited on the workers for {np.mean(self.waits):.2f} s per star (p50 {p50:.2f} s, p95 {p95:.2f} s) over '
+              f'{len(self.waits)} stars')
+
+
+    def run(self):
+        """
+            Reviews the catalog in order while the next few stars are analysed in the background
+            Parameters:
+                        None
+            Returns:
+                        None
+        """
+        statuses = self.ledger.get_statuses()
+        rows = ((row['iau_name'], row) for _, row in self.catalog_data.catalog_df.iterrows()
+                if not self.ledger.is_done(statuses[row['iau_name']], False, self.refresh))
+        self.executor = self.create_executor()
+
+        try:
+            while True:
+                # Keep the next few stars analysing, claiming each before it's started
+                for name, row in rows:
+                    if self.ledger.claim(name):
+                        self.submit(name, row)
+
+                    if len(self.pending) > self.lookahead:
+                        break
+
+                if not self.pending:
+                    break
+
+                name = next(iter(self.pending))
+                self.waits.append(0.0)
+
+                try:
+                    result = self.wait(self.pending[name]['period'])
+                except BrokenProcessPool:
+                    self.waits.pop()
+                    self.restart(name)
+                    continue
+                except Exception as e:
+                    print(f'Error for {name}: {e} \n')
+                    self.cancel(name)
+                    self.ledger.update(name, FAILED, error=repr(e))
+                    continue
+
+                # Stars with no new sectors keep their earlier status
+                if result is None:
+                    self.cancel(name)
+                    self.ledger.release(name)
+                    self.waits.pop()
+                    continue
+
+                # Workers left over the ceiling are replaced once they finish the stars they have
+                if self.max_memory and result.get('rss') and result['rss'] > self.max_memory:
+                    self.recycle()
+
+                if result['status'] != COMPUTED:
+                    self.cancel(name)
+                    self.ledger.update(name, result['status'], error=result['error'], sectors=result['sectors'])
+                    self.waits.pop()
+                    continue
+
+                try:
+                    status = self.review(name, result)
+                except BrokenProcessPool:
+                    # The star's effects were lost with the pool, so it's analysed again with the rest
+                    self.waits.pop()
+                    self.restart(name)
+                    continue
+                except Exception as e:
+                    print(f'Error for {name}: {e} \n')
+                    self.cancel(name)
+                    self.ledger.update(name, FAILED, result['tic'], repr(e), result['sectors'])
+                    continue
+
+                # Reviewer closed the window, so stop here and resume later
+                if status is None:
+                    print('Review paused, run again to resume')
+                    self.waits.pop()
+                    break
+
+                self.cancel(name)
+                self.preload_plots.results_store.flush()
+                self.ledger.update(name, status, result['tic'], sectors=result['sectors'])
+
+        finally:
+            # Give back the stars that were analysed ahead but never reviewed
+            for name in list(self.pending):
+                self.cancel(name)
+                self.ledger.release(name)
+
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.log_waits()
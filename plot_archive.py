@@ -0,0 +1,285 @@
+import argparse
+from io import BytesIO
+import json
+import matplotlib.image as mpimg
+import numpy as np
+import os
+from os.path import exists
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # No cross-process locking on windows
+
+
+class PlotArchive(object):
+    def __init__(self, archive_dir, image_format='png', dpi=None, quality=80):
+        self.archive_dir = archive_dir
+
+        # Encoding of new plots
+        self.image_format = image_format # 'png' or 'webp'
+        self.dpi = dpi # None keeps the figure's dpi
+        self.quality = quality # WebP quality
+
+        # Packed plots and their index
+        self.data_dir = os.path.join(self.archive_dir, 'plots.pack')
+        self.index_dir = os.path.join(self.archive_dir, 'plots.idx')
+
+        # Index of every plot {(tic, plot type): (offset, length, format)}
+        self.index = {}
+        self.index_position = 0 # Bytes of the index file already read
+
+        # Load the existing index
+        os.makedirs(self.archive_dir, exist_ok=True)
+        self.refresh()
+
+
+    def refresh(self):
+        """
+            Reads any index entries appended since the last read (possibly by other processes)
+            Parameters:
+                        None
+            Returns:
+                        None
+        """
+        if not exists(self.index_dir):
+            return
+
+        with open(self.index_dir, 'rb') as f:
+            f.seek(self.index_position)
+
+            for line in f:
+                # Stop at a partially written entry
+                if not line.endswith(b'\n'):
+                    break
+
+                entry = json.loads(line)
+                self.index[(entry['tic'], entry['plot_type'])] = (entry['offset'], entry['length'], entry['format'])
+                self.index_position += len(line)
+
+
+    def exists(self, plot_type, tic):
+        """
+            Checks if a plot is in the archive
+            Parameters:
+                        plot_type: 'Period' or an effect
+                        tic: TIC name of the star
+            Returns:
+                        boolean: True if the plot exists
+        """
+        if (tic, plot_type) not in self.index:
+            self.refresh()
+
+        return (tic, plot_type) in self.index
+
+
+    def add(self, plot_type, tic, data, image_format):
+        """
+            Appends an encoded plot to the archive, and then its entry to the index, under an exclusive lock
+            Parameters:
+                        plot_type: 'Period' or an effect
+                        tic: TIC name of the star
+                        data: encoded image bytes
+                        image_format: format of the encoded image
+            Returns:
+                        None
+        """
+        with open(self.data_dir, 'ab') as data_file:
+            # Only one process appends at a time
+            if fcntl:
+                fcntl.flock(data_file, fcntl.LOCK_EX)
+
+            try:
+                offset = data_file.seek(0, os.SEEK_END)
+                data_file.write(data)
+                data_file.flush()
+
+                # The plot is only visible once its index entry is written
+                entry = {'tic': tic, 'plot_type': plot_type, 'offset': offset, 'length': len(data), 'format': image_format}
+                with open(self.index_dir, 'a') as index_file:
+                    index_file.write(json.dumps(entry) + '\n')
+
+            finally:
+                if fcntl:
+                    fcntl.flock(data_file, fcntl.LOCK_UN)
+
+        self.index[(tic, plot_type)] = (offset, len(data), image_format)
+
+
+    def save_figure(self, fig, plot_type, tic):
+        """
+            Encodes a figure and appends it to the archive
+            Parameters:
+                        fig: matplotlib figure
+                        plot_type: 'Period' or an effect
+                        tic: TIC name of the star
+            Returns:
+                        None
+        """
+        buffer = BytesIO()
+
+        if self.image_format == 'webp':
+            fig.savefig(buffer, format='webp', dpi=self.dpi, pil_kwargs={'quality': self.quality})
+        else:
+            fig.savefig(buffer, format='png', dpi=self.dpi)
+
+        self.add(plot_type, tic, buffer.getvalue(), self.image_format)
+
+
+    def read(self, plot_type, tic):
+        """
+            Reads the encoded bytes of a plot
+            Parameters:
+                        plot_type: 'Period' or an effect
+                        tic: TIC name of the star
+            Returns:
+                        data: encoded image bytes
+                        image_format: format of the encoded image
+        """
+        if not self.exists(plot_type, tic):
+            raise KeyError(f'No {plot_type} plot for {tic} in {self.data_dir}')
+
+        offset, length, image_format = self.index[(tic, plot_type)]
+
+        with open(self.data_dir, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+
+        return data, image_format
+
+
+    def read_image(self, plot_type, tic):
+        """
+            Reads and decodes a plot
+            Parameters:
+                        plot_type: 'Period' or an effect
+                        tic: TIC name of the star
+            Returns:
+                        img: image array
+        """
+        data, image_format = self.read(plot_type, tic)
+
+        # Matplotlib only decodes png itself
+        if image_format == 'png':
+            return mpimg.imread(BytesIO(data), format='png')
+
+        from PIL import Image
+        return np.asarray(Image.open(BytesIO(data)))
+
+
+    def get_tics(self, plot_type='Period'):
+        """
+            Gets the TIC name of every star with a given plot, in the order they were added
+            Parameters:
+                        plot_type: 'Period' or an effect
+            Returns:
+                        tics: list of TIC names
+        """
+        self.refresh()
+
+        tics = [tic for tic, saved_type in self.index if saved_type == plot_type]
+
+        return tics
+
+
+    def export(self, out_dir, create_dir):
+        """
+            Writes every plot in the archive out as a loose file, for sharing
+            Parameters:
+                        out_dir: directory to write the plots to
+                        create_dir: function(plot_type, tic) giving a plot's relative file name
+            Returns:
+                        num_exported: number of plots written
+        """
+        self.refresh()
+
+        num_exported = 0
+        for tic, plot_type in self.index:
+            data, image_format = self.read(plot_type, tic)
+
+            # Keep the loose file names, with the archive's extension
+            plot_dir = os.path.join(out_dir, os.path.splitext(create_dir(plot_type, tic))[0] + '.' + image_format)
+            os.makedirs(os.path.dirname(plot_dir), exist_ok=True)
+
+            with open(plot_dir, 'wb') as f:
+                f.write(data)
+
+            num_exported += 1
+
+        return num_exported
+
+
+    def merge(self, archive_dir):
+        """
+            Appends every plot of another archive (e.g. a shard's) that this one doesn't have
+            Parameters:
+                        archive_dir: directory of the other archive
+            Returns:
+                        num_merged: number of plots added
+        """
+        other = PlotArchive(archive_dir)
+
+        num_merged = 0
+        for tic, plot_type in other.index:
+            if self.exists(plot_type, tic):
+                continue
+
+            self.add(plot_type, tic, *other.read(plot_type, tic))
+            num_merged += 1
+
+        return num_merged
+
+
+    def pack(self, plot_dirs):
+        """
+            Adds existing loose plot files into the archive
+            Parameters:
+                        plot_dirs: {plot type: (directory, file suffix)} of the loose plots
+            Returns:
+                        num_packed: number of plots added
+        """
+        num_packed = 0
+        for plot_type, (plot_dir, suffix) in plot_dirs.items():
+            if not exists(plot_dir):
+                continue
+
+            for file in sorted(os.listdir(plot_dir)):
+                if not file.startswith('TIC') or not file.endswith(suffix):
+                    continue
+
+                tic = file.replace(suffix, '')
+                if self.exists(plot_type, tic):
+                    continue
+
+                with open(os.path.join(plot_dir, file), 'rb') as f:
+                    self.add(plot_type, tic, f.read(), os.path.splitext(file)[1][1:])
+
+                num_packed += 1
+
+        return num_packed
+
+
+if __name__ == '__main__':
+    from preload_plots import PreloadPlots
+
+    parser = argparse.ArgumentParser(description='Packs loose preload plots into the plot archive, or exports them back out')
+    parser.add_argument('command', choices=['export', 'pack'])
+    parser.add_argument('--archive', default='preload/', help='directory of the plot archive')
+    parser.add_argument('--out', default='exported_plots/', help='directory to export loose plots to')
+    parser.add_argument('--plots', default=None, help='preload directory holding the loose plot directories to pack '
+                                                      '(default the archive directory)')
+    args = parser.parse_args()
+
+    archive = PlotArchive(args.archive)
+
+    # Loose file names are the same as the old preload directories, under the run's own preload directory
+    preload_plots = PreloadPlots(False, None, preload_dir=os.path.join(args.plots or args.archive, ''))
+
+    if args.command == 'export':
+        num_plots = archive.export(args.out, lambda plot_type, tic: os.path.relpath(preload_plots.create_dir(plot_type, tic), preload_plots.preload_dir))
+        print(f'Exported {num_plots} plots to {args.out}')
+    else:
+        plot_dirs = {plot_type: os.path.split(preload_plots.create_dir(plot_type, ''))
+                     for plot_type in ['Period'] + preload_plots.effects}
+        num_plots = archive.pack(plot_dirs)
+        print(f'Packed {num_plots} plots into {archive.data_dir}')
@@ -0,0 +1,334 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing as mp
+import os
+from tqdm import tqdm
+
+from memory_guard import release_memory
+from run_ledger import *
+from stage_metrics import StageMetrics, set_metrics, star
+
+# Queue the workers report started stars on (set by init_worker)
+started_stars = None
+
+# Each worker's own connection to the run ledger
+worker_ledger = None
+
+# Each worker's own periodogram cache
+worker_periodogram_cache = None
+
+# Each worker's own stage metrics recorder
+worker_metrics = None
+
+
+def init_worker(started_queue, worker_memory):
+    """
+        Initializes a preload worker process, forcing the headless Agg backend and optionally capping the
+        worker's address space
+        Parameters:
+                    started_queue: queue to report started stars on
+                    worker_memory: maximum memory per worker in MB (None for no limit)
+        Returns:
+                    None
+    """
+    global started_stars
+    started_stars = started_queue
+
+    # Draw figures without a display
+    os.environ['MPLBACKEND'] = 'Agg'
+    import matplotlib
+    matplotlib.use('Agg')
+
+    # Cap the memory of the worker (only available on unix)
+    if worker_memory:
+        try:
+            import resource
+            limit = int(worker_memory * 1024 ** 2)
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        except (ImportError, ValueError, OSError) as e:
+            print(f'Could not limit worker memory: {e}')
+
+
+def preload_star(index, catalog_row, cadence, preload_settings, ledger_dir, lightcurve_settings=None, periodogram_dir=None,
+                 metrics_settings=None):
+    """
+        Runs the full analysis for one catalog row in a worker process, saving the plots (or products) of the star
+        Parameters:
+                    index: index of the row in the catalog dataframe
+                    catalog_row: row of the catalog dataframe
+                    cadence: desired cadence for lightcurves
+                    preload_settings: PreloadPlots arguments, from get_settings()
+                    ledger_dir: path of the run ledger
+                    lightcurve_settings: LightcurveData keyword arguments, other than the periodogram cache
+                    periodogram_dir: directory of the periodogram cache (None to not keep one)
+                    metrics_settings: StageMetrics arguments, from get_settings() (None to not record stages)
+        Returns:
+                    row: preload row of the star (None if there was no lightcurve, or another process has it)
+                    sectors: number of sectors at the cadence (None if the search failed)
+                    failure: error text if the star's analysis raised (None if it didn't)
+                    rss: resident memory of the worker in MB after releasing the star (None if it can't be read)
+    """
+    global worker_ledger, worker_periodogram_cache, worker_metrics
+    from preload_plots import PreloadPlots
+    from lightcurve_data import LightcurveData
+    from orb_calculator import OrbCalculator
+    from exoplanet_effects import ExoplanetEffects
+    from periodogram_cache import PeriodogramCache
+
+    # Let the main process know which star this worker is on, in case it crashes
+    started_stars.put(index)
+
+    # Connect to the run ledger once per worker
+    if worker_ledger is None:
+        worker_ledger = RunLedger(ledger_dir)
+
+    if periodogram_dir and worker_periodogram_cache is None:
+        worker_periodogram_cache = PeriodogramCache(periodogram_dir, cadence)
+
+    if metrics_settings and worker_metrics is None:
+        worker_metrics = StageMetrics(**metrics_settings)
+        set_metrics(worker_metrics)
+
+    # Skip stars another process is working on
+    name = catalog_row['iau_name']
+    if not worker_ledger.claim(name): return None, None, None, None
+
+    # Workers only ever save plots
+    preload_plots = PreloadPlots(**preload_settings)
+
+    # Only the preload row and these are kept once the star is done, the heavy objects are dropped before releasing
+    row, status, tic, error, sectors, failure = None, None, None, None, None, None
+    lightcurve_data = orb_calculator = exoplanet_effects = None
+
+    # Measure the star's stages (nothing is recorded without metrics settings)
+    with star(name) as outcome:
+        try:
+            # Get lightcurve data
+            lightcurve_data = LightcurveData(catalog_row, cadence, periodogram_cache=worker_periodogram_cache, 
+                                             **(lightcurve_settings or {}))
+            sectors = lightcurve_data.sectors
+
+            # Stars with no new sectors keep their earlier results, and stars with no lightcurve have none
+            if not lightcurve_data.unchanged and lightcurve_data.lightcurve:
+                # Save period and effects plots
+                orb_calculator = OrbCalculator(lightcurve_data, preload_plots)
+                exoplanet_effects = ExoplanetEffects(lightcurve_data, orb_calculator, preload_plots)
+
+                if preload_plots.products:
+                    preload_plots.save_products(lightcurve_data, orb_calculator, exoplanet_effects)
+
+                row = preload_plots.create_preload_row(lightcurve_data)
+                status, tic = COMPUTED, lightcurve_data.name
+
+            elif not lightcurve_data.unchanged:
+                status, error = (FAILED if lightcurve_data.error else NO_DATA), lightcurve_data.error
+
+        except Exception as e:
+            # Returned rather than raised, so the worker's memory is still reported
+            row, status, tic, error = None, FAILED, None, repr(e)
+            failure = error
+
+        finally:
+            # Release every figure and the heavy lightcurve objects before the next star
+            lightcurve_data = orb_calculator = exoplanet_effects = None
+            rss = release_memory()
+
+        outcome['status'] = status
+
+    # Computed stars are marked by the main process, once their row is in the results store
+    if status is None:
+        worker_ledger.release(name)
+    elif status != COMPUTED:
+        worker_ledger.update(name, status, tic, error, sectors)
+
+    return row, sectors, failure, rss
+
+
+class PreloadEngine(object):
+    def __init__(self, catalog_data, preload_plots, cadence, workers, ledger,
+                 max_tasks_per_worker=25, worker_memory=None, max_retries=1, lightcurve_settings=None,
+                 periodogram_dir=None, metrics_settings=None, max_memory=None, queued_per_worker=2):
+        self.catalog_data = catalog_data
+        self.preload_plots = preload_plots
+        self.cadence = cadence
+        self.lightcurve_settings = lightcurve_settings or {} # LightcurveData keyword arguments
+        self.periodogram_dir = periodogram_dir # Directory of the periodogram cache (None to not keep one)
+        self.metrics_settings = metrics_settings # StageMetrics arguments of the workers (None to not record stages)
+        self.refresh = self.lightcurve_settings.get('refresh', False) # True to search finished stars again for new sectors
+        self.workers = workers
+        self.ledger = ledger
+
+        # Worker limits
+        self.max_tasks_per_worker = max_tasks_per_worker # Recycle workers after this many stars
+        self.worker_memory = worker_memory # Memory cap per worker in MB
+        self.max_retries = max_retries # Times a star is retried after crashing its worker
+        self.max_memory = max_memory # Memory in MB a worker may be left at after a star before the pool is recycled
+        self.queued_per_worker = queued_per_worker # Stars handed to the pool ahead of the workers, per worker
+
+        # Track stars that could not be processed
+        self.failed = {} # {iau_name: error}
+
+
+    def create_executor(self, workers, started_queue):
+        """
+            Creates a process pool of headless workers
+            Parameters:
+                        workers: number of worker processes
+                        started_queue: queue the workers report started stars on
+            Returns:
+                        executor: process pool executor
+        """
+        executor = ProcessPoolExecutor(max_workers = workers,
+                                       mp_context = mp.get_context('spawn'),
+                                       initializer = init_worker,
+                                       initargs = (started_queue, self.worker_memory),
+                                       max_tasks_per_child = self.max_tasks_per_worker)
+
+        return executor
+
+
+    def drain(self, started_queue):
+        """
+            Empties the queue of started stars
+            Parameters:
+                        started_queue: queue the workers report started stars on
+            Returns:
+                        started: set of catalog indices that were started
+        """
+        started = set()
+
+        while not started_queue.empty():
+            started.add(started_queue.get())
+
+        return started
+
+
+    def process(self, pending, workers, started_queue, progress):
+        """
+            Runs the pending catalog rows on a fresh process pool, streaming finished rows into the preload data csv. Only
+            a few stars per worker are handed to the pool at a time, and once a worker is left over max_memory no more
+            are, so the pool can be replaced with fresh workers
+            Parameters:
+                        pending: {catalog index: catalog row} still to be processed, finished rows are removed
+                        workers: number of worker processes
+                        started_queue: queue the workers report started stars on
+                        progress: tqdm progress bar
+            Returns:
+                        suspects: catalog indices that were running when a worker crashed (empty if none crashed, or
+                                  the pool is to be recycled with rows still pending)
+        """
+        executor = self.create_executor(workers, started_queue)
+        queued = iter(list(pending.items()))
+        futures = {}
+        recycle = False
+
+        try:
+            while True:
+                # Keep a few stars per worker queued, until the pool needs recycling
+                while not recycle and len(futures) < workers * self.queued_per_worker:
+                    index, catalog_row = next(queued, (None, None))
+                    if catalog_row is None:
+                        break
+
+                    futures[executor.submit(preload_star, index, catalog_row, self.cadence,
+                                            self.preload_plots.get_settings(), self.ledger.ledger_dir, self.lightcurve_settings,
+                                            self.periodogram_dir, self.metrics_settings)] = index
+
+                if not futures:
+                    break
+
+                future = next(as_completed(futures))
+                index = futures.pop(future)
+
+                try:
+                    row, sectors, failure, rss = future.result()
+                except BrokenProcessPool:
+                    raise
+                except Exception as e:
+                    row, sectors, failure, rss = None, None, repr(e), None
+
+                if failure:
+                    self.failed[pending[index]['iau_name']] = failure
+
+                # Only the main process writes to the results store, and a star is only marked computed once its row
+                # is written, so a run stopped in between preloads it again
+                if row:
+                    self.preload_plots.write_preload_row(row)
+                    self.preload_plots.results_store.flush()
+                    self.ledger.update(pending[index]['iau_name'], COMPUTED, row['TIC'], sectors=sectors)
+
+                # Let the queued stars finish, then start again with fresh workers
+                if self.max_memory and rss and rss > self.max_memory and not recycle:
+                    print(f'\nA preload worker is at {rss:.0f} MB after a star, over max_memory ({self.max_memory} MB), '
+                          f'recycling the workers ...')
+                    recycle = True
+
+                del pending[index]
+                progress.update(1)
+                progress.set_postfix(failed = len(self.failed))
+
+        except BrokenProcessPool:
+            # Only the stars that had started can have crashed the worker
+            suspects = self.drain(started_queue) & set(pending)
+
+            # The crashed worker never released its claims
+            for index in suspects:
+                self.ledger.release(pending[index]['iau_name'], any_worker=True)
+
+            return suspects or set(pending)
+
+        finally:
+            executor.shutdown(wait = True, cancel_futures = True)
+            self.drain(started_queue)
+
+        return set()
+
+
+    def run(self):
+        """
+            Spreads the catalog rows across the process pool, isolating any star that crashes a worker
+            Parameters:
+                        None
+            Returns:
+                        None
+        """
+        # Every row still to be processed (skipping stars finished by a previous run), and how many times it 
+        # crashed a worker on its own
+        statuses = self.ledger.get_statuses()
+        pending = {index: row for index, row in self.catalog_data.catalog_df.iterrows()
+                   if not self.ledger.is_done(statuses[row['iau_name']], True, self.refresh)}
+        crashes = {index: 0 for index in pending}
+        suspects = set()
+        started_queue = mp.get_context('spawn').SimpleQueue() # Unbuffered, so survives a crash
+
+        with tqdm(total = len(pending), desc = 'Preloading lightcurves') as progress:
+            while pending:
+                # Process everything on the full pool
+                if not suspects:
+                    suspects = self.process(pending, self.workers, started_queue, progress)
+
+                    if suspects:
+                        print(f'\nA preload worker crashed, rerunning {len(suspects)} stars on their own ...')
+
+                    continue
+
+                # Rerun a suspect on its own, so a crash can be pinned on it
+                index = suspects.pop()
+                if not self.process({index: pending[index]}, 1, started_queue, progress):
+                    del pending[index]
+                    continue
+
+                crashes[index] += 1
+
+                # Give up on stars that keep crashing workers
+                if crashes[index] > self.max_retries:
+                    self.failed[pending[index]['iau_name']] = 'Worker crashed'
+                    self.ledger.update(pending[index]['iau_name'], FAILED, error='Worker crashed')
+                    del pending[index]
+                    progress.update(1)
+                    progress.set_postfix(failed = len(self.failed))
+                else:
+                    suspects.add(index)
+
+        if self.failed:
+            print(f'{len(self.failed)} stars failed to preload')
@@ -1,26 +1,39 @@
-import csv
 import math
 import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
 import numpy as np
-import os
-from os.path import exists
-import pandas as pd
+
+from plot_archive import *
+from review_session import *
+from star_products import *
+from product_plots import *
+from stage_metrics import timed
 
 
 class PreloadPlots(object):
-    def __init__(self, preload, porb_dir):
+    def __init__(self, preload, porb_dir, products=False, plot_format='png', plot_dpi=None, results_store=None,
+                 preload_dir='preload/'):
         self.preload = preload
 
+        # Store preload rows and reviewed results are written to (not needed by preload workers)
+        self.results_store = results_store
+
+        # True if preload saves the numerical products of each star, to be rendered at review, instead of plots
+        self.products = products
+
+        # Encoding of packed plots
+        self.plot_format = plot_format # 'png' or 'webp'
+        self.plot_dpi = plot_dpi # None keeps the figure's dpi
+
         # Final data directory
         self.porb_dir = porb_dir
 
-        # Plot directories
-        self.preload_dir = 'preload/'
+        # Plot directories (preload_dir ends in '/', and differs per shard)
+        self.preload_dir = preload_dir
         self.doppler_dir = self.preload_dir + 'doppler_plots/'
         self.eclipsing_dir = self.preload_dir + 'eclipsing_plots/' 
         self.flare_dir = self.preload_dir + 'flare_plots/'     
         self.period_dir = self.preload_dir + 'period_plots/' 
+        self.products_dir = self.preload_dir + 'products/'
 
         # Preload data directories
         self.preload_data_dir = self.preload_dir + 'preload_data.csv'
@@ -28,11 +41,32 @@ class PreloadPlots(object):
         # Lightcurve effects
         self.effects = ['Doppler beaming', 'Eclipsing', 'Flares']
 
-        # Initialize a boolean to determine if the period is real
-        self.is_real_period = False
+        # Product store and its renderer, or the packed plot archive
+        if self.preload and self.products:
+            self.star_products = StarProducts(self.products_dir)
+            self.product_plots = ProductPlots(self.star_products)
+        elif self.preload:
+            self.plot_archive = PlotArchive(self.preload_dir, self.plot_format, self.plot_dpi)
+
+
+    def get_settings(self):
+        """
+            Gets the arguments this instance was created with, so worker processes can recreate it
+            Parameters:
+                        None
+            Returns:
+                        settings: dictionary of PreloadPlots arguments
+        """
+        settings = {
+            'preload': self.preload,
+            'porb_dir': self.porb_dir,
+            'products': self.products,
+            'plot_format': self.plot_format,
+            'plot_dpi': self.plot_dpi,
+            'preload_dir': self.preload_dir
+        }
 
-        # List of effects found in the lightcurve data
-        self.effects_found = [] # [Eclipsing, Doppler beaming, Flares, Irradiation, Ellipsodial]
+        return settings
 
 
     def create_preload_row(self, lightcurve_data):
@@ -42,6 +76,11 @@ class PreloadPlots(object):
         row = {
             'TIC': lightcurve_data.name,
             'Orbital period (days)': lightcurve_data.period_at_max_power,
+            'Orbital period error (days)': lightcurve_data.period_error,
+            'Amplitude': lightcurve_data.amplitude,
+            'Amplitude error': lightcurve_data.amplitude_error,
+            'Consensus period (days)': lightcurve_data.consensus_period,
+            'Consensus score': lightcurve_data.consensus_score,
             'Literature period (days)': lightcurve_data.lit_period, 
             'i Magnitude': lightcurve_data.imag,
         }
@@ -49,39 +88,81 @@ class PreloadPlots(object):
         return row
     
 
-    def create_row(self, row):
+    def create_row(self, record, answers):
         """
-            
+            Creates a row of a reviewed star to be added to the results store
+            Parameters:
+                        record: preload row of the star
+                        answers: {screen: True/False} reviewer answers of the star
+            Returns:
+                        row: row of the star
         """
+        irradiation, ellipsoidal = self.irradiation_ellipsodial_check(record)
+
         row = {
-            'TIC': row['TIC'].values[0],
-            'Orbital period (days)': row['Orbital period (days)'].values[0],
-            'Literature period (days)': row['Literature period (days)'].values[0], 
-            'i Magnitude': row['i Magnitude'].values[0],
-            'Eclipsing': self.effects_found[0],
-            'Doppler beaming': self.effects_found[1],
-            'Flares': self.effects_found[2],
-            'Irradiation': self.effects_found[3],
-            'Ellipsoidal': self.effects_found[4]
+            'TIC': record['TIC'],
+            'Orbital period (days)': record['Orbital period (days)'],
+            'Orbital period error (days)': record.get('Orbital period error (days)'),
+            'Amplitude': record.get('Amplitude'),
+            'Amplitude error': record.get('Amplitude error'),
+            'Consensus period (days)': record.get('Consensus period (days)'),
+            'Consensus score': record.get('Consensus score'),
+            'Literature period (days)': record['Literature period (days)'], 
+            'i Magnitude': record['i Magnitude'],
+            'Eclipsing': answers['Eclipsing'],
+            'Doppler beaming': answers['Doppler beaming'],
+            'Flares': answers['Flares'],
+            'Irradiation': irradiation,
+            'Ellipsoidal': ellipsoidal
         }
 
         return row
 
 
+    @timed('save_plot')
     def save_plot(self, plot_type, tic):
         """
             
         """
-        # Get plot directory
-        plot_dir = self.create_dir(plot_type, tic)
-
-        # Check if directory exists
-        if not exists(plot_dir):
-            plt.savefig(plot_dir)
-            plt.close()
+        # Check if the plot is already in the archive
+        if not self.plot_archive.exists(plot_type, tic):
+            self.plot_archive.save_figure(plt.gcf(), plot_type, tic)
         else:
             print(f'{plot_type} plot already exists for {tic}')
 
+        plt.close()
+
+
+    @timed('save_products')
+    def save_products(self, lightcurve_data, orb_calculator, exoplanet_effects):
+        """
+            Saves the numerical products the star's plots are rendered from at review
+            Parameters:
+                        lightcurve_data: LightcurveData of the star
+                        orb_calculator: OrbCalculator of the star
+                        exoplanet_effects: ExoplanetEffects of the star
+            Returns:
+                        None
+        """
+        products = self.star_products.create_products(lightcurve_data, orb_calculator, exoplanet_effects.flare_predictions)
+        self.star_products.save(lightcurve_data.name, products)
+
+
+    def load_images(self, tic):
+        """
+            Loads a star's period and effects plots, either rendered from its products or read from the plot archive
+            Parameters:
+                        tic: TIC name of the star
+            Returns:
+                        images: {plot type: image array}
+        """
+        if self.products:
+            return self.product_plots.render(tic, self.effects)
+
+        images = {plot_type: self.plot_archive.read_image(plot_type, tic) for plot_type in ['Period'] + self.effects}
+
+        return images
+
 
     def create_dir(self, plot_type, tic):
         """
@@ -102,190 +183,81 @@ class PreloadPlots(object):
         return plot_dir
     
 
+    @timed('save_period')
     def save_period(self, lightcurve_data):
         """
             
         """
-        # See if file already exists
-        file_exists = exists(self.preload_data_dir)
-
         # Create the row
         row = self.create_preload_row(lightcurve_data)
-        
-        # Open file in append mode
-        with open(self.preload_data_dir, 'a', newline='') as csvfile:
-            fieldnames = [
-                'TIC', 
-                'Orbital period (days)', 
-                'Literature period (days)', 
-                'i Magnitude', 
-                'Eclipsing', 
-                'Doppler beaming', 
-                'Flares', 
-                'Irradiation', 
-                'Ellipsoidal'
-            ]
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-            # Write header if file doesn't exist
-            if not file_exists:
-                writer.writeheader()
-            
-            # Append row
-            writer.writerow(row)
-
-
-    def add_to_csv(self, row):
-        """
-            
-        """
-        # See if file already exists
-        file_exists = exists(self.porb_dir)
 
-        # Create the row
-        row = self.create_row(row)
-        
-        # Open file in append mode
-        with open(self.porb_dir, 'a', newline='') as csvfile:
-            fieldnames = [
-                'TIC', 
-                'Orbital period (days)', 
-                'Literature period (days)', 
-                'i Magnitude', 
-                'Eclipsing', 
-                'Doppler beaming', 
-                'Flares', 
-                'Irradiation', 
-                'Ellipsoidal'
-            ]
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-            # Write header if file doesn't exist
-            if not file_exists:
-                writer.writeheader()
-            
-            # Append row
-            writer.writerow(row)
+        # Write the row
+        self.write_preload_row(row)
 
 
-    def get_tics(self):
+    def write_preload_row(self, row):
         """
-            
+            Queues an already created preload row to be written to the results store
+            Parameters:
+                        row: preload row from create_preload_row()
+            Returns:
+                        None
         """
-        # Get star name for every period plot
-        plots = [plot for plot in os.listdir('preload/period_plots') if plot.startswith('TIC')]
-        tics = [plot.replace('_period.png', '') for plot in plots]
+        self.results_store.add('preload', row)
 
-        return tics
-    
 
-    def period_plot(self, tic):
+    def add_result(self, record, answers):
         """
-            
+            Queues a reviewed star's row to be written to the results store
+            Parameters:
+                        record: preload row of the star
+                        answers: {screen: True/False} reviewer answers of the star
+            Returns:
+                        None
         """
-        # Get the plot directory
-        period_plot = self.create_dir('Period', tic)
-
-        # Show the period plot
-        fig = plt.figure(figsize=(14, 8))
-        cid = fig.canvas.mpl_connect('key_press_event', lambda event: self.on_key(event, 'Period selection')) 
-        plt.axis('off')
-        plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
-        img = mpimg.imread(period_plot)
-        plt.imshow(img)
-        plt.show()
+        self.results_store.add('results', self.create_row(record, answers))
 
 
-    def effects_plots(self, tic):
+    def get_tics(self):
         """
             
         """
-        for effect in self.effects:
-            # Get the plot directory
-            plot_dir = self.create_dir(effect, tic)
-
-            fig = plt.figure(figsize=(14, 8))
-            cid = fig.canvas.mpl_connect('key_press_event', lambda event: self.on_key(event, 'Effects selection')) 
-            plt.axis('off')
-            plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
-            img = mpimg.imread(plot_dir)
-            plt.imshow(img)
-            plt.show()
+        # Get star name for every star with products
+        if self.products:
+            return self.star_products.get_tics()
 
+        # Get star name for every period plot
+        return self.plot_archive.get_tics('Period')
+    
 
-    def irradiation_ellipsodial_check(self, row):
+    def irradiation_ellipsodial_check(self, record):
         """
-            
+            Checks if a star shows irradiation or ellipsodial effects from its periods
+            Parameters:
+                        record: preload row of the star
+            Returns:
+                        irradiation: True if the literature period is the period at max power
+                        ellipsoidal: True if the literature period is twice the period at max power
         """
+        difference = np.abs(record['Literature period (days)'] - record['Orbital period (days)'])
+
         # Irradiation if literature period = period at max power
-        if math.isclose(np.abs(row['Literature period (days)'].values[0] - row['Orbital period (days)'].values[0]), 0, rel_tol=1e-2):
-            self.effects_found.append(True)
-        else:
-            self.effects_found.append(False)
+        irradiation = math.isclose(difference, 0, rel_tol=1e-2)
 
         # Ellipsoidal if literature period is twice the period at max power
-        if math.isclose(np.abs(row['Literature period (days)'].values[0] - row['Orbital period (days)'].values[0]), 2, rel_tol=1e-2):
-            self.effects_found(True)
-        else:
-            self.effects_found.append(False)
+        ellipsoidal = math.isclose(difference, 2, rel_tol=1e-2)
+
+        return irradiation, ellipsoidal
 
     
-    def run(self):
+    def run(self, ledger=None):
         """
-            
+            Reviews the preloaded stars, resuming any previous review session
+            Parameters:
+                        ledger: run ledger to mark reviewed stars in (None to not keep one)
+            Returns:
+                        None
         """
         # Check preload
         if self.preload:
-            
-            # Get all of the tics in the directory
-            tics = self.get_tics()
-
-            # Load the saved star data
-            preload_df = pd.read_csv(self.preload_data_dir)
-
-            # Check if orbital period csv exists
-            porb_filename = 'orbital_periods/periods.csv'
-            if exists(porb_filename):
-                os.remove(porb_filename)
-
-            # Iterate through every star
-            for tic in tics:
-                # Load the period plot
-                self.period_plot(tic)
-
-                # Check if the period is real
-                if not self.is_real_period:
-                    continue
-
-                # Load effects plots
-                self.effects_found = []
-                self.effects_plots(tic)
-
-                # Get the current row of the df
-                row = preload_df.loc[preload_df['TIC'] == tic]
-
-                # Check for irradiation and ellipsoidal
-                self.irradiation_ellipsodial_check(row)
-
-                # Save the data
-                self.add_to_csv(row)
-
-
-    def on_key(self, event, purpose):
-        """
-            
-        """
-        y_n_keys = {'y', 'n'}
-
-        if event.key not in y_n_keys:
-            print("Invalid key input, select 'y' or 'n'")
-        else:
-            if purpose == 'Period selection':
-                if event.key == 'n':
-                    print('Period is not real, loading next plot ... \n')
-                else:
-                    self.is_real_period = True
-            elif purpose == 'Effects selection':
-                self.effects_found.append(event.key == 'y') 
-
-            plt.close()
\ No newline at end of file
+            ReviewSession(self, ledger).run()
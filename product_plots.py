@@ -0,0 +1,288 @@
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import matplotlib.gridspec as gridspec
+import numpy as np
+
+
+class ProductPlots(object):
+    def __init__(self, star_products):
+        self.star_products = star_products
+
+        # Flare colormap, set with the plot style at the first render so seaborn is only imported once a star is drawn
+        self.flare_cmap = None
+
+
+    def set_style(self):
+        """
+            Sets the plot style and colormaps of the live plots
+            Parameters:
+                        None
+            Returns:
+                        None
+        """
+        import seaborn as sns
+
+        sns.set_style("whitegrid")
+        self.flare_cmap = sns.color_palette("flare", as_cmap=True)
+
+
+    def plot_periodogram(self, axis, products):
+        """
+            Plots the stored periodogram on a given axis, as well as the period at max power, the literature period,
+            if any, and the 5 sigma cutoff
+            Parameters:
+                        axis: axis to be plotted on
+                        products: star products
+            Returns:
+                        None
+        """
+        period_at_max_power = float(products['period_at_max_power'])
+        lit_period = float(products['lit_period'])
+
+        # Plot title
+        axis.set_title('Periodogram', fontsize=12)
+        axis.set_xlabel(r'$P_{\text{orb}}$ (days)', fontsize=10)
+        axis.set_ylabel('Power', fontsize=10)
+        axis.plot(products['periodogram_period'], products['periodogram_power'], color='#9AADD0')
+        axis.axvline(x=period_at_max_power, color="#101935", ls=(0, (4, 5)), lw=2,
+                     label=fr'$P_{{\text{{orb, max power}}}}={np.round(period_at_max_power, 3)}$ days')
+
+        # Plot literature period if there is one
+        if lit_period != 0.0:
+            axis.axvline(x=lit_period, color='#A30015',
+                         label=fr'Literature $P_{{\text{{orb}}}}={np.round(lit_period, 3)}$ days')
+
+        # Plot the candidate periods the methods agree on (products stored before the consensus have none)
+        for rank, (period, score) in enumerate(zip(products.get('consensus_period', [])[:3], products.get('consensus_score', [])[:3])):
+            axis.axvline(x=period, color='#E3A72F', ls=':', lw=2 - 0.5 * rank,
+                         label=fr'Consensus $P_{{{rank + 1}}}={np.round(period, 3)}$ days ({score:.2f})')
+
+        # Plot 5 sigma cutoff
+        axis.axhline(y=float(products['cutoff']), color='#4A5D96', ls=(0, (4, 5)), lw=2, label='5-sigma cutoff')
+
+        # Change scale to be log
+        axis.set_xscale('log')
+
+        # Add legend
+        axis.legend(loc='upper left')
+
+
+    def plot_binned_lightcurve(self, axis, products, prefix='binned'):
+        """
+            Plots the stored binned lightcurve and binned sine wave on a given axis
+            Parameters:
+                        axis: axis to be plotted on
+                        products: star products
+                        prefix: 'binned' for one fold, 'double' for two folds
+            Returns:
+                        None
+        """
+        flux = products[f'{prefix}_flux']
+        flux_err = products[f'{prefix}_flux_err']
+
+        # Plot the binned lightcurve
+        axis.vlines(products[f'{prefix}_phase'], flux - flux_err, flux + flux_err, color='#9AADD0', lw=2)
+
+        # Plot the binned sine fit
+        axis.plot(products[f'{prefix}_sine_phase'], products[f'{prefix}_sine_flux'], color='#101935', label='Folded Sine Wave')
+
+
+    def plot_lightcurve_and_sine(self, axis, products):
+        """
+            Plots the stored window of the lightcurve and the sine wave, as well as the period of the sine wave
+            Parameters:
+                        axis: axis to be plotted on
+                        products: star products
+            Returns:
+                        None
+        """
+        sine_period = float(products['sine_period'])
+        time_points = products['time_points']
+
+        # Plot title
+        axis.set_title('Lightcurve', fontsize=12)
+        axis.set_xlabel('Time (days)', fontsize=10)
+        axis.set_ylabel('Normalized Flux', fontsize=10)
+
+        # Plot lightcurve
+        axis.vlines(products['window_time'],
+                    products['window_flux'] - products['window_flux_err'],
+                    products['window_flux'] + products['window_flux_err'], color='#9AADD0')
+
+        # Add vertical lines at each period interval of the sine wave
+        for tp in time_points:
+            axis.axvline(x = tp, color = '#4A5D96', ls = (0, (4, 5)), lw = 2,
+                         label = fr'$P_{{\text{{orb, sine}}}} = {np.round(sine_period, 3)}$ days' if tp == time_points[0] else "")
+
+        # Plot sine wave
+        axis.plot(products['window_time'], products['window_sine'], color='#101935', label='Fitted Sine Wave')
+
+        # Set xlim and plot legend
+        axis.set_xlim(float(products['xmin']), float(products['xmax']))
+        axis.legend(loc='upper right')
+
+
+    def plot_residuals(self, axis, products):
+        """
+            Plots the stored residuals of the lightcurve
+            Parameters:
+                        axis: axis to be plotted on
+                        products: star products
+            Returns:
+                        None
+        """
+        # Plot title
+        axis.set_title('Flux - Fitted Sine Wave', fontsize=12)
+        axis.set_xlabel('Time (days)', fontsize=10)
+        axis.set_ylabel('Normalized Flux', fontsize=10)
+
+        # Plot the residuals
+        axis.plot(products['window_time'], products['window_residuals'], color='#9AADD0')
+
+        # Set xlim (no legend needed)
+        axis.set_xlim(float(products['xmin']), float(products['xmax']))
+
+
+    def period_figure(self, products):
+        """
+            Creates the period plot (periodogram, binned lightcurve, lightcurve and residuals) from stored products
+            Parameters:
+                        products: star products
+            Returns:
+                        fig: matplotlib figure
+        """
+        fig = Figure(figsize=(14, 8))
+        axs = fig.subplots(2, 2)
+        fig.subplots_adjust(hspace=0.35)
+        fig.suptitle(r"Press 'y' if the period is real, 'n' if not.", fontweight='bold')
+        if bool(products['is_plausible']):
+            fig.text(0.5, 0.928, r'Note: $P_{\text{orb, max power}}$ is over 5 sigma, so MIGHT be real', ha='center', fontsize=12, style='italic')
+        else:
+            fig.text(0.5, 0.928, r'Note: $P_{\text{orb, max power}}$ is under 5 sigma, so might NOT be real', ha='center', fontsize=12, style='italic')
+        fig.text(0.5, 0.05, f"{products['name']}", ha='center', fontsize=16, fontweight='bold')
+        fig.text(0.5, 0.02, fr"$i_{{\text{{mag}}}}={products['imag']}$", ha='center', fontsize=12, fontweight='bold')
+
+        # Plot the periodogram
+        self.plot_periodogram(axs[0, 0], products)
+
+        # Plot the binned lightcurve
+        axs[1, 0].set_title(r'Lightcurve Folded on $P_{\text{orb, max power}}$', fontsize=12)
+        axs[1, 0].set_xlabel('Phase', fontsize=10)
+        axs[1, 0].set_ylabel('Normalized Flux', fontsize=10)
+        self.plot_binned_lightcurve(axs[1, 0], products)
+        axs[1, 0].legend(loc='upper right')
+
+        # Plot the lightcurve with the sine fit
+        self.plot_lightcurve_and_sine(axs[0, 1], products)
+
+        # Plot residuals
+        self.plot_residuals(axs[1, 1], products)
+
+        return fig
+
+
+    def effects_figure(self, effect, products):
+        """
+            Creates an effects plot from stored products, laid out as in ExoplanetEffects
+            Parameters:
+                        effect: lightcurve effect
+                        products: star products
+            Returns:
+                        fig: matplotlib figure
+        """
+        fig = Figure(figsize=(14, 8))
+        fig.text(0.5, 0.928, fr"$P_{{\text{{orb, max power}}}}={np.round(float(products['period_at_max_power']), 4)}$ days", ha='center', fontsize=12)
+        fig.text(0.5, 0.02, fr"{products['name']}, $i_{{\text{{mag}}}}={products['imag']}$", ha='center', fontsize=16)
+
+        # Eclipsing plot
+        if effect == 'Eclipsing':
+            fig.suptitle("Press 'y' if there are eclipses, 'n' if not", fontweight='bold')
+            gs = gridspec.GridSpec(2, 2, figure=fig, height_ratios=[1, 1])
+            ax1 = fig.add_subplot(gs[0, :])
+            ax2 = fig.add_subplot(gs[1, 0])
+            ax3 = fig.add_subplot(gs[1, 1])
+            fig.subplots_adjust(hspace=0.5)
+
+            self.plot_lightcurve_and_sine(ax1, products)
+            self.plot_periodogram(ax2, products)
+            ax3.set_title(r'Lightcurve Folded on $P_{\text{orb, max power}}$', fontsize=12)
+            ax3.set_xlabel('Phase', fontsize=10)
+            ax3.set_ylabel('Normalized Flux', fontsize=10)
+            self.plot_binned_lightcurve(ax3, products)
+            ax3.legend(loc='upper right')
+
+        # Doppler beaming plot
+        if effect == 'Doppler beaming':
+            fig.suptitle("Press 'y' if there is doppler beaming, 'n' if not", fontweight='bold')
+            ax = fig.add_axes([0.1, 0.2, 0.8, 0.6])
+            self.plot_binned_lightcurve(ax, products, prefix='double')
+            ax.legend()
+
+        # Flares plot
+        if effect == 'Flares':
+            fig.suptitle("Press 'y' if there are flares, 'n' if not", fontweight='bold')
+            gs = gridspec.GridSpec(2, 1, figure=fig, height_ratios=[1, 1])
+            ax1 = fig.add_subplot(gs[0, 0])
+            ax2 = fig.add_subplot(gs[1, 0])
+            fig.subplots_adjust(hspace=0.5)
+
+            for axis, key, title in ((ax1, 'residuals', 'Flux - Fitted Sine Wave'), (ax2, 'flux', 'Lightcurve')):
+                if f'flare_{key}_time' in products:
+                    axis.scatter(products[f'flare_{key}_time'], products[f'flare_{key}_flux'],
+                                 c=products[f'flare_{key}_probability'], vmin=0, vmax=1, s=10, cmap=self.flare_cmap)
+                axis.set_title(title, fontsize=12)
+                axis.set_xlabel('Time (days)', fontsize=10)
+                axis.set_ylabel('Normalized Flux', fontsize=10)
+
+            # Add a single colorbar for both subplots
+            if ax1.collections:
+                cbar = fig.colorbar(ax1.collections[0], ax=[ax1, ax2], orientation='vertical', pad=0.02)
+                cbar.set_label('Probability of Flare')
+
+        return fig
+
+
+    def to_image(self, fig):
+        """
+            Draws a figure off screen into an RGBA image
+            Parameters:
+                        fig: matplotlib figure
+            Returns:
+                        image: (height, width, 4) uint8 array
+        """
+        canvas = FigureCanvasAgg(fig)
+        canvas.draw()
+
+        return np.asarray(canvas.buffer_rgba()).copy()
+
+
+    def render(self, tic, effects):
+        """
+            Renders the period and effects plots of a star from its stored products
+            Parameters:
+                        tic: TIC name of the star
+                        effects: effects to render
+            Returns:
+                        images: {plot type: RGBA image}
+        """
+        return self.render_products(self.star_products.load(tic), ['Period'] + effects)
+
+
+    def render_products(self, products, plot_types):
+        """
+            Renders plots of a star from its products
+            Parameters:
+                        products: star products
+                        plot_types: 'Period' and/or effects to render
+            Returns:
+                        images: {plot type: RGBA image}
+        """
+        if self.flare_cmap is None:
+            self.set_style()
+
+        images = {}
+        for plot_type in plot_types:
+            fig = self.period_figure(products) if plot_type == 'Period' else self.effects_figure(plot_type, products)
+            images[plot_type] = self.to_image(fig)
+
+        return images
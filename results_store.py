@@ -0,0 +1,335 @@
+import atexit
+from contextlib import closing
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+# Every result column {csv name: (sql name, sql type)}, in csv order
+RESULT_COLUMNS = {
+    'TIC': ('tic', 'TEXT PRIMARY KEY'),
+    'Orbital period (days)': ('period', 'REAL'),
+    'Orbital period error (days)': ('period_err', 'REAL'),
+    'Amplitude': ('amplitude', 'REAL'),
+    'Amplitude error': ('amplitude_err', 'REAL'),
+    'Consensus period (days)': ('consensus_period', 'REAL'),
+    'Consensus score': ('consensus_score', 'REAL'),
+    'Literature period (days)': ('lit_period', 'REAL'),
+    'i Magnitude': ('imag', 'REAL'),
+    'Eclipsing': ('eclipsing', 'INTEGER'),
+    'Doppler beaming': ('doppler_beaming', 'INTEGER'),
+    'Flares': ('flares', 'INTEGER'),
+    'Irradiation': ('irradiation', 'INTEGER'),
+    'Ellipsoidal': ('ellipsoidal', 'INTEGER')
+}
+
+# Columns stored as booleans
+EFFECT_COLUMNS = ['Eclipsing', 'Doppler beaming', 'Flares', 'Irradiation', 'Ellipsoidal']
+
+# Tables of the store
+TABLES = ['results', 'preload']
+
+# Writer queue item that forces the current batch to be written
+FLUSH = object()
+
+
+class ResultsStore(object):
+    def __init__(self, store_dir, batch_size=100, flush_interval=5.0):
+        self.store_dir = store_dir
+
+        # Rows are written in transactions of up to batch_size rows, at most flush_interval seconds apart
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        # Create the store
+        os.makedirs(os.path.dirname(self.store_dir) or '.', exist_ok=True)
+        with closing(self.connect()) as connection:
+            self.create_tables(connection)
+
+        # Single writer thread, fed by a queue so any thread can add rows
+        self.queue = queue.Queue()
+        self.error = None
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+        # The writer thread dies with the process, so write what is still queued on exit (e.g. after Ctrl-C)
+        atexit.register(self.flush)
+
+
+    def connect(self):
+        """
+            Connects to the store in WAL mode, so readers never block the writer
+            Parameters:
+                        None
+            Returns:
+                        connection: sqlite3 connection
+        """
+        connection = sqlite3.connect(self.store_dir, timeout=60)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+
+        return connection
+
+
+    def create_tables(self, connection):
+        """
+            Creates the results and preload tables, and their indices, if they don't exist (adding any missing columns)
+            Parameters:
+                        connection: sqlite3 connection
+            Returns:
+                        None
+        """
+        columns = ', '.join(f'{sql_name} {sql_type}' for sql_name, sql_type in RESULT_COLUMNS.values())
+
+        for table in TABLES:
+            connection.execute(f'CREATE TABLE IF NOT EXISTS {table} ({columns})')
+
+            # Add columns introduced since the store was created
+            existing = {row[1] for row in connection.execute(f'PRAGMA table_info({table})')}
+            for sql_name, sql_type in RESULT_COLUMNS.values():
+                if sql_name not in existing:
+                    connection.execute(f'ALTER TABLE {table} ADD COLUMN {sql_name} {sql_type}')
+            connection.execute(f'CREATE INDEX IF NOT EXISTS {table}_period ON {table} (period)')
+
+            for effect in EFFECT_COLUMNS:
+                sql_name = RESULT_COLUMNS[effect][0]
+                connection.execute(f'CREATE INDEX IF NOT EXISTS {table}_{sql_name} ON {table} ({sql_name})')
+
+
+    def to_value(self, column, value):
+        """
+            Converts a row value to its typed sql value
+            Parameters:
+                        column: csv name of the column
+                        value: value in the row
+            Returns:
+                        value: sql value (None for missing values)
+        """
+        if value is None or (isinstance(value, float) and value != value) or value == '':
+            return None
+
+        if column in EFFECT_COLUMNS:
+            return int(value in (True, 'True', 1, '1'))
+
+        if RESULT_COLUMNS[column][1] == 'REAL':
+            return float(value)
+
+        return str(value)
+
+
+    def add(self, table, row):
+        """
+            Queues a row to be written (replacing any earlier row of the same TIC)
+            Parameters:
+                        table: 'results' or 'preload'
+                        row: dictionary keyed by csv column names (missing columns are stored as NULL)
+            Returns:
+                        None
+        """
+        if self.error:
+            raise self.error
+
+        values = tuple(self.to_value(column, row.get(column)) for column in RESULT_COLUMNS)
+        self.queue.put((table, values))
+
+
+    def write_batch(self, connection, batch):
+        """
+            Writes a batch of rows in a single transaction
+            Parameters:
+                        connection: sqlite3 connection of the writer thread
+                        batch: list of (table, values)
+            Returns:
+                        None
+        """
+        sql_names = ', '.join(sql_name for sql_name, _ in RESULT_COLUMNS.values())
+        placeholders = ', '.join('?' * len(RESULT_COLUMNS))
+
+        with connection:
+            for table in TABLES:
+                rows = [values for batch_table, values in batch if batch_table == table]
+                if rows:
+                    connection.executemany(f'INSERT OR REPLACE INTO {table} ({sql_names}) VALUES ({placeholders})', rows)
+
+
+    def write_loop(self):
+        """
+            Writer thread, gathering queued rows into batches and writing them
+            Parameters:
+                        None
+            Returns:
+                        None
+        """
+        connection = self.connect()
+
+        while True:
+            items = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+
+            # Gather rows until the batch is full, the interval is up, or a flush is asked for
+            while len(items) < self.batch_size and items[-1] is not FLUSH:
+                try:
+                    items.append(self.queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+
+            try:
+                self.write_batch(connection, [item for item in items if item is not FLUSH])
+            except Exception as e:
+                self.error = e
+            finally:
+                for _ in items:
+                    self.queue.task_done()
+
+
+    def flush(self):
+        """
+            Waits until every queued row is written
+            Parameters:
+                        None
+            Returns:
+                        None
+        """
+        self.queue.put(FLUSH)
+        self.queue.join()
+
+        if self.error:
+            raise self.error
+
+
+    def query(self, table='results', tic=None, min_period=None, max_period=None, effects=None):
+        """
+            Queries the stored rows by TIC, orbital period range and effect flags
+            Parameters:
+                        table: 'results' or 'preload'
+                        tic: TIC name to select (None for all)
+                        min_period: minimum orbital period in days (None for no minimum)
+                        max_period: maximum orbital period in days (None for no maximum)
+                        effects: {effect: True/False} flags to select (None for any)
+            Returns:
+                        df: pandas dataframe with the csv column names
+        """
+        conditions, parameters = [], []
+
+        if tic is not None:
+            conditions.append('tic = ?')
+            parameters.append(tic)
+
+        if min_period is not None:
+            conditions.append('period >= ?')
+            parameters.append(min_period)
+
+        if max_period is not None:
+            conditions.append('period <= ?')
+            parameters.append(max_period)
+
+        for effect, flag in (effects or {}).items():
+            conditions.append(f'{RESULT_COLUMNS[effect][0]} = ?')
+            parameters.append(int(flag))
+
+        sql_names = ', '.join(f'{sql_name} AS "{column}"' for column, (sql_name, _) in RESULT_COLUMNS.items())
+        where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+
+        import pandas as pd
+
+        with closing(self.connect()) as connection:
+            df = pd.read_sql_query(f'SELECT {sql_names} FROM {table}{where} ORDER BY rowid', connection, params=parameters)
+
+        # Effects back to booleans, keeping missing effects empty
+        for effect in EFFECT_COLUMNS:
+            df[effect] = df[effect].map({1: True, 0: False})
+
+        return df
+
+
+    def get_tics(self, table='results'):
+        """
+            Gets the TIC name of every stored row
+            Parameters:
+                        table: 'results' or 'preload'
+            Returns:
+                        tics: set of TIC names
+        """
+        with closing(self.connect()) as connection:
+            tics = {tic for tic, in connection.execute(f'SELECT tic FROM {table}')}
+
+        return tics
+
+
+    def reset(self):
+        """
+            Deletes every stored row, so the next run starts over
+            Parameters:
+                        None
+            Returns:
+                        None
+        """
+        self.flush()
+
+        with closing(self.connect()) as connection, connection:
+            for table in TABLES:
+                connection.execute(f'DELETE FROM {table}')
+
+
+    def merge(self, store_dir):
+        """
+            Copies every row of another store (e.g. a shard's) into this one, replacing rows of the same TIC
+            Parameters:
+                        store_dir: path of the other store
+            Returns:
+                        num_rows: {table: number of rows copied}
+        """
+        self.flush()
+
+        # Bring the other store's columns up to date
+        with closing(sqlite3.connect(store_dir, timeout=60)) as connection:
+            self.create_tables(connection)
+
+        sql_names = ', '.join(sql_name for sql_name, _ in RESULT_COLUMNS.values())
+        num_rows = {}
+
+        with closing(self.connect()) as connection:
+            connection.execute('ATTACH DATABASE ? AS other', (store_dir,))
+
+            with connection:
+                for table in TABLES:
+                    cursor = connection.execute(f'INSERT OR REPLACE INTO {table} ({sql_names}) SELECT {sql_names} FROM other.{table}')
+                    num_rows[table] = cursor.rowcount
+
+        return num_rows
+
+
+    def export_csv(self, table, csv_dir):
+        """
+            Writes every stored row out as a csv, with the same columns as the old per row csv
+            Parameters:
+                        table: 'results' or 'preload'
+                        csv_dir: path of the csv
+            Returns:
+                        None
+        """
+        self.flush()
+
+        df = self.query(table)
+        os.makedirs(os.path.dirname(csv_dir) or '.', exist_ok=True)
+        df.to_csv(csv_dir, index=False)
+
+
+    def import_csv(self, table, csv_dir):
+        """
+            Adds the rows of an existing csv to the store
+            Parameters:
+                        table: 'results' or 'preload'
+                        csv_dir: path of the csv
+            Returns:
+                        None
+        """
+        import pandas as pd
+
+        df = pd.read_csv(csv_dir)
+
+        for row in df.to_dict('records'):
+            self.add(table, row)
+
+        self.flush()
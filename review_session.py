@@ -0,0 +1,282 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import matplotlib.pyplot as plt
+import os
+from os.path import exists
+import time
+
+from run_ledger import *
+
+
+class ReviewSession(object):
+    def __init__(self, preload_plots, ledger=None, prefetch=3, log_every=10):
+        self.preload_plots = preload_plots
+
+        # Run ledger to mark reviewed stars in (None to not keep one)
+        self.ledger = ledger
+
+        # Number of stars decoded ahead of the one being reviewed
+        self.prefetch = prefetch
+
+        # Log throughput every this many reviewed stars
+        self.log_every = log_every
+
+        # Every answer the reviewer has given, one JSON line per screen
+        self.decisions_dir = self.preload_plots.preload_dir + 'review_session.jsonl'
+
+        # Screens shown for every star, in order
+        self.screens = ['Period'] + self.preload_plots.effects
+
+        # Decoded images {tic: future of {plot type: image}}, decoded by a background thread
+        self.loaded = {}
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        # Current key press
+        self.answer = None
+
+        # Stars already in the results store
+        self.saved = set()
+
+
+    def create_index(self):
+        """
+            Creates a TIC keyed index of the preload data
+            Parameters:
+                        None
+            Returns:
+                        index: {tic: preload row as a dictionary}
+        """
+        results_store = self.preload_plots.results_store
+
+        # Bring in the preload csv of older runs
+        if not results_store.get_tics('preload') and exists(self.preload_plots.preload_data_dir):
+            results_store.import_csv('preload', self.preload_plots.preload_data_dir)
+
+        results_store.flush()
+        preload_df = results_store.query('preload')
+
+        # Stars preloaded more than once keep their latest row
+        preload_df = preload_df.drop_duplicates('TIC', keep='last').set_index('TIC', drop=False)
+
+        return preload_df.to_dict('index')
+
+
+    def load_decisions(self):
+        """
+            Loads the answers of previous sessions
+            Parameters:
+                        None
+            Returns:
+                        decisions: {tic: {screen: True/False}}
+        """
+        decisions = {}
+
+        if not exists(self.decisions_dir):
+            return decisions
+
+        with open(self.decisions_dir, 'r') as f:
+            for line in f:
+                # Skip an answer that was cut off mid write
+                if not line.endswith('\n'):
+                    break
+
+                entry = json.loads(line)
+                decisions.setdefault(entry['TIC'], {})[entry['screen']] = entry['answer']
+
+        return decisions
+
+
+    def record(self, tic, screen, answer, confidence=None):
+        """
+            Persists one answer before moving on, so a session can resume from it
+            Parameters:
+                        tic: TIC name of the star
+                        screen: 'Period' or an effect
+                        answer: True for 'y', False for 'n'
+                        confidence: autopilot confidence of the answer (None for the reviewer's answers)
+            Returns:
+                        None
+        """
+        entry = {'TIC': tic, 'screen': screen, 'answer': answer, 'time': time.time()}
+        if confidence is not None:
+            entry['confidence'] = confidence
+
+        with open(self.decisions_dir, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+
+    def is_complete(self, answers):
+        """
+            Checks if every needed screen of a star has been answered
+            Parameters:
+                        answers: {screen: True/False} of the star
+            Returns:
+                        boolean: True if the star needs no more answers
+        """
+        # Effects aren't asked for stars without a real period
+        if answers.get('Period') is False:
+            return True
+
+        return all(screen in answers for screen in self.screens)
+
+
+    def save_results(self, decisions, index):
+        """
+            Saves the results of every finished star with a real period that is not in the results store yet
+            Parameters:
+                        decisions: {tic: {screen: True/False}}
+                        index: TIC keyed preload data
+            Returns:
+                        None
+        """
+        for tic, answers in decisions.items():
+            if tic in self.saved or tic not in index:
+                continue
+
+            if answers.get('Period') and self.is_complete(answers):
+                self.preload_plots.add_result(index[tic], answers)
+                self.saved.add(tic)
+
+
+    def load_images(self, tic):
+        """
+            Starts decoding a star's images in the background, if not already started
+            Parameters:
+                        tic: TIC name of the star
+            Returns:
+                        future: future of {plot type: image}
+        """
+        if tic not in self.loaded:
+            self.loaded[tic] = self.executor.submit(self.preload_plots.load_images, tic)
+
+        return self.loaded[tic]
+
+
+    def show(self, image):
+        """
+            Shows a plot and waits for the reviewer to press 'y' or 'n'
+            Parameters:
+                        image: image of the plot
+            Returns:
+                        answer: True for 'y', False for 'n', None if the window was closed without an answer
+        """
+        self.answer = None
+
+        fig = plt.figure(figsize=(14, 8))
+        cid = fig.canvas.mpl_connect('key_press_event', lambda event: self.on_key(event))
+        plt.axis('off')
+        plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
+        plt.imshow(image)
+        plt.show()
+
+        return self.answer
+
+
+    def log_throughput(self, num_reviewed, start_time, num_remaining):
+        """
+            Prints the number of stars reviewed per minute this session
+            Parameters:
+                        num_reviewed: stars reviewed this session
+                        start_time: start time of the session
+                        num_remaining: stars still to be reviewed
+            Returns:
+                        None
+        """
+        minutes = (time.time() - start_time) / 60
+        rate = num_reviewed / minutes if minutes > 0 else 0.0
+
+        print(f'Reviewed {num_reviewed} stars in {minutes:.1f} min ({rate:.1f} stars/min), {num_remaining} left')
+
+
+    def run(self):
+        """
+            Reviews every preloaded star, resuming from the last answer of any previous session
+            Parameters:
+                        None
+            Returns:
+                        None
+        """
+        index = self.create_index()
+        decisions = self.load_decisions()
+
+        # Stars already saved
+        self.saved = self.preload_plots.results_store.get_tics('results')
+
+        # Save stars that were finished but not saved when the last session stopped
+        self.save_results(decisions, index)
+
+        # Stars still to be reviewed, in preload order
+        tics = [tic for tic in self.preload_plots.get_tics()
+                if tic in index and not self.is_complete(decisions.get(tic, {}))]
+
+        if len(tics) < len(index):
+            print(f'Resuming review, {len(tics)} of {len(index)} stars left')
+
+        start_time = time.time()
+
+        try:
+            for i, tic in enumerate(tics):
+                # Decode the next few stars in the background
+                for upcoming in tics[i:i + self.prefetch + 1]:
+                    self.load_images(upcoming)
+
+                images = self.load_images(tic).result()
+                answers = decisions.setdefault(tic, {})
+
+                # Ask every screen not answered yet
+                for screen in self.screens:
+                    if screen in answers:
+                        continue
+
+                    answer = self.show(images[screen])
+
+                    # Reviewer closed the window, so stop here and resume later
+                    if answer is None:
+                        print('Review paused, run again to resume')
+                        self.log_throughput(i, start_time, len(tics) - i)
+                        return
+
+                    self.record(tic, screen, answer)
+                    answers[screen] = answer
+
+                    if screen == 'Period' and not answer:
+                        print('Period is not real, loading next plot ... \n')
+                        break
+
+                # Save the star once every screen is answered
+                self.save_results({tic: answers}, index)
+
+                if self.ledger:
+                    self.preload_plots.results_store.flush()
+                    self.ledger.update_tic(tic, SAVED if answers['Period'] else REVIEWED)
+
+                # Forget the decoded images
+                del self.loaded[tic]
+
+                if (i + 1) % self.log_every == 0:
+                    self.log_throughput(i + 1, start_time, len(tics) - i - 1)
+
+            self.log_throughput(len(tics), start_time, 0)
+
+        finally:
+            # Stop decoding ahead, so no prefetch thread outlives the review
+            self.executor.shutdown(cancel_futures=True)
+
+
+    def on_key(self, event):
+        """
+            Event function that determines if a key was clicked
+            Parameters:
+                        event: key press event
+            Returns:
+                        None
+        """
+        y_n_keys = {'y', 'n'}
+
+        if event.key not in y_n_keys:
+            print("Invalid key input, select 'y' or 'n'")
+        else:
+            self.answer = event.key == 'y'
+            plt.close()
@@ -0,0 +1,275 @@
+import os
+import socket
+import sqlite3
+import time
+
+# Star statuses
+NOT_SEARCHED = 'not searched'
+NO_DATA = 'no data at cadence'
+COMPUTED = 'computed'
+REVIEWED = 'reviewed'
+SAVED = 'saved'
+FAILED = 'failed'
+
+# Statuses from least to most finished, deciding which row of a star is kept when ledgers are merged
+STATUS_ORDER = [NOT_SEARCHED, FAILED, NO_DATA, COMPUTED, REVIEWED, SAVED]
+
+
+class RunLedger(object):
+    def __init__(self, ledger_dir, lease=3600, no_data_ttl=30 * 86400):
+        self.ledger_dir = ledger_dir
+
+        # Seconds after which a claim by a worker that never finished can be taken over
+        self.lease = lease
+
+        # Seconds a star found to have no data at the cadence is skipped for, before it is searched again
+        self.no_data_ttl = no_data_ttl
+
+        # Name of this worker
+        self.worker = f'{socket.gethostname()}:{os.getpid()}'
+
+        # Create the ledger
+        os.makedirs(os.path.dirname(self.ledger_dir) or '.', exist_ok=True)
+        self.connection = self.connect()
+        self.create_table()
+
+
+    def connect(self):
+        """
+            Connects to the ledger in WAL mode, so readers never block the writer
+            Parameters:
+                        None
+            Returns:
+                        connection: sqlite3 connection (autocommit, transactions are explicit)
+        """
+        connection = sqlite3.connect(self.ledger_dir, timeout=60, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+
+        return connection
+
+
+    def create_table(self):
+        """
+            Creates the table of star statuses if it doesn't exist
+            Parameters:
+                        None
+            Returns:
+                        None
+        """
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS stars (
+                iau_name TEXT PRIMARY KEY,
+                tic TEXT,
+                status TEXT NOT NULL,
+                worker TEXT,
+                claimed REAL,
+                finished REAL,
+                duration REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                sectors INTEGER
+            )""")
+        self.connection.execute('CREATE INDEX IF NOT EXISTS stars_tic ON stars (tic)')
+
+        # Ledgers made before sector counts were kept
+        columns = {column[1] for column in self.connection.execute('PRAGMA table_info(stars)')}
+        if 'sectors' not in columns:
+            self.connection.execute('ALTER TABLE stars ADD COLUMN sectors INTEGER')
+
+
+    def register(self, iau_names):
+        """
+            Adds every catalog star not yet in the ledger as not searched
+            Parameters:
+                        iau_names: star names of the catalog
+            Returns:
+                        None
+        """
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.connection.executemany('INSERT OR IGNORE INTO stars (iau_name, status) VALUES (?, ?)',
+                                        [(name, NOT_SEARCHED) for name in iau_names])
+
+
+    def get_statuses(self):
+        """
+            Gets the status of every star in the ledger
+            Parameters:
+                        None
+            Returns:
+                        statuses: {iau_name: status}
+        """
+        return dict(self.connection.execute('SELECT iau_name, status FROM stars'))
+
+
+    def get_sectors(self):
+        """
+            Gets the number of sectors at the cadence found for every searched star
+            Parameters:
+                        None
+            Returns:
+                        sectors: {iau_name: number of sectors}
+        """
+        return dict(self.connection.execute('SELECT iau_name, sectors FROM stars WHERE sectors IS NOT NULL'))
+
+
+    def expire(self):
+        """
+            Marks stars whose no data result is older than the TTL as not searched, so they are searched again
+            Parameters:
+                        None
+            Returns:
+                        num_expired: number of stars to be searched again
+        """
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            cursor = self.connection.execute('UPDATE stars SET status = ? WHERE status = ? AND finished < ?',
+                                             (NOT_SEARCHED, NO_DATA, time.time() - self.no_data_ttl))
+
+        return cursor.rowcount
+
+
+    def is_done(self, status, preload, refresh=False):
+        """
+            Checks if a star with a given status needs no more processing
+            Parameters:
+                        status: status of the star
+                        preload: True if preloading, where computed stars are done
+                        refresh: True if finished stars are searched again for new sectors
+            Returns:
+                        boolean: True if the star can be skipped
+        """
+        done = {NO_DATA, REVIEWED, SAVED}
+        if preload:
+            done.add(COMPUTED)
+        if refresh:
+            done = {NO_DATA}
+
+        return status in done
+
+
+    def claim(self, iau_name):
+        """
+            Claims a star for this worker, unless another worker holds an unexpired claim on it
+            Parameters:
+                        iau_name: name of the star
+            Returns:
+                        boolean: True if the star was claimed
+        """
+        now = time.time()
+
+        with self.connection:
+            # Take the write lock first, so two workers can't claim the same star
+            self.connection.execute('BEGIN IMMEDIATE')
+            cursor = self.connection.execute("""
+                UPDATE stars SET worker = ?, claimed = ?, attempts = attempts + 1
+                WHERE iau_name = ? AND (worker IS NULL OR worker = ? OR claimed < ?)""",
+                (self.worker, now, iau_name, self.worker, now - self.lease))
+
+        return cursor.rowcount == 1
+
+
+    def update(self, iau_name, status, tic=None, error=None, sectors=None):
+        """
+            Records a star's new status, the time since it was claimed, and any error, releasing the claim
+            Parameters:
+                        iau_name: name of the star
+                        status: new status of the star
+                        tic: TIC name of the star (None leaves it unchanged)
+                        error: error text (None if there was no error)
+                        sectors: number of sectors at the cadence (None leaves it unchanged)
+            Returns:
+                        None
+        """
+        now = time.time()
+
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.connection.execute("""
+                UPDATE stars SET status = ?, tic = COALESCE(?, tic), error = ?, finished = ?,
+                    duration = CASE WHEN claimed IS NULL THEN duration ELSE ? - claimed END,
+                    sectors = COALESCE(?, sectors), worker = NULL, claimed = NULL
+                WHERE iau_name = ?""",
+                (status, tic, error, now, now, sectors, iau_name))
+
+
+    def update_tic(self, tic, status):
+        """
+            Records a new status for a star known only by its TIC name (e.g. at review)
+            Parameters:
+                        tic: TIC name of the star
+                        status: new status of the star
+            Returns:
+                        None
+        """
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.connection.execute('UPDATE stars SET status = ? WHERE tic = ?', (status, tic))
+
+
+    def release(self, iau_name, any_worker=False):
+        """
+            Releases a claim on a star without changing its status (e.g. on Ctrl-C, or after its worker crashed)
+            Parameters:
+                        iau_name: name of the star
+                        any_worker: True to release the claim even if another worker holds it
+            Returns:
+                        None
+        """
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.connection.execute('UPDATE stars SET worker = NULL, claimed = NULL WHERE iau_name = ? AND (worker = ? OR ?)',
+                                    (iau_name, self.worker, any_worker))
+
+
+    def merge(self, ledger_dir):
+        """
+            Copies the stars of another ledger (e.g. a shard's) into this one, keeping whichever row of a star is
+            further along, with no claims
+            Parameters:
+                        ledger_dir: path of the other ledger
+            Returns:
+                        num_merged: number of stars copied
+        """
+        columns = ['iau_name', 'tic', 'status', 'finished', 'duration', 'attempts', 'error', 'sectors']
+        other = RunLedger(ledger_dir)
+        rows = other.connection.execute(f"SELECT {', '.join(columns)} FROM stars").fetchall()
+        other.connection.close()
+
+        statuses = self.get_statuses()
+
+        rows = [row for row in rows if row[0] not in statuses or 
+                STATUS_ORDER.index(row[2]) >= STATUS_ORDER.index(statuses[row[0]])]
+
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.connection.executemany(f"INSERT OR REPLACE INTO stars ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                                        rows)
+
+        return len(rows)
+
+
+    def reset(self):
+        """
+            Forgets every star, so the next run starts over, except stars found to have no data within the TTL
+            Parameters:
+                        None
+            Returns:
+                        None
+        """
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.connection.execute('DELETE FROM stars WHERE NOT (status = ? AND finished >= ?)',
+                                    (NO_DATA, time.time() - self.no_data_ttl))
+
+
+    def summary(self):
+        """
+            Counts the stars in each status
+            Parameters:
+                        None
+            Returns:
+                        counts: {status: number of stars}
+        """
+        return dict(self.connection.execute('SELECT status, COUNT(*) FROM stars GROUP BY status'))
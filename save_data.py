@@ -1,19 +1,20 @@
-import csv
+from stage_metrics import timed
 
 
 class SaveData(object):
-    def __init__(self, catalog_data, lightcurve_data, exoplanet_effects):
+    def __init__(self, catalog_data, lightcurve_data, exoplanet_effects, results_store):
         self.catalog_data = catalog_data
         self.lightcurve_data = lightcurve_data
         self.exoplanet_effects = exoplanet_effects
+        self.results_store = results_store
 
-        # Save the data to a csv
-        self.add_to_csv()
+        # Save the data to the results store
+        self.add_to_store()
 
 
     def create_row(self):
         """
-            Creates a row of the current lightcurve's date to be added to the porb_dir
+            Creates a row of the current lightcurve's date to be added to the results store
             Name:       create_row()
             Parameters:
                         None
@@ -23,6 +24,11 @@ class SaveData(object):
         row = {
             'TIC': self.lightcurve_data.name,
             'Orbital period (days)': self.lightcurve_data.period_at_max_power,
+            'Orbital period error (days)': self.lightcurve_data.period_error,
+            'Amplitude': self.lightcurve_data.amplitude,
+            'Amplitude error': self.lightcurve_data.amplitude_error,
+            'Consensus period (days)': self.lightcurve_data.consensus_period,
+            'Consensus score': self.lightcurve_data.consensus_score,
             'Literature period (days)': self.lightcurve_data.lit_period, 
             'i Magnitude': self.lightcurve_data.imag,
             'Eclipsing': self.exoplanet_effects.effects_found[0],
@@ -35,44 +41,18 @@ class SaveData(object):
         return row
 
 
-    def add_to_csv(self):
+    @timed('save_data')
+    def add_to_store(self):
         """
-            Adds the lightcurve's row to the porb_dir
-            Name:       add_to_csv()
+            Queues the lightcurve's row to be written to the results store (exported to porb_dir at the end of the run)
+            Name:       add_to_store()
             Parameters:
                         None
             Returns:
                         None
         """
-        # See if file already exists
-        try:
-            with open(self.catalog_data.porb_dir, 'r') as csvfile:
-                pass
-            file_exists = True
-        except FileNotFoundError:
-            file_exists = False
-
         # Create the row
         row = self.create_row()
-        
-        # Open file in append mode
-        with open(self.catalog_data.porb_dir, 'a', newline='') as csvfile:
-            fieldnames = [
-                'TIC', 
-                'Orbital period (days)', 
-                'Literature period (days)', 
-                'i Magnitude', 'Eclipsing', 
-                'Doppler beaming', 
-                'Flares', 
-                'Irradiation', 
-                'Ellipsoidal'
-            ]
-            
-            writer = csv.DictWriter(csvfile, fieldnames = fieldnames)
 
-            # Write header if file doesn't exist
-            if not file_exists:
-                writer.writeheader()
-            
-            # Append row
-            writer.writerow(row)
+        # Queue the row for the store's writer
+        self.results_store.add('results', row)
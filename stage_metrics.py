@@ -0,0 +1,280 @@
+from contextlib import contextmanager
+import functools
+import json
+import numpy as np
+import os
+from os.path import exists
+import time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None # RSS is read from /proc without psutil
+
+# Recorder of this process (None records nothing, so the hooks cost a global lookup)
+active_metrics = None
+
+
+def get_rss():
+    """
+        Gets the resident memory of this process
+        Parameters:
+                    None
+        Returns:
+                    rss: resident memory in MB (None if it can't be read)
+    """
+    if psutil:
+        return psutil.Process().memory_info().rss / 1024 ** 2
+
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def set_metrics(metrics):
+    """
+        Sets the recorder the stage hooks of this process report to
+        Parameters:
+                    metrics: StageMetrics (None to stop recording)
+        Returns:
+                    None
+    """
+    global active_metrics
+    active_metrics = metrics
+
+
+@contextmanager
+def stage(name):
+    """
+        Measures a block as a stage of the current star
+        Parameters:
+                    name: name of the stage
+        Returns:
+                    None
+    """
+    metrics = active_metrics
+    if metrics is None or metrics.current is None:
+        yield
+        return
+
+    wall, cpu, rss = time.perf_counter(), time.process_time(), get_rss()
+
+    try:
+        yield
+    finally:
+        rss_delta = get_rss() - rss if rss is not None else None
+        metrics.add(name, time.perf_counter() - wall, time.process_time() - cpu, rss_delta)
+
+
+def timed(name):
+    """
+        Decorates a function so every call is measured as a stage of the current star
+        Parameters:
+                    name: name of the stage
+        Returns:
+                    decorator: function decorator
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def star(name):
+    """
+        Measures a block as one star of the current recorder
+        Parameters:
+                    name: catalog name of the star
+        Returns:
+                    outcome: dictionary to set the star's 'status' in
+    """
+    metrics = active_metrics
+    if metrics is None:
+        yield {'status': None}
+        return
+
+    with metrics.star(name) as outcome:
+        yield outcome
+
+
+class StageMetrics(object):
+    def __init__(self, metrics_dir, run_id=None):
+        self.metrics_dir = metrics_dir
+
+        # Every process of a run writes the same run_id, so a run's summary leaves out older runs in the file
+        self.run_id = run_id or f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+
+        # Star being measured, and its stages {stage: [wall, cpu, rss delta, calls]}
+        self.name = None
+        self.current = None
+        self.start = None
+
+        os.makedirs(os.path.dirname(self.metrics_dir) or '.', exist_ok=True)
+
+
+    def get_settings(self):
+        """
+            Gets the arguments this instance was created with, so worker processes can recreate it
+            Parameters:
+                        None
+            Returns:
+                        settings: dictionary of StageMetrics arguments
+        """
+        return {'metrics_dir': self.metrics_dir, 'run_id': self.run_id}
+
+
+    def start_star(self, name):
+        """
+            Starts measuring a star
+            Parameters:
+                        name: catalog name of the star
+            Returns:
+                        None
+        """
+        self.name = name
+        self.current = {}
+        self.start = (time.perf_counter(), time.process_time(), get_rss())
+
+
+    def add(self, name, wall, cpu, rss_delta):
+        """
+            Adds a measured stage to the current star, summing stages run more than once
+            Parameters:
+                        name: name of the stage
+                        wall: wall time (seconds)
+                        cpu: CPU time (seconds)
+                        rss_delta: change in resident memory (MB, None if unknown)
+            Returns:
+                        None
+        """
+        totals = self.current.setdefault(name, [0.0, 0.0, 0.0, 0])
+        totals[0] += wall
+        totals[1] += cpu
+        totals[2] += rss_delta or 0.0
+        totals[3] += 1
+
+
+    def finish_star(self, status=None):
+        """
+            Appends the current star's stages to the metrics file as one JSON line
+            Parameters:
+                        status: status the star ended in
+            Returns:
+                        None
+        """
+        if self.current is None:
+            return
+
+        wall, cpu, rss = self.start
+        rss_end = get_rss()
+
+        record = {
+            'run': self.run_id,
+            'star': self.name,
+            'status': status,
+            'pid': os.getpid(),
+            'time': time.time(),
+            'wall': time.perf_counter() - wall,
+            'cpu': time.process_time() - cpu,
+            'rss': rss_end,
+            'rss_delta': rss_end - rss if rss is not None and rss_end is not None else None,
+            'stages': {name: {'wall': totals[0], 'cpu': totals[1], 'rss_delta': totals[2], 'calls': totals[3]}
+                       for name, totals in self.current.items()}
+        }
+
+        # One short append per line, so processes sharing the file don't interleave
+        with open(self.metrics_dir, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+        self.name = self.current = self.start = None
+
+
+    @contextmanager
+    def star(self, name):
+        """
+            Measures everything in a block as one star, recording the status set on the yielded dictionary
+            Parameters:
+                        name: catalog name of the star
+            Returns:
+                        outcome: dictionary to set the star's 'status' in
+        """
+        outcome = {'status': None}
+        self.start_star(name)
+
+        try:
+            yield outcome
+        finally:
+            self.finish_star(outcome['status'])
+
+
+    def load(self, run_id=None):
+        """
+            Loads the records of a run
+            Parameters:
+                        run_id: run to load (None for this run)
+            Returns:
+                        records: list of star records
+        """
+        run_id = run_id or self.run_id
+        records = []
+
+        if not exists(self.metrics_dir):
+            return records
+
+        with open(self.metrics_dir, 'r') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+
+                record = json.loads(line)
+                if record['run'] == run_id:
+                    records.append(record)
+
+        return records
+
+
+    def summary(self, run_id=None):
+        """
+            Prints the p50 and p95 wall time, CPU time and memory change of every stage over the stars of a run
+            Parameters:
+                        run_id: run to summarize (None for this run)
+            Returns:
+                        summary: {stage: {stars, p50/p95 of wall, cpu and rss_delta, total wall}}
+        """
+        records = self.load(run_id)
+        if not records:
+            return {}
+
+        per_stage = {}
+        for record in records:
+            per_stage.setdefault('total', []).append((record['wall'], record['cpu'], record['rss_delta'] or 0.0))
+            for name, measured in record['stages'].items():
+                per_stage.setdefault(name, []).append((measured['wall'], measured['cpu'], measured['rss_delta']))
+
+        summary = {}
+        for name, values in per_stage.items():
+            values = np.array(values)
+            summary[name] = {'stars': len(values), 'total_wall': values[:, 0].sum()}
+
+            for column, key in enumerate(['wall', 'cpu', 'rss_delta']):
+                summary[name][f'{key}_p50'], summary[name][f'{key}_p95'] = np.percentile(values[:, column], [50, 95])
+
+        # Slowest stages first
+        print(f'\nStage timings over {len(records)} stars (run {run_id or self.run_id}):')
+        print(f"{'stage':<20}{'stars':>7}{'wall p50':>11}{'wall p95':>11}{'cpu p50':>11}{'cpu p95':>11}{'rss p95':>11}{'share':>8}")
+
+        total_wall = summary['total']['total_wall'] or 1.0
+        for name, values in sorted(summary.items(), key=lambda item: (item[0] != 'total', -item[1]['total_wall'])):
+            print(f"{name:<20}{values['stars']:>7}{values['wall_p50']:>10.2f}s{values['wall_p95']:>10.2f}s"
+                  f"{values['cpu_p50']:>10.2f}s{values['cpu_p95']:>10.2f}s{values['rss_delta_p95']:>8.1f} MB"
+                  f"{100 * values['total_wall'] / total_wall:>7.0f}%")
+
+        return summary
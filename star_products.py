@@ -0,0 +1,232 @@
+import numpy as np
+import os
+from os.path import exists
+import shutil
+
+
+class StarProducts(object):
+    def __init__(self, products_dir, periodogram_points=5000):
+        self.products_dir = products_dir
+
+        # Number of points the periodogram is reduced to (only what a plot can show)
+        self.periodogram_points = periodogram_points
+
+        # Create the products directory
+        os.makedirs(self.products_dir, exist_ok=True)
+
+
+    def to_array(self, values):
+        """
+            Converts lightcurve columns (quantities, masked or not) to compact float32 arrays, with masked values as NaN
+            Parameters:
+                        values: column, quantity or array
+            Returns:
+                        array: float32 numpy array
+        """
+        values = getattr(values, 'value', values)
+
+        # Fill masked values with NaN
+        if hasattr(values, 'unmasked'):
+            values = np.where(values.mask, np.nan, values.unmasked)
+
+        return np.asarray(np.ma.filled(values, np.nan), dtype=np.float32)
+
+
+    def periodogram_envelope(self, period, power):
+        """
+            Reduces the periodogram to the maximum power within log spaced period bins, which keeps every peak that
+            would be visible on the log scaled plot
+            Parameters:
+                        period: periodogram periods
+                        power: periodogram power
+            Returns:
+                        envelope_period: period of the maximum power in each bin
+                        envelope_power: maximum power in each bin
+        """
+        # Remove NaNs
+        nan_mask = ~np.isnan(power)
+        period, power = period[nan_mask], power[nan_mask]
+
+        # Nothing to reduce
+        if len(period) <= self.periodogram_points:
+            return period, power
+
+        # Assign each point a log spaced bin
+        edges = np.geomspace(period.min(), period.max(), self.periodogram_points + 1)
+        bins = np.clip(np.searchsorted(edges, period, side='right') - 1, 0, self.periodogram_points - 1)
+
+        # Sort by bin, then by power, so the last point of each bin is its maximum
+        order = np.lexsort((power, bins))
+        last = np.r_[bins[order][1:] != bins[order][:-1], True]
+        keep = np.sort(order[last])
+
+        return period[keep], power[keep]
+
+
+    def create_products(self, lightcurve_data, orb_calculator, flare_predictions=None):
+        """
+            Reduces a star's analysis to the compact numerical products needed to draw its period and effects plots
+            Parameters:
+                        lightcurve_data: LightcurveData of the star
+                        orb_calculator: OrbCalculator of the star
+                        flare_predictions: stella flare probabilities of the star (None to add them later)
+            Returns:
+                        products: dictionary of numpy arrays
+        """
+        # Periodogram
+        period, power = self.periodogram_envelope(self.to_array(lightcurve_data.periodogram.period),
+                                                  self.to_array(lightcurve_data.periodogram.power))
+
+        # Folded and binned lightcurves and sine waves, folded once and twice
+        binned_lightcurve = orb_calculator.binned_lightcurve
+        binned_sine = orb_calculator.binned_sine
+        double_lightcurve = orb_calculator.fold_lightcurve(num_folds=2)
+        double_sine, _ = orb_calculator.fold_sine_wave(lightcurve_data.time, orb_calculator.sine_fit.params['frequency'].value,
+                                                       orb_calculator.sine_fit.best_fit, num_folds=2)
+
+        # Only the plotted window of the lightcurve is kept
+        window = (lightcurve_data.time >= orb_calculator.xmin) & (lightcurve_data.time <= orb_calculator.xmax)
+        sine_fit = orb_calculator.sine_fit.best_fit
+
+        products = {
+            'name': np.array(lightcurve_data.name),
+            'imag': np.array(lightcurve_data.imag),
+            'lit_period': np.array(lightcurve_data.lit_period),
+            'period_at_max_power': np.array(lightcurve_data.period_at_max_power),
+            'consensus_period': np.array([candidate['period'] for candidate in lightcurve_data.period_candidates], dtype=np.float64),
+            'consensus_score': np.array([candidate['score'] for candidate in lightcurve_data.period_candidates], dtype=np.float64),
+            'cutoff': np.array(orb_calculator.cutoff),
+            'is_plausible': np.array(orb_calculator.is_plausible),
+            'periodogram_period': period,
+            'periodogram_power': power,
+            'binned_phase': self.to_array(binned_lightcurve.phase),
+            'binned_flux': self.to_array(binned_lightcurve.flux),
+            'binned_flux_err': self.to_array(binned_lightcurve.flux_err),
+            'binned_sine_phase': self.to_array(binned_sine.phase),
+            'binned_sine_flux': self.to_array(binned_sine.flux),
+            'double_phase': self.to_array(double_lightcurve.phase),
+            'double_flux': self.to_array(double_lightcurve.flux),
+            'double_flux_err': self.to_array(double_lightcurve.flux_err),
+            'double_sine_phase': self.to_array(double_sine.phase),
+            'double_sine_flux': self.to_array(double_sine.flux),
+            'sine_period': np.array(orb_calculator.sine_period),
+            'time_points': np.asarray(orb_calculator.time_points, dtype=np.float64),
+            'xmin': np.array(orb_calculator.xmin),
+            'xmax': np.array(orb_calculator.xmax),
+            'window_time': np.asarray(lightcurve_data.time[window], dtype=np.float64),
+            'window_flux': self.to_array(lightcurve_data.flux[window]),
+            'window_flux_err': self.to_array(lightcurve_data.flux_err[window]),
+            'window_sine': self.to_array(sine_fit[window]),
+            'window_residuals': self.to_array(lightcurve_data.flux[window] - sine_fit[window])
+        }
+
+        self.add_flares(products, flare_predictions or {})
+
+        return products
+
+
+    def add_flares(self, products, flare_predictions):
+        """
+            Adds the flare probabilities of the residuals and the lightcurve to a star's products
+            Parameters:
+                        products: dictionary of numpy arrays from create_products(), added to in place
+                        flare_predictions: {'residuals': (time, flux, probability), 'flux': (time, flux, probability)}
+            Returns:
+                        None
+        """
+        for key, (time, flux, probability) in flare_predictions.items():
+            products[f'flare_{key}_time'] = np.asarray(time, dtype=np.float64)
+            products[f'flare_{key}_flux'] = self.to_array(flux)
+            products[f'flare_{key}_probability'] = self.to_array(probability)
+
+
+    def create_dir(self, tic):
+        """
+            Creates the file name of a star's products
+            Parameters:
+                        tic: TIC name of the star
+            Returns:
+                        products_file: path of the star's products
+        """
+        return os.path.join(self.products_dir, tic + '_products.npz')
+
+
+    def save(self, tic, products):
+        """
+            Saves a star's products, writing to a temporary file first so a reader never sees a partial file
+            Parameters:
+                        tic: TIC name of the star
+                        products: dictionary of numpy arrays from create_products()
+            Returns:
+                        None
+        """
+        products_file = self.create_dir(tic)
+        temp_file = products_file + f'.{os.getpid()}.tmp'
+
+        with open(temp_file, 'wb') as f:
+            np.savez_compressed(f, **products)
+
+        os.replace(temp_file, products_file)
+
+
+    def load(self, tic):
+        """
+            Loads a star's products
+            Parameters:
+                        tic: TIC name of the star
+            Returns:
+                        products: dictionary of numpy arrays (scalars as 0-d arrays)
+        """
+        with np.load(self.create_dir(tic)) as data:
+            products = {key: data[key] for key in data.files}
+
+        return products
+
+
+    def exists(self, tic):
+        """
+            Checks if a star's products have been saved
+            Parameters:
+                        tic: TIC name of the star
+            Returns:
+                        boolean: True if the products exist
+        """
+        return exists(self.create_dir(tic))
+
+
+    def get_tics(self):
+        """
+            Gets the TIC name of every star with saved products
+            Parameters:
+                        None
+            Returns:
+                        tics: list of TIC names
+        """
+        tics = [file.replace('_products.npz', '') for file in sorted(os.listdir(self.products_dir))
+                if file.startswith('TIC') and file.endswith('_products.npz')]
+
+        return tics
+
+
+    def merge(self, products_dir):
+        """
+            Copies every star's products from another directory (e.g. a shard's) that this one doesn't have
+            Parameters:
+                        products_dir: directory of the other products
+            Returns:
+                        num_merged: number of stars copied
+        """
+        other = StarProducts(products_dir)
+
+        num_merged = 0
+        for tic in other.get_tics():
+            if self.exists(tic):
+                continue
+
+            # Copied to a temporary file first so a reader never sees a partial file
+            temp_file = self.create_dir(tic) + f'.{os.getpid()}.tmp'
+            shutil.copyfile(other.create_dir(tic), temp_file)
+            os.replace(temp_file, self.create_dir(tic))
+            num_merged += 1
+
+        return num_merged
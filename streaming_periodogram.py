@@ -0,0 +1,158 @@
+from astropy.timeseries.periodograms.lombscargle.implementations.utils import trig_sum
+import numpy as np
+
+# Extirpolation settings of the FFT trig sums (~1e-5 relative error, against ~1e-2 for astropy's defaults)
+TRIG_SUM_SETTINGS = {'oversampling': 10, 'Mfft': 6}
+
+# Approximate bytes held per point of a time block, and per point of the FFT grid of a frequency block, while summing
+BYTES_PER_POINT = 128
+BYTES_PER_FFT_POINT = 64
+
+
+def lomb_scargle_amplitude(scalar_sums, frequency_sums):
+    """
+        Calculates the floating mean Lomb-Scargle amplitude from weighted sums, matching lightkurve's amplitude
+        normalization
+        Parameters:
+                    scalar_sums: [sum w, sum w y, sum w y^2]
+                    frequency_sums: [C, S, YC, YS, C2, S2] sums of w cos(wt), w sin(wt), w y cos(wt), w y sin(wt),
+                                    w cos(2wt) and w sin(2wt) at each frequency
+        Returns:
+                    power: amplitude at each frequency
+    """
+    W, Y, _ = scalar_sums
+    C, S, YC, YS, C2, S2 = np.asarray(frequency_sums) / W
+    Y = Y / W
+
+    # Sums about the weighted means
+    CC = 0.5 * (1 + C2) - C * C
+    SS = 0.5 * (1 - C2) - S * S
+    CS = 0.5 * S2 - C * S
+    YC = YC - Y * C
+    YS = YS - Y * S
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = (SS * YC * YC + CC * YS * YS - 2 * CS * YC * YS) / (CC * SS - CS * CS)
+
+    return np.sqrt(2 * np.clip(p, 0, None))
+
+
+class StreamingPeriodogram(object):
+    def __init__(self, memory_limit=256, oversample_factor=10):
+        # Memory allowed for the working arrays, in MB (the lightcurve and output arrays are not counted)
+        self.memory_limit = memory_limit
+
+        # Grid spacing as in lightkurve, 1 / (oversample_factor * baseline)
+        self.oversample_factor = oversample_factor
+
+
+    def create_grid(self, time, minimum_period, maximum_period):
+        """
+            Creates the uniform frequency grid lightkurve would use for a lightcurve
+            Parameters:
+                        time: time data of the lightcurve (days)
+                        minimum_period: minimum period (days)
+                        maximum_period: maximum period (days)
+            Returns:
+                        minimum_frequency: first grid frequency (1/day)
+                        frequency_spacing: grid spacing (1/day)
+                        num_frequencies: number of grid frequencies
+        """
+        minimum_frequency = 1 / maximum_period
+        frequency_spacing = 1 / (self.oversample_factor * (time.max() - time.min()))
+        num_frequencies = len(np.arange(minimum_frequency, 1 / minimum_period, frequency_spacing))
+
+        return minimum_frequency, frequency_spacing, num_frequencies
+
+
+    def get_block_sizes(self, num_points, num_frequencies):
+        """
+            Splits the memory limit between a block of points and a block of frequencies
+            Parameters:
+                        num_points: number of points in the lightcurve
+                        num_frequencies: number of grid frequencies
+            Returns:
+                        time_block: points summed at a time
+                        frequency_block: frequencies summed at a time
+        """
+        budget = self.memory_limit * 1024 ** 2 / 2
+
+        time_block = int(min(num_points, max(1024, budget // BYTES_PER_POINT)))
+
+        # FFT grids are a power of two of at least oversampling points per frequency, so fill the largest that fits
+        fft_points = 2 ** int(np.log2(max(budget // BYTES_PER_FFT_POINT, 2)))
+        frequency_block = int(min(num_frequencies, max(1024, fft_points // TRIG_SUM_SETTINGS['oversampling'])))
+
+        return time_block, frequency_block
+
+
+    def block_sums(self, time, flux, weights, start_frequency, frequency_spacing, num_frequencies, time_block):
+        """
+            Accumulates the Lomb-Scargle sums of a block of frequencies over every block of points
+            Parameters:
+                        time: time data (days)
+                        flux: flux data, about its weighted mean
+                        weights: weight of each point
+                        start_frequency: first frequency of the block (1/day)
+                        frequency_spacing: grid spacing (1/day)
+                        num_frequencies: number of frequencies in the block
+                        time_block: points summed at a time
+            Returns:
+                        frequency_sums: [C, S, YC, YS, C2, S2] of the block
+        """
+        frequency_sums = np.zeros((6, num_frequencies))
+
+        for start in range(0, len(time), time_block):
+            block = slice(start, start + time_block)
+            block_time, block_weights = time[block], weights[block]
+
+            S, C = trig_sum(block_time, block_weights, frequency_spacing, num_frequencies, f0=start_frequency, 
+                            **TRIG_SUM_SETTINGS)
+            YS, YC = trig_sum(block_time, block_weights * flux[block], frequency_spacing, num_frequencies, f0=start_frequency, 
+                              **TRIG_SUM_SETTINGS)
+            S2, C2 = trig_sum(block_time, block_weights, frequency_spacing, num_frequencies, f0=start_frequency, freq_factor=2, 
+                              **TRIG_SUM_SETTINGS)
+
+            frequency_sums += (C, S, YC, YS, C2, S2)
+
+        return frequency_sums
+
+
+    def compute(self, time, flux, weights=None, minimum_period=None, maximum_period=14):
+        """
+            Calculates the periodogram a block of frequencies at a time, each summed a block of points at a time,
+            so working memory stays under the memory limit however long the lightcurve
+            Parameters:
+                        time: time data (days)
+                        flux: flux data
+                        weights: weight of each point (None for equal weights, as in lightkurve)
+                        minimum_period: minimum period (days, None for twice the median spacing)
+                        maximum_period: maximum period (days)
+            Returns:
+                        frequency: grid frequencies (1/day)
+                        power: amplitude at each grid frequency
+        """
+        time = np.asarray(time, dtype=float)
+        flux = np.asarray(flux, dtype=float)
+        weights = np.ones_like(time) if weights is None else np.asarray(weights, dtype=float)
+
+        if minimum_period is None:
+            minimum_period = 2 * np.median(np.diff(time))
+
+        minimum_frequency, frequency_spacing, num_frequencies = self.create_grid(time, minimum_period, maximum_period)
+        time_block, frequency_block = self.get_block_sizes(len(time), num_frequencies)
+
+        # Center the flux, so the sums don't lose precision to the mean
+        scalar_sums = np.array([weights.sum(), np.dot(weights, flux), 0.0])
+        flux = flux - scalar_sums[1] / scalar_sums[0]
+        scalar_sums[1] = 0.0
+
+        frequency = minimum_frequency + frequency_spacing * np.arange(num_frequencies)
+        power = np.empty(num_frequencies)
+
+        for start in range(0, num_frequencies, frequency_block):
+            stop = min(start + frequency_block, num_frequencies)
+            frequency_sums = self.block_sums(time, flux, weights, frequency[start], frequency_spacing, stop - start, time_block)
+            power[start:stop] = lomb_scargle_amplitude(scalar_sums, frequency_sums)
+
+        return frequency, power
@@ -0,0 +1,304 @@
+import json
+import numpy as np
+import os
+
+from autopilot import AUTOPILOT_SCREENS
+
+# TESS sampling (days): sectors of two orbits, with a downlink gap between orbits and sectors
+SECTOR_LENGTH = 27.4
+DOWNLINK_GAP = 1.0
+
+# Drawn parameters of every star, in store column order
+PARAMETERS = ['period', 't0', 'eclipse_depth', 'eclipse_width', 'secondary_ratio', 'beaming', 'reflection',
+              'ellipsoidal', 'num_flares', 'white_noise', 'red_noise', 'red_index', 'period_snr']
+
+
+class SyntheticLightcurves(object):
+    def __init__(self, cadence=120, num_sectors=1, seed=0, period_range=(0.05, 10), max_flares=20, flare_window=240,
+                 dropout_fraction=0.02, snr_cutoff=7.0):
+        # Sampling
+        self.cadence = cadence # Seconds
+        self.num_sectors = num_sectors
+
+        # Batches are drawn from SeedSequence([seed, batch number]), so a store is the same however it was batched
+        # up to the batch size
+        self.seed = seed
+
+        # Orbital periods are log uniform over period_range (days)
+        self.period_range = period_range
+
+        # Most flares a star can have, and the points each flare's decay is added over
+        self.max_flares = max_flares
+        self.flare_window = flare_window
+
+        # Fraction of points flagged (e.g. momentum dumps, scattered light), on top of the downlink gaps
+        self.dropout_fraction = dropout_fraction
+
+        # Periodic signals above this amplitude signal to noise are labelled real periods
+        self.snr_cutoff = snr_cutoff
+
+        # Shared time grid, with the downlink gaps masked
+        self.time, self.in_gap = self.create_time()
+
+
+    def create_time(self):
+        """
+            Creates the uniform time grid of every star, marking the points that fall in downlink gaps
+            Parameters:
+                        None
+            Returns:
+                        time: time of each point (days)
+                        in_gap: True for points in a downlink gap
+        """
+        step = self.cadence / 86400
+        time = 2000 + np.arange(0, self.num_sectors * SECTOR_LENGTH, step)
+
+        # Each orbit ends with a downlink gap
+        orbit_time = (time - 2000) % (SECTOR_LENGTH / 2)
+        in_gap = orbit_time >= SECTOR_LENGTH / 2 - DOWNLINK_GAP
+
+        return time, in_gap
+
+
+    def draw_parameters(self, rng, batch_size):
+        """
+            Draws the orbit, effects and noise of a batch of stars
+            Parameters:
+                        rng: numpy random generator
+                        batch_size: number of stars
+            Returns:
+                        parameters: {parameter: array of batch_size values}, the effect amplitudes 0 where absent
+        """
+        # Log uniform amplitudes, present in a given fraction of stars
+        def some(probability, low, high):
+            values = np.exp(rng.uniform(np.log(low), np.log(high), batch_size))
+            return np.where(rng.random(batch_size) < probability, values, 0.0)
+
+        period = np.exp(rng.uniform(*np.log(self.period_range), batch_size))
+
+        parameters = {
+            'period': period,
+            't0': rng.uniform(0, 1, batch_size) * period,
+            'eclipse_depth': some(0.25, 0.02, 0.8),
+            'eclipse_width': rng.uniform(0.01, 0.05, batch_size), # Phase
+            'secondary_ratio': rng.uniform(0, 0.3, batch_size),
+            'beaming': some(0.2, 2e-4, 5e-3),
+            'reflection': some(0.4, 1e-3, 1e-1),
+            'ellipsoidal': some(0.3, 5e-4, 3e-2),
+            'num_flares': np.where(rng.random(batch_size) < 0.3, rng.integers(1, self.max_flares + 1, batch_size), 0),
+            'white_noise': np.exp(rng.uniform(np.log(1e-3), np.log(5e-2), batch_size)),
+            'red_noise': np.exp(rng.uniform(np.log(1e-4), np.log(1e-2), batch_size)),
+            'red_index': rng.uniform(1, 2, batch_size) # Power spectrum slope of the red noise
+        }
+
+        return parameters
+
+
+    def orbital_signal(self, parameters):
+        """
+            Creates the eclipses, Doppler beaming, reflection and ellipsoidal modulation of a batch
+            Parameters:
+                        parameters: drawn parameters of the batch
+            Returns:
+                        signal: (batch, time) relative flux
+        """
+        column = lambda name: parameters[name][:, None]
+
+        phase = ((self.time[None, :] - column('t0')) / column('period')) % 1
+        angle = 2 * np.pi * phase
+
+        # Reflection peaks at phase 0.5, when the irradiated face is seen
+        signal = (column('beaming') * np.sin(angle)
+                  - column('reflection') * np.cos(angle)
+                  - column('ellipsoidal') * np.cos(2 * angle))
+
+        # Trapezoid eclipses, the primary at phase 0 and the secondary at phase 0.5
+        half_width = column('eclipse_width') / 2
+        for center, depth in [(0.0, column('eclipse_depth')), (0.5, column('eclipse_depth') * column('secondary_ratio'))]:
+            distance = np.abs((phase - center + 0.5) % 1 - 0.5)
+            signal -= depth * np.clip((half_width - distance) / (0.25 * half_width), 0, 1)
+
+        return signal
+
+
+    def add_flares(self, rng, flux, parameters):
+        """
+            Adds flares with a one cadence rise and an exponential decay, over a window of points after each start
+            Parameters:
+                        rng: numpy random generator
+                        flux: (batch, time) relative flux, added to in place
+                        parameters: drawn parameters of the batch
+            Returns:
+                        None
+        """
+        batch_size, num_points = flux.shape
+
+        # Every star draws max_flares flares, keeping the first num_flares
+        shape = (batch_size, self.max_flares)
+        starts = rng.integers(0, num_points, shape)
+        amplitudes = np.exp(rng.uniform(np.log(5e-3), np.log(0.5), shape))
+        decays = np.exp(rng.uniform(np.log(2), np.log(60), shape)) * 60 / self.cadence # Points
+        kept = np.arange(self.max_flares)[None, :] < parameters['num_flares'][:, None]
+
+        offsets = np.arange(self.flare_window)
+        indices = starts[..., None] + offsets
+        values = (amplitudes * kept)[..., None] * np.exp(-offsets / decays[..., None])
+
+        inside = indices < num_points
+        rows = np.broadcast_to(np.arange(batch_size)[:, None, None], indices.shape)
+
+        np.add.at(flux, (rows[inside], indices[inside]), values[inside])
+
+
+    def red_noise(self, rng, parameters, num_points):
+        """
+            Creates power law noise by shaping white noise in the frequency domain
+            Parameters:
+                        rng: numpy random generator
+                        parameters: drawn parameters of the batch
+                        num_points: number of points
+            Returns:
+                        noise: (batch, time) red noise, with a standard deviation of red_noise
+        """
+        batch_size = len(parameters['red_index'])
+
+        spectrum = np.fft.rfft(rng.standard_normal((batch_size, num_points)), axis=1)
+        frequency = np.fft.rfftfreq(num_points)
+        frequency[0] = frequency[1]
+
+        spectrum *= frequency[None, :] ** (-parameters['red_index'][:, None] / 2)
+        noise = np.fft.irfft(spectrum, n=num_points, axis=1)
+        noise /= noise.std(axis=1, keepdims=True)
+
+        return noise * parameters['red_noise'][:, None]
+
+
+    def create_labels(self, parameters):
+        """
+            Labels the autopilot screens of a batch from the injected signals
+            Parameters:
+                        parameters: drawn parameters of the batch
+            Returns:
+                        labels: (batch, len(AUTOPILOT_SCREENS)) 1 where the effect is there, 0 where not
+        """
+        labels = np.zeros((len(parameters['period']), len(AUTOPILOT_SCREENS)), dtype=np.float32)
+
+        labels[:, AUTOPILOT_SCREENS.index('Period')] = parameters['period_snr'] >= self.snr_cutoff
+        labels[:, AUTOPILOT_SCREENS.index('Eclipsing')] = parameters['eclipse_depth'] > 0
+        labels[:, AUTOPILOT_SCREENS.index('Doppler beaming')] = parameters['beaming'] > 0
+        labels[:, AUTOPILOT_SCREENS.index('Flares')] = parameters['num_flares'] > 0
+
+        return labels
+
+
+    def create_batch(self, batch_number, batch_size):
+        """
+            Creates a reproducible batch of lightcurves
+            Parameters:
+                        batch_number: number of the batch, seeding it along with the generator's seed
+                        batch_size: number of stars
+            Returns:
+                        flux: (batch, time) float32 normalized flux, NaN where no data
+                        labels: (batch, len(AUTOPILOT_SCREENS)) labels
+                        parameters: {parameter: array of batch_size values}
+        """
+        rng = np.random.default_rng(np.random.SeedSequence([self.seed, batch_number]))
+        num_points = len(self.time)
+
+        parameters = self.draw_parameters(rng, batch_size)
+
+        flux = 1 + self.orbital_signal(parameters)
+        self.add_flares(rng, flux, parameters)
+
+        flux += self.red_noise(rng, parameters, num_points)
+        flux += rng.standard_normal((batch_size, num_points)) * parameters['white_noise'][:, None]
+
+        # Downlink gaps, and flagged points of each star
+        missing = self.in_gap[None, :] | (rng.random((batch_size, num_points)) < self.dropout_fraction)
+        flux[missing] = np.nan
+
+        # Amplitude signal to noise of the strongest periodic signal, as a periodogram peak would see it
+        # (an eclipse only counts for the fraction of the orbit it lasts)
+        eclipse = parameters['eclipse_depth'] * parameters['eclipse_width']
+        amplitude = np.max([parameters['beaming'], parameters['reflection'], parameters['ellipsoidal'], eclipse], axis=0)
+        noise = np.hypot(parameters['white_noise'], parameters['red_noise'])
+        parameters['period_snr'] = amplitude * np.sqrt((~missing).sum(axis=1) / 2) / noise
+
+        return flux.astype(np.float32), self.create_labels(parameters), parameters
+
+
+    def generate(self, num_stars, batch_size=256):
+        """
+            Generates lightcurves a batch at a time
+            Parameters:
+                        num_stars: number of stars
+                        batch_size: stars per batch
+            Returns:
+                        batches: generator of (flux, labels, parameters) batches
+        """
+        for batch_number, start in enumerate(range(0, num_stars, batch_size)):
+            yield self.create_batch(batch_number, min(batch_size, num_stars - start))
+
+
+    def write(self, store_dir, num_stars, batch_size=256):
+        """
+            Writes lightcurves straight into memory mapped .npy arrays, a batch at a time
+            Parameters:
+                        store_dir: directory of the array store
+                        num_stars: number of stars
+                        batch_size: stars per batch
+            Returns:
+                        None
+        """
+        os.makedirs(store_dir, exist_ok=True)
+
+        np.save(os.path.join(store_dir, 'time.npy'), self.time)
+
+        open_memmap = np.lib.format.open_memmap
+        flux_store = open_memmap(os.path.join(store_dir, 'flux.npy'), mode='w+', dtype=np.float32, shape=(num_stars, len(self.time)))
+        labels_store = open_memmap(os.path.join(store_dir, 'labels.npy'), mode='w+', dtype=np.float32,
+                                   shape=(num_stars, len(AUTOPILOT_SCREENS)))
+        parameters_store = open_memmap(os.path.join(store_dir, 'parameters.npy'), mode='w+', dtype=np.float64,
+                                       shape=(num_stars, len(PARAMETERS)))
+
+        start = 0
+        for flux, labels, parameters in self.generate(num_stars, batch_size):
+            stop = start + len(flux)
+
+            flux_store[start:stop] = flux
+            labels_store[start:stop] = labels
+            parameters_store[start:stop] = np.stack([parameters[name] for name in PARAMETERS], axis=1)
+
+            start = stop
+
+        for store in [flux_store, labels_store, parameters_store]:
+            store.flush()
+
+        meta = {
+            'num_stars': num_stars,
+            'batch_size': batch_size,
+            'cadence': self.cadence,
+            'num_sectors': self.num_sectors,
+            'seed': self.seed,
+            'screens': AUTOPILOT_SCREENS,
+            'parameters': PARAMETERS
+        }
+
+        with open(os.path.join(store_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=4)
+
+
+def load_store(store_dir):
+    """
+        Opens an array store written by SyntheticLightcurves.write(), memory mapped
+        Parameters:
+                    store_dir: directory of the array store
+        Returns:
+                    time: time of each point (days)
+                    flux: (stars, time) memory mapped flux
+                    labels: (stars, len(AUTOPILOT_SCREENS)) memory mapped labels
+                    parameters: (stars, len(PARAMETERS)) memory mapped parameters
+    """
+    load = lambda name, mmap_mode='r': np.load(os.path.join(store_dir, f'{name}.npy'), mmap_mode=mmap_mode)
+
+    return load('time', None), load('flux'), load('labels'), load('parameters')
@@ -0,0 +1,65 @@
+import numpy as np
+
+from run_ledger import *
+
+
+class TargetScheduler(object):
+    def __init__(self, ledger, porb_weight=5.0, sector_weight=1.0):
+        self.ledger = ledger
+
+        # Score weights, in i magnitudes (a literature period is worth being porb_weight magnitudes brighter)
+        self.porb_weight = porb_weight
+        self.sector_weight = sector_weight # Per e-fold in the number of sectors
+
+
+    def score(self, catalog_df, sectors):
+        """
+            Scores the expected yield of each catalog row from its i magnitude, whether it has a literature period,
+            and its number of sectors at the cadence
+            Parameters:
+                        catalog_df: pandas dataframe of the catalog data
+                        sectors: {iau_name: number of sectors} of searched stars
+            Returns:
+                        scores: numpy array of scores (higher is searched first)
+        """
+        # Missing magnitudes are stored as 0, so count them as the faintest
+        imag = catalog_df['i'].to_numpy(dtype=float)
+        missing = ~np.isfinite(imag) | (imag <= 0)
+        imag[missing] = imag[~missing].max() if (~missing).any() else 0.0
+
+        has_porb = (catalog_df['porb'].fillna(0).to_numpy(dtype=float) > 0)
+
+        # Stars never searched are counted as having one sector
+        num_sectors = catalog_df['iau_name'].map(sectors).fillna(1).to_numpy(dtype=float)
+
+        scores = -imag + self.porb_weight * has_porb + self.sector_weight * np.log1p(num_sectors)
+
+        return scores
+
+
+    def order(self, catalog_df):
+        """
+            Orders the catalog by expected yield, dropping stars known to have no data at the cadence
+            Parameters:
+                        catalog_df: pandas dataframe of the catalog data
+            Returns:
+                        catalog_df: reordered pandas dataframe (keeping the original index)
+        """
+        # Search stars again once their no data result is older than the TTL
+        num_expired = self.ledger.expire()
+        if num_expired:
+            print(f'Searching {num_expired} stars with no data again')
+
+        statuses = self.ledger.get_statuses()
+        known_empty = catalog_df['iau_name'].map(statuses).eq(NO_DATA).to_numpy()
+
+        if known_empty.any():
+            print(f'Skipping {known_empty.sum()} stars known to have no data at the cadence')
+
+        catalog_df = catalog_df[~known_empty]
+
+        # Stable, so ties keep catalog order
+        scores = self.score(catalog_df, self.ledger.get_sectors())
+        order = np.argsort(-scores, kind='stable')
+
+        return catalog_df.iloc[order]
@@ -0,0 +1,362 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing as mp
+import numpy as np
+import os
+from os.path import exists
+from tqdm import tqdm
+
+try:
+    import h5py
+except ImportError:
+    h5py = None # Training sets need h5py
+
+from autopilot import *
+from memory_guard import release_memory
+from preload_engine import init_worker
+
+
+def star_features(catalog_row, cadence, lightcurve_settings=None):
+    """
+        Runs the headless analysis of one catalog row in a worker process and creates its autopilot features
+        Parameters:
+                    catalog_row: row of the catalog dataframe
+                    cadence: desired cadence for lightcurves
+                    lightcurve_settings: LightcurveData keyword arguments
+        Returns:
+                    tic: TIC name of the star (None if there was no lightcurve)
+                    features: NUM_FEATURES float array (None if there was no lightcurve)
+                    labels: len(AUTOPILOT_SCREENS) labels from the literature period, NaN where unknown
+    """
+    from preload_plots import PreloadPlots
+    from lightcurve_data import LightcurveData
+    from orb_calculator import OrbCalculator
+    from exoplanet_effects import ExoplanetEffects
+
+    # Products preload, so nothing is drawn
+    preload_plots = PreloadPlots(True, None, True)
+
+    try:
+        lightcurve_data = LightcurveData(catalog_row, cadence, **(lightcurve_settings or {}))
+        if not lightcurve_data.lightcurve:
+            return None, None, None
+
+        # Kept, as the lightcurve is released before the features are made
+        tic = lightcurve_data.name
+
+        orb_calculator = OrbCalculator(lightcurve_data, preload_plots)
+        exoplanet_effects = ExoplanetEffects(lightcurve_data, orb_calculator, preload_plots)
+
+        products = preload_plots.star_products.create_products(lightcurve_data, orb_calculator, exoplanet_effects.flare_predictions)
+
+    finally:
+        lightcurve_data = orb_calculator = exoplanet_effects = None
+        release_memory()
+
+    features = create_features(products)
+
+    # A period matching the literature period (or half of it) is real, anything else waits for a reviewer
+    labels = np.full(len(AUTOPILOT_SCREENS), np.nan)
+    lit_matches = [features[SCALAR_FEATURES_START + SCALAR_FEATURES.index(name)]
+                   for name in ['literature period', 'literature period doubled']]
+    if any(lit_matches):
+        labels[AUTOPILOT_SCREENS.index('Period')] = 1.0
+
+    return tic, features, labels
+
+
+class TrainingSet(object):
+    def __init__(self, training_dir, chunk_rows=256, compression='gzip'):
+        if h5py is None:
+            raise ImportError('Training sets need h5py (pip install h5py)')
+
+        self.training_dir = training_dir
+
+        # Rows per HDF5 chunk, the unit stars are written, compressed and read in
+        self.chunk_rows = chunk_rows
+        self.compression = compression
+
+        # Create the datasets
+        os.makedirs(os.path.dirname(self.training_dir) or '.', exist_ok=True)
+        if not exists(self.training_dir):
+            self.create()
+
+
+    def create(self):
+        """
+            Creates the empty, resizable, chunked datasets, one row per star
+            Parameters:
+                        None
+            Returns:
+                        None
+        """
+        string_dtype = h5py.string_dtype()
+
+        with h5py.File(self.training_dir, 'w') as f:
+            f.attrs['screens'] = AUTOPILOT_SCREENS
+            f.attrs['num_features'] = NUM_FEATURES
+
+            for name in ['iau_name', 'tic']:
+                f.create_dataset(name, shape=(0,), maxshape=(None,), dtype=string_dtype, chunks=(self.chunk_rows,))
+
+            f.create_dataset('features', shape=(0, NUM_FEATURES), maxshape=(None, NUM_FEATURES), dtype=np.float32,
+                             chunks=(self.chunk_rows, NUM_FEATURES), compression=self.compression, shuffle=True)
+            f.create_dataset('labels', shape=(0, len(AUTOPILOT_SCREENS)), maxshape=(None, len(AUTOPILOT_SCREENS)),
+                             dtype=np.float32, chunks=(self.chunk_rows, len(AUTOPILOT_SCREENS)), fillvalue=np.nan)
+
+
+    def check(self, f):
+        """
+            Checks a training set was made with the current screens and features
+            Parameters:
+                        f: open h5py file
+            Returns:
+                        None
+        """
+        if list(f.attrs['screens']) != AUTOPILOT_SCREENS or int(f.attrs['num_features']) != NUM_FEATURES:
+            raise ValueError(f'Training set {self.training_dir} was made with different screens or features')
+
+
+    def get_index(self, name='tic'):
+        """
+            Gets the row of every star
+            Parameters:
+                        name: 'tic' or 'iau_name'
+            Returns:
+                        index: {name: row}
+        """
+        with h5py.File(self.training_dir, 'r') as f:
+            names = f[name].asstr()[:]
+
+        return {value: row for row, value in enumerate(names)}
+
+
+    def append(self, iau_names, tics, features, labels):
+        """
+            Appends rows to the end of every dataset (stars already in the set are overwritten in place)
+            Parameters:
+                        iau_names: catalog names of the stars
+                        tics: TIC names of the stars
+                        features: (stars, NUM_FEATURES) features
+                        labels: (stars, len(AUTOPILOT_SCREENS)) labels, NaN where unknown
+            Returns:
+                        None
+        """
+        index = self.get_index()
+        features = np.asarray(features, dtype=np.float32).reshape(-1, NUM_FEATURES)
+        labels = np.asarray(labels, dtype=np.float32).reshape(-1, len(AUTOPILOT_SCREENS))
+
+        existing = np.array([tic in index for tic in tics], dtype=bool)
+
+        with h5py.File(self.training_dir, 'a') as f:
+            self.check(f)
+
+            for position in np.flatnonzero(existing):
+                row = index[tics[position]]
+                f['features'][row] = features[position]
+                f['labels'][row] = labels[position]
+
+            new = np.flatnonzero(~existing)
+            if not len(new):
+                return
+
+            # One resize and one contiguous write per dataset
+            start = f['tic'].shape[0]
+            for name, values in [('iau_name', [iau_names[i] for i in new]), ('tic', [tics[i] for i in new]),
+                                 ('features', features[new]), ('labels', labels[new])]:
+                f[name].resize(start + len(new), axis=0)
+                f[name][start:] = values
+
+
+    def add_labels(self, answers):
+        """
+            Sets the labels of stars already in the set, e.g. from reviewer answers given after the set was built
+            Parameters:
+                        answers: {tic: {screen: True/False}}
+            Returns:
+                        num_labelled: number of stars in the set whose labels were set
+        """
+        index = self.get_index()
+        rows = sorted(index[tic] for tic in answers if tic in index)
+
+        if not rows:
+            return 0
+
+        with h5py.File(self.training_dir, 'a') as f:
+            self.check(f)
+
+            # Read and write the labels once, rather than a row at a time
+            labels = f['labels'][rows[0]:rows[-1] + 1]
+            tics = f['tic'].asstr()[rows[0]:rows[-1] + 1]
+
+            for position, tic in enumerate(tics):
+                for screen, answer in answers.get(tic, {}).items():
+                    if screen in AUTOPILOT_SCREENS:
+                        labels[position, AUTOPILOT_SCREENS.index(screen)] = float(answer)
+
+            f['labels'][rows[0]:rows[-1] + 1] = labels
+
+        return len(rows)
+
+
+    def build(self, catalog_df, cadence, workers=4, lightcurve_settings=None, worker_memory=None):
+        """
+            Computes the features of every catalog row not in the set yet across a process pool, with the main
+            process writing them a chunk of rows at a time
+            Parameters:
+                        catalog_df: pandas dataframe of the catalog data
+                        cadence: desired cadence for lightcurves
+                        workers: number of worker processes
+                        lightcurve_settings: LightcurveData keyword arguments
+                        worker_memory: maximum memory per worker in MB (None for no limit)
+            Returns:
+                        failed: {iau_name: error} of the stars whose analysis raised
+        """
+        done = self.get_index('iau_name')
+        pending = [row for _, row in catalog_df.iterrows() if row['iau_name'] not in done]
+        failed = {}
+
+        if not pending:
+            print(f'Every star is already in {self.training_dir}')
+            return failed
+
+        executor = ProcessPoolExecutor(max_workers = workers,
+                                       mp_context = mp.get_context('spawn'),
+                                       initializer = init_worker,
+                                       initargs = (None, worker_memory),
+                                       max_tasks_per_child = 25)
+
+        buffer = []
+
+        try:
+            futures = {executor.submit(star_features, row, cadence, lightcurve_settings): row['iau_name'] for row in pending}
+
+            for future in tqdm(as_completed(futures), 'Building training set', total = len(futures)):
+                iau_name = futures[future]
+
+                try:
+                    tic, features, labels = future.result()
+                except Exception as e:
+                    print(f'Error for {iau_name}: {e} \n')
+                    failed[iau_name] = repr(e)
+                    continue
+
+                if tic is None:
+                    continue
+
+                buffer.append((iau_name, tic, features, labels))
+
+                # Write whole chunks
+                if len(buffer) >= self.chunk_rows:
+                    self.append(*zip(*buffer))
+                    buffer = []
+
+        finally:
+            if buffer:
+                self.append(*zip(*buffer))
+
+            executor.shutdown(wait = True, cancel_futures = True)
+
+        return failed
+
+
+    def create_loader(self, batch_size=64, shuffle=True, labelled_only=True, buffer_chunks=8, seed=0):
+        """
+            Creates a streaming loader of the set
+            Parameters:
+                        batch_size: stars per batch
+                        shuffle: True to shuffle the stars every pass
+                        labelled_only: True to skip stars without any label
+                        buffer_chunks: chunks held in memory at a time
+                        seed: random seed of the shuffle
+            Returns:
+                        loader: TrainingLoader
+        """
+        return TrainingLoader(self.training_dir, batch_size, shuffle, labelled_only, buffer_chunks, seed)
+
+
+class TrainingLoader(object):
+    def __init__(self, training_dir, batch_size=64, shuffle=True, labelled_only=True, buffer_chunks=8, seed=0):
+        if h5py is None:
+            raise ImportError('Training sets need h5py (pip install h5py)')
+
+        self.training_dir = training_dir
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.labelled_only = labelled_only # Skip stars without any label
+
+        # Chunks read, and shuffled together, at a time, so memory is buffer_chunks * chunk rows
+        self.buffer_chunks = buffer_chunks
+
+        self.rng = np.random.default_rng(seed)
+
+
+    def read_windows(self):
+        """
+            Reads the set a window of whole HDF5 chunks at a time, so every chunk is decompressed once per pass
+            Parameters:
+                        None
+            Returns:
+                        windows: generator of (features, labels) windows
+        """
+        with h5py.File(self.training_dir, 'r') as f:
+            features, labels = f['features'], f['labels']
+            chunk_rows = features.chunks[0]
+            starts = np.arange(0, features.shape[0], chunk_rows)
+
+            if self.shuffle:
+                starts = self.rng.permutation(starts)
+
+            for i in range(0, len(starts), self.buffer_chunks):
+                windows = [(features[start:start + chunk_rows], labels[start:start + chunk_rows])
+                           for start in starts[i:i + self.buffer_chunks]]
+
+                window_features = np.concatenate([window[0] for window in windows])
+                window_labels = np.concatenate([window[1] for window in windows])
+
+                if self.labelled_only:
+                    labelled = np.isfinite(window_labels).any(axis=1)
+                    window_features, window_labels = window_features[labelled], window_labels[labelled]
+
+                yield window_features, window_labels
+
+
+    def feature_statistics(self):
+        """
+            Calculates the mean and standard deviation of every feature in one streamed pass
+            Parameters:
+                        None
+            Returns:
+                        feature_mean: mean of each feature
+                        feature_scale: standard deviation of each feature
+        """
+        count, sums, squares = 0, np.zeros(NUM_FEATURES), np.zeros(NUM_FEATURES)
+
+        for features, _ in self.read_windows():
+            features = features.astype(np.float64)
+            count += len(features)
+            sums += features.sum(axis=0)
+            squares += (features * features).sum(axis=0)
+
+        if not count:
+            raise ValueError(f'No labelled stars in {self.training_dir}')
+
+        feature_mean = sums / count
+        feature_scale = np.sqrt(np.clip(squares / count - feature_mean * feature_mean, 0, None))
+
+        return feature_mean, feature_scale
+
+
+    def __iter__(self):
+        """
+            Streams batches of the set, shuffled within each window of chunks
+            Parameters:
+                        None
+            Returns:
+                        batches: generator of (features, labels) batches
+        """
+        for features, labels in self.read_windows():
+            order = self.rng.permutation(len(features)) if self.shuffle else np.arange(len(features))
+
+            for start in range(0, len(order), self.batch_size):
+                batch = order[start:start + self.batch_size]
+                yield features[batch], labels[batch]